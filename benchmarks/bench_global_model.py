@@ -0,0 +1,160 @@
+import resource
+import tempfile
+import time
+from pathlib import Path
+
+import click
+from catboost import CatBoostRegressor
+from workalendar.america import Brazil
+
+from benchmarks.synthetic_olist import generate_raw_datasets
+from scr.model_pipeline.dataset_store import get_dataset_store
+from scr.model_pipeline.feature_engineering import (
+    KEY_COL_LIST,
+    build_model_data,
+)
+from scr.model_pipeline.streaming_ingestion import ingest_raw_datasets
+from scr.model_pipeline.temporal_target_and_split import (
+    COLUMNS_PER_READ,
+    split_model_data,
+)
+
+
+def peak_memory_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def split(store, split_data):
+    """
+    Train/validation rows of model_data with a 1 week target, by the
+    column-batched split of the temporal_target_and_split stage. The rows
+    without a target are left out
+    """
+
+    x_train, y_train, x_val, y_val = split_model_data(
+        store, "sales_amount_sum", [1], split_data, COLUMNS_PER_READ
+    )
+    has_train_target = y_train.iloc[:, 0].notna().to_numpy()
+    has_val_target = y_val.iloc[:, 0].notna().to_numpy()
+    features = x_train.columns.drop("order_purchase_date")
+
+    return (
+        x_train.loc[has_train_target, features],
+        y_train.iloc[:, 0].to_numpy()[has_train_target],
+        x_val.loc[has_val_target, features],
+    )
+
+
+def train_global_model(split_dfs, iterations):
+    x_train, y_train, x_val = split_dfs
+    model = CatBoostRegressor(
+        iterations=iterations,
+        cat_features=list(x_train.select_dtypes(["object", "category"])),
+        verbose=0,
+    )
+    model.fit(x_train, y_train)
+
+    return model.predict(x_val)
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+# pylint: disable=too-many-locals
+@click.command()
+@click.option(
+    "--num-orders",
+    default=1_000_000,
+    help="Number of synthetic orders",
+)
+@click.option(
+    "--num-categories",
+    default=70,
+    help="Number of product categories",
+)
+@click.option(
+    "--num-cities",
+    default=400,
+    help="Number of customer cities",
+)
+@click.option(
+    "--series-chunk-size",
+    default=2000,
+    help="Series whose features are built at once",
+)
+@click.option(
+    "--iterations",
+    default=50,
+    help="CatBoost iterations of the global model",
+)
+@click.option(
+    "--split-data",
+    default="2018-05-01",
+    help="Split date between train/test datasets",
+)
+def run_benchmark(
+    num_orders: int,
+    num_categories: int,
+    num_cities: int,
+    series_chunk_size: int,
+    iterations: int,
+    split_data: str,
+):
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_path = f"{tmp_dir}/raw/"
+        generate_raw_datasets(
+            raw_path, num_orders, num_categories, num_cities
+        )
+        store = get_dataset_store(f"{tmp_dir}/processed/", "parquet")
+        click.echo(
+            f"orders: {num_orders:,}, categories: {num_categories}, "
+            f"cities: {num_cities}"
+        )
+
+        def ingest():
+            (Path(tmp_dir) / "spool").mkdir()
+            national_df, final_df = ingest_raw_datasets(
+                raw_path,
+                Path(tmp_dir) / "spool",
+                store,
+                Brazil(),
+                chunksize=200_000,
+                num_partitions=16,
+                series_scope="all",
+            )
+            store.write(national_df, "national_orders_by_week")
+            store.write(final_df, "orders_by_week")
+
+        split_dfs = []
+        # (name, stage, rows processed by the stage)
+        stages = [
+            ("ingest", ingest, lambda: num_orders),
+            (
+                "features",
+                lambda: build_model_data(store, series_chunk_size),
+                lambda: len(store.read("model_data", columns=KEY_COL_LIST)),
+            ),
+            (
+                "split",
+                lambda: split_dfs.extend(split(store, split_data)),
+                lambda: len(split_dfs[0]) + len(split_dfs[2]),
+            ),
+            (
+                "train",
+                lambda: train_global_model(split_dfs, iterations),
+                lambda: len(split_dfs[0]),
+            ),
+        ]
+        for name, stage, count_rows in stages:
+            start = time.perf_counter()
+            stage()
+            seconds = time.perf_counter() - start
+            rows = count_rows()
+            click.echo(
+                f"{name}: {seconds:.2f}s for {rows:,} rows "
+                f"({rows / seconds:,.0f} rows/s), "
+                f"peak memory {peak_memory_mb():,.0f} MB"
+            )
+
+
+if __name__ == "__main__":
+    run_benchmark()
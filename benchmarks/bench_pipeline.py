@@ -0,0 +1,501 @@
+import io
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import pyarrow as pa
+import pyarrow.parquet as pq
+from catboost import CatBoostRegressor
+from workalendar.america import Brazil
+
+from benchmarks.synthetic_olist import generate_raw_datasets
+from scr.batch_prediction import (
+    ndjson_chunks,
+    open_record_batches,
+    predict_record_batches,
+)
+from scr.model_cache import feature_schema
+from scr.model_pipeline.catboost_optimization import (
+    TRIAL_DATA,
+    evaluate_trial,
+    load_trial_data,
+)
+from scr.model_pipeline.data_preparation import (
+    add_order_features,
+    aggregate_weekly,
+    join_orders,
+    read_raw_datasets,
+)
+from scr.model_pipeline.dataset_store import get_dataset_store
+from scr.model_pipeline.feature_engineering import (
+    KEY_COL_LIST,
+    build_model_data,
+)
+from scr.model_pipeline.streaming_ingestion import ingest_raw_datasets
+from scr.model_pipeline.temporal_target_and_split import (
+    COLUMNS_PER_READ,
+    add_target_and_split_by_product,
+)
+
+BASELINE_DIR = "./benchmarks/baselines"
+TRAIN_PARAMS = {"depth": 6, "min_data_in_leaf": 1, "random_state": 42}
+
+
+def reset_peak_memory():
+    """
+    Reset the peak resident memory of the process to its current resident
+    memory (Linux only), so that each stage gets its own peak
+    """
+
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def memory_status_mb(field):
+    """
+    VmRSS (resident) or VmHWM (peak resident) memory of the process, None
+    where /proc is missing
+    """
+
+    try:
+        with open("/proc/self/status", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def peak_memory_mb():
+    """
+    Peak resident memory since the last reset_peak_memory, or since the
+    start of the process where it can't be reset
+    """
+
+    peak = memory_status_mb("VmHWM")
+    if peak is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return peak
+
+
+def time_stage(stage, count_rows, *args):
+    """
+    Run stage(*args) and return its result with its time, throughput and
+    peak memory. The peak memory is counted from the resident memory at
+    the start of the stage, so the data left by the previous stages is
+    not part of it. count_rows gives the rows processed from the result
+    """
+
+    reset_peak_memory()
+    start_memory = memory_status_mb("VmRSS") or 0
+    start = time.perf_counter()
+    result = stage(*args)
+    seconds = time.perf_counter() - start
+    rows = count_rows(result)
+
+    return result, {
+        "seconds": round(seconds, 3),
+        "rows": rows,
+        "rows_per_second": round(rows / seconds),
+        "peak_memory_mb": round(peak_memory_mb() - start_memory, 1),
+    }
+
+
+def score_batch(model, x_val):
+    """
+    Scoring path of /predict-batch: Parquet body read by record batches,
+    native CatBoost predictions and NDJSON response
+    """
+
+    body = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(x_val, preserve_index=False), body)
+    body.seek(0)
+    schema = feature_schema(model)
+    batches = open_record_batches(body, "parquet", schema["feature_types"])
+
+    # one line per row
+    return sum(
+        chunk.count(b"\n")
+        for chunk in ndjson_chunks(
+            predict_record_batches(model, batches, schema["cat_features"])
+        )
+    )
+
+
+def train(source_path, split_data, iterations, artifact_dir):
+    """
+    Training path of catboost_optimization: its datasets loaded once and
+    one trial fitted with fixed params, without MLflow logging.
+    Returns the trained model
+    """
+
+    load_trial_data(source_path, "parquet", split_data)
+    result = evaluate_trial(
+        {**TRAIN_PARAMS, "iterations": iterations},
+        artifact_dir,
+        thread_count=os.cpu_count(),
+        early_stopping_rounds=10,
+        with_chart=False,
+    )
+
+    return CatBoostRegressor().load_model(result["model_path"])
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+# pylint: disable=too-many-locals
+def run_stages(
+    raw_path,
+    work_dir,
+    num_orders,
+    ingestion,
+    series_chunk_size,
+    iterations,
+    split_data,
+):
+    """
+    Time each stage of the pipeline on the raw datasets of raw_path, from
+    the ingestion to the scoring of the validation rows. The rows of the
+    ingestion are the orders, those of the other stages the weekly series
+    rows (or the order lines before the weekly aggregation)
+    """
+
+    store = get_dataset_store(f"{work_dir}/processed/", "parquet")
+    results = {}
+
+    def run(name, stage, count_rows, *args):
+        result, results[name] = time_stage(stage, count_rows, *args)
+        click.echo(
+            f"{name}: {results[name]['seconds']:.2f}s for "
+            f"{results[name]['rows']:,} rows "
+            f"({results[name]['rows_per_second']:,} rows/s), "
+            f"peak memory {results[name]['peak_memory_mb']:,.0f} MB"
+        )
+        return result
+
+    if ingestion == "streaming":
+        (Path(work_dir) / "spool").mkdir()
+        national_df, final_df = run(
+            "streaming_ingestion",
+            lambda: ingest_raw_datasets(
+                raw_path,
+                Path(work_dir) / "spool",
+                store,
+                Brazil(),
+                chunksize=200_000,
+                num_partitions=16,
+                series_scope="all",
+            ),
+            lambda _: num_orders,
+        )
+    else:
+        raw_dfs = run(
+            "read_raw_datasets",
+            read_raw_datasets,
+            lambda _: num_orders,
+            raw_path,
+        )
+        joined_df = run("join_orders", join_orders, len, *raw_dfs)
+        del raw_dfs
+        joined_df = run(
+            "add_order_features", add_order_features, len, joined_df, Brazil()
+        )
+        national_df, final_df = run(
+            "aggregate_weekly",
+            aggregate_weekly,
+            lambda _: len(joined_df),
+            joined_df,
+            "all",
+        )
+        del joined_df
+    store.write(national_df, "national_orders_by_week")
+    store.write(final_df, "orders_by_week")
+    del national_df, final_df
+
+    run(
+        "build_model_data",
+        build_model_data,
+        lambda _: len(store.read("model_data", columns=KEY_COL_LIST)),
+        store,
+        series_chunk_size,
+    )
+    run(
+        "temporal_target_and_split",
+        add_target_and_split_by_product.callback,
+        lambda _: len(store.read("model_data", columns=KEY_COL_LIST)),
+        f"{work_dir}/processed/",
+        "parquet",
+        "sales_amount_sum",
+        1,
+        None,
+        split_data,
+        COLUMNS_PER_READ,
+    )
+    (Path(work_dir) / "model").mkdir()
+    model = run(
+        "train",
+        train,
+        lambda _: len(TRIAL_DATA["x_train"]),
+        f"{work_dir}/processed/",
+        split_data,
+        iterations,
+        Path(work_dir) / "model",
+    )
+    x_val = TRIAL_DATA["x_val"]
+    TRIAL_DATA.clear()
+    run("score_batch", score_batch, lambda rows: rows, model, x_val)
+
+    return results
+
+
+def best_of(runs):
+    """
+    Fastest time and lowest peak memory of each stage over the runs, the
+    least disturbed by the other processes of the machine
+    """
+
+    stages = {}
+    for name, stats in runs[0].items():
+        seconds = min(stage_runs[name]["seconds"] for stage_runs in runs)
+        stages[name] = {
+            "seconds": seconds,
+            "rows": stats["rows"],
+            "rows_per_second": round(stats["rows"] / seconds),
+            "peak_memory_mb": min(
+                stage_runs[name]["peak_memory_mb"] for stage_runs in runs
+            ),
+        }
+
+    return stages
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+def compare_to_baseline(
+    stages,
+    baseline_stages,
+    time_tolerance,
+    memory_tolerance,
+    min_seconds,
+    min_megabytes,
+):
+    """
+    Regressions of the stages against the baseline: slower by more than
+    time_tolerance (and min_seconds) or with a peak memory higher by more
+    than memory_tolerance (and min_megabytes)
+    """
+
+    regressions = []
+    for name, stats in stages.items():
+        baseline = baseline_stages.get(name)
+        if baseline is None:
+            continue
+        if (
+            stats["seconds"] > baseline["seconds"] * (1 + time_tolerance)
+            and stats["seconds"] - baseline["seconds"] > min_seconds
+        ):
+            regressions.append(
+                f"{name}: {stats['seconds']:.2f}s, baseline "
+                f"{baseline['seconds']:.2f}s"
+            )
+        if (
+            stats["peak_memory_mb"]
+            > baseline["peak_memory_mb"] * (1 + memory_tolerance)
+            and stats["peak_memory_mb"] - baseline["peak_memory_mb"]
+            > min_megabytes
+        ):
+            regressions.append(
+                f"{name}: peak memory {stats['peak_memory_mb']:,.0f} MB, "
+                f"baseline {baseline['peak_memory_mb']:,.0f} MB"
+            )
+
+    return regressions
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+# pylint: disable=too-many-locals
+@click.command()
+@click.option(
+    "--num-orders",
+    default=100_000,
+    help="Number of synthetic orders (10k to 50M)",
+)
+@click.option(
+    "--num-categories",
+    default=70,
+    help="Number of product categories",
+)
+@click.option(
+    "--num-cities",
+    default=50,
+    help="Number of customer cities",
+)
+@click.option(
+    "--ingestion",
+    default="batch",
+    type=click.Choice(["batch", "streaming"]),
+    help="In-memory data preparation or chunked streaming ingestion",
+)
+@click.option(
+    "--series-chunk-size",
+    default=2000,
+    help="Series whose features are built at once",
+)
+@click.option(
+    "--iterations",
+    default=50,
+    help="CatBoost iterations of the trained model",
+)
+@click.option(
+    "--split-data",
+    default="2018-05-01",
+    help="Split date between train/test datasets",
+)
+@click.option(
+    "--repeat",
+    default=3,
+    help="Runs of the stages, the best one of each stage is kept",
+)
+@click.option(
+    "--baseline-dir",
+    default=BASELINE_DIR,
+    help="Location of the baseline of each benchmark configuration",
+)
+@click.option(
+    "--save-baseline",
+    is_flag=True,
+    help="Save the results as the baseline instead of comparing them",
+)
+@click.option(
+    "--time-tolerance",
+    default=0.25,
+    help="Allowed relative slowdown of a stage against the baseline",
+)
+@click.option(
+    "--memory-tolerance",
+    default=0.2,
+    help="Allowed relative increase of the peak memory of a stage",
+)
+@click.option(
+    "--min-seconds",
+    default=0.25,
+    help="Slowdowns below this many seconds are taken as noise",
+)
+@click.option(
+    "--min-megabytes",
+    default=32.0,
+    help="Peak memory increases below this many MB are taken as noise",
+)
+@click.option(
+    "--output",
+    default="./reports/benchmark_pipeline.json",
+    help="Location where the results are written",
+)
+def run_benchmark(
+    num_orders: int,
+    num_categories: int,
+    num_cities: int,
+    ingestion: str,
+    series_chunk_size: int,
+    iterations: int,
+    split_data: str,
+    repeat: int,
+    baseline_dir: str,
+    save_baseline: bool,
+    time_tolerance: float,
+    memory_tolerance: float,
+    min_seconds: float,
+    min_megabytes: float,
+    output: str,
+):
+
+    params = {
+        "num_orders": num_orders,
+        "num_categories": num_categories,
+        "num_cities": num_cities,
+        "ingestion": ingestion,
+        "series_chunk_size": series_chunk_size,
+        "iterations": iterations,
+        "split_data": split_data,
+        "repeat": repeat,
+    }
+    click.echo(
+        f"orders: {num_orders:,}, categories: {num_categories}, "
+        f"cities: {num_cities}, ingestion: {ingestion}"
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_path = f"{tmp_dir}/raw/"
+        generate_raw_datasets(
+            raw_path, num_orders, num_categories, num_cities
+        )
+        runs = []
+        for number in range(repeat):
+            click.echo(f"run {number + 1}/{repeat}")
+            work_dir = Path(tmp_dir) / "work"
+            work_dir.mkdir()
+            runs.append(
+                run_stages(
+                    raw_path,
+                    work_dir,
+                    num_orders,
+                    ingestion,
+                    series_chunk_size,
+                    iterations,
+                    split_data,
+                )
+            )
+            shutil.rmtree(work_dir)
+        stages = best_of(runs)
+
+    results = {"params": params, "stages": stages}
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(results, file, indent=2)
+
+    baseline_path = Path(baseline_dir) / (
+        f"pipeline_{num_orders}_{num_categories}x{num_cities}_"
+        f"{ingestion}.json"
+    )
+    if save_baseline:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(baseline_path, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+            file.write("\n")
+        click.echo(f"Baseline saved in {baseline_path}")
+        return
+    if not baseline_path.exists():
+        click.echo(f"No baseline in {baseline_path}, nothing compared")
+        return
+
+    with open(baseline_path, encoding="utf-8") as file:
+        baseline = json.load(file)
+    if baseline["params"] != params:
+        raise click.UsageError(
+            f"{baseline_path} was measured with {baseline['params']}"
+        )
+    regressions = compare_to_baseline(
+        stages,
+        baseline["stages"],
+        time_tolerance,
+        memory_tolerance,
+        min_seconds,
+        min_megabytes,
+    )
+    if regressions:
+        raise click.ClickException(
+            "Regressions against the baseline:\n" + "\n".join(regressions)
+        )
+    click.echo(f"No regression against {baseline_path}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
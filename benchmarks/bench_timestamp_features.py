@@ -0,0 +1,88 @@
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+from scr.model_pipeline.data_preparation import add_timestamp_features
+
+
+def make_orders(num_rows, seed=42):
+    rng = np.random.default_rng(seed)
+    seconds = rng.integers(0, 640 * 24 * 3600, num_rows)
+    timestamp = pd.Timestamp("2016-12-01") + pd.to_timedelta(
+        seconds, unit="s"
+    )
+
+    return pd.DataFrame(
+        {"order_purchase_timestamp": timestamp.strftime("%Y-%m-%d %H:%M:%S")}
+    )
+
+
+def legacy_timestamp_features(df):
+    """
+    Per-row implementation previously used in data_preparation.py
+    """
+
+    df["order_purchase_timestamp"] = pd.to_datetime(
+        df["order_purchase_timestamp"]
+    )
+    df["order_purchase_date"] = [
+        pd.to_datetime(day) - pd.Timedelta(days=day.weekday())
+        for day in df["order_purchase_timestamp"].dt.normalize()
+    ]
+    df["order_purchase_original_date"] = pd.to_datetime(
+        df["order_purchase_timestamp"]
+    ).dt.normalize()
+    df["order_purchase_month"] = pd.to_datetime(
+        pd.to_datetime(df["order_purchase_timestamp"]).dt.strftime("%Y-%m-01")
+    )
+    df["daytime_in_minutes"] = (
+        pd.to_datetime(df["order_purchase_timestamp"]).dt.hour * 60
+        + pd.to_datetime(df["order_purchase_timestamp"]).dt.minute
+    )
+
+    return df
+
+
+def time_it(func, df):
+    start = time.perf_counter()
+    func(df)
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option(
+    "--num-rows",
+    default=10_000_000,
+    help="Number of synthetic orders",
+)
+@click.option(
+    "--legacy-rows",
+    default=100_000,
+    help="Rows timed with the per-row implementation (extrapolated)",
+)
+def run_benchmark(num_rows: int, legacy_rows: int):
+
+    orders_df = make_orders(num_rows)
+    vectorized = time_it(
+        lambda df: add_timestamp_features(df, "order_purchase_timestamp"),
+        orders_df.copy(),
+    )
+    legacy = (
+        time_it(legacy_timestamp_features, orders_df[:legacy_rows].copy())
+        * num_rows
+        / legacy_rows
+    )
+
+    click.echo(f"rows: {num_rows:,}")
+    click.echo(
+        f"add_timestamp_features: {vectorized:.2f}s "
+        f"({num_rows / vectorized:,.0f} rows/s)"
+    )
+    click.echo(f"legacy (extrapolated): {legacy:.2f}s")
+    click.echo(f"speedup: {legacy / vectorized:.1f}x")
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,264 @@
+import subprocess
+import sys
+from contextlib import ExitStack
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+STATES = ["SP", "RJ", "MG", "RS", "PR", "SC", "BA", "DF", "GO", "ES"]
+ORDER_STATUSES = ["delivered", "shipped", "canceled", "unavailable"]
+FIRST_TIMESTAMP = pd.Timestamp("2016-12-01")
+NUM_DAYS = 640
+
+
+def zipf_choice(rng, num_values, size, exponent=1.1):
+    """
+    Indexes in [0, num_values) with a Zipf-like popularity, as the orders
+    by category and by city of the Olist data
+    """
+
+    weights = 1 / np.arange(1, num_values + 1) ** exponent
+    return rng.choice(num_values, size=size, p=weights / weights.sum())
+
+
+def prefixed_ids(prefix, first, count, width):
+    """
+    String ids like "o000000042", built without a Python loop
+    """
+
+    return np.char.add(
+        prefix,
+        np.char.zfill(np.arange(first, first + count).astype(str), width),
+    ).astype(object)
+
+
+def make_products(rng, num_categories):
+    num_products = num_categories * 30
+    category = zipf_choice(rng, num_categories, num_products)
+
+    return pd.DataFrame(
+        {
+            "product_id": prefixed_ids("p", 0, num_products, 6),
+            "product_category_name": prefixed_ids(
+                "category_", 0, num_categories, 3
+            )[category],
+            "product_weight_g": rng.integers(50, 10_000, num_products),
+        }
+    )
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+# pylint: disable=too-many-locals
+def make_order_chunk(
+    rng, first_order, num_orders, total_orders, num_cities, product_ids
+):
+    """
+    Orders, items and customers of the orders first_order to
+    first_order + num_orders, one customer per order
+    """
+
+    order_ids = prefixed_ids("o", first_order, num_orders, 9)
+    customer_ids = prefixed_ids("c", first_order, num_orders, 9)
+
+    city = zipf_choice(rng, num_cities, num_orders)
+    customers_df = pd.DataFrame(
+        {
+            "customer_id": customer_ids,
+            "customer_unique_id": rng.integers(
+                0, total_orders // 2 + 1, num_orders
+            ),
+            "customer_zip_code_prefix": 1000 + city,
+            "customer_city": np.char.add(
+                "city ", np.char.zfill(np.arange(num_cities).astype(str), 4)
+            ).astype(object)[city],
+            "customer_state": np.array(STATES, dtype=object)[
+                city % len(STATES)
+            ],
+        }
+    )
+
+    seconds = rng.integers(0, NUM_DAYS * 24 * 3600, num_orders)
+    orders_df = pd.DataFrame(
+        {
+            "order_id": order_ids,
+            "customer_id": customer_ids,
+            "order_status": rng.choice(
+                ORDER_STATUSES, num_orders, p=[0.9, 0.04, 0.03, 0.03]
+            ),
+            # written as "%Y-%m-%d %H:%M:%S" by the CSV writer
+            "order_purchase_timestamp": (
+                FIRST_TIMESTAMP + pd.to_timedelta(seconds, unit="s")
+            ).astype("datetime64[s]"),
+        }
+    )
+
+    items_per_order = rng.integers(1, 4, num_orders)
+    num_items = items_per_order.sum()
+    order_items_df = pd.DataFrame(
+        {
+            "order_id": np.repeat(order_ids, items_per_order),
+            "order_item_id": np.arange(1, num_items + 1)
+            - np.repeat(
+                np.cumsum(items_per_order) - items_per_order, items_per_order
+            ),
+            "product_id": product_ids[
+                rng.integers(0, len(product_ids), num_items)
+            ],
+            "price": rng.lognormal(4, 0.8, num_items).round(2),
+            "freight_value": rng.lognormal(2.8, 0.5, num_items).round(2),
+        }
+    )
+
+    return orders_df, order_items_df, customers_df
+
+
+def iter_olist_chunks(
+    num_orders,
+    num_categories=70,
+    num_cities=4000,
+    seed=42,
+    chunk_orders=1_000_000,
+):
+    """
+    Products table, then the (orders, items, customers) tables of each
+    chunk of chunk_orders orders: memory depends on the chunk size, not on
+    num_orders
+    """
+
+    rng = np.random.default_rng(seed)
+    products_df = make_products(rng, num_categories)
+    yield products_df
+
+    product_ids = products_df["product_id"].to_numpy()
+    for first_order in range(0, num_orders, chunk_orders):
+        yield make_order_chunk(
+            rng,
+            first_order,
+            min(chunk_orders, num_orders - first_order),
+            num_orders,
+            num_cities,
+            product_ids,
+        )
+
+
+def make_olist_datasets(
+    num_orders, num_categories=70, num_cities=4000, seed=42
+):
+    """
+    Orders, items, products and customers tables with the columns of the
+    Olist raw datasets. Returns them in the order of read_raw_datasets
+    """
+
+    products_df, *chunks = iter_olist_chunks(
+        num_orders, num_categories, num_cities, seed
+    )
+    orders_df, order_items_df, customers_df = (
+        pd.concat(dfs, ignore_index=True) for dfs in zip(*chunks)
+    )
+
+    return orders_df, order_items_df, products_df, customers_df
+
+
+def write_olist_datasets(raw_chunks, raw_path):
+    """
+    Write the products table and the chunks of iter_olist_chunks with the
+    file names expected by read_raw_datasets, one chunk at a time
+    """
+
+    raw_path = Path(raw_path)
+    raw_path.mkdir(parents=True, exist_ok=True)
+    raw_chunks = iter(raw_chunks)
+    pa_csv.write_csv(
+        pa.Table.from_pandas(next(raw_chunks), preserve_index=False),
+        raw_path / "olist_products_dataset.csv",
+    )
+    with ExitStack() as stack:
+        writers = None
+        for chunk in raw_chunks:
+            tables = [
+                pa.Table.from_pandas(df, preserve_index=False) for df in chunk
+            ]
+            if writers is None:
+                writers = [
+                    stack.enter_context(
+                        pa_csv.CSVWriter(
+                            raw_path / f"olist_{name}_dataset.csv",
+                            table.schema,
+                        )
+                    )
+                    for table, name in zip(
+                        tables, ["orders", "order_items", "customers"]
+                    )
+                ]
+            for writer, table in zip(writers, tables):
+                writer.write_table(table)
+
+
+def generate_raw_datasets(raw_path, num_orders, num_categories, num_cities):
+    """
+    Write the synthetic raw datasets from another process, so that their
+    generation is out of the peak memory of the benchmark process
+    """
+
+    subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.synthetic_olist",
+            f"--num-orders={num_orders}",
+            f"--num-categories={num_categories}",
+            f"--num-cities={num_cities}",
+            f"--raw-path={raw_path}",
+        ],
+        check=True,
+    )
+
+
+@click.command()
+@click.option(
+    "--num-orders",
+    default=1_000_000,
+    help="Number of synthetic orders",
+)
+@click.option(
+    "--num-categories",
+    default=70,
+    help="Number of product categories",
+)
+@click.option(
+    "--num-cities",
+    default=4000,
+    help="Number of customer cities",
+)
+@click.option(
+    "--chunk-orders",
+    default=1_000_000,
+    help="Orders generated and written at once",
+)
+@click.option(
+    "--raw-path",
+    default="./data/synthetic/raw/",
+    help="Location where the raw datasets are written",
+)
+def run_generator(
+    num_orders: int,
+    num_categories: int,
+    num_cities: int,
+    chunk_orders: int,
+    raw_path: str,
+):
+
+    write_olist_datasets(
+        iter_olist_chunks(
+            num_orders, num_categories, num_cities, chunk_orders=chunk_orders
+        ),
+        raw_path,
+    )
+
+
+if __name__ == "__main__":
+    run_generator()
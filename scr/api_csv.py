@@ -1,52 +1,285 @@
-from io import BytesIO
-from typing import Optional
-
-import pandas as pd
-from fastapi import FastAPI, HTTPException, UploadFile
-
-import mlflow
-
-mlflow.set_tracking_uri("http://mlflow:5000")
-client = mlflow.MlflowClient()
-print("aqui")
-
-app = FastAPI()
-
-# # Load current and reference data
-# current_data = pd.read_csv("./data/processed/x_val.csv").drop(
-#     "order_purchase_date", axis=1
-# )
-# features = current_data.columns
-
-# # Load model
-# model = CatBoost()
-# model.load_model("final_model/model/model.cb")
-# model.set_feature_names(features)
-
-# Load model
-model = mlflow.pyfunc.load_model("models:/ecommerce_forecast/1")
-print("ou aqui?")
-
-
-@app.post("/predict-csv")
-async def predict_csv(file: Optional[UploadFile] = None):
-    if file is None:
-        raise HTTPException(status_code=400, detail="No file uploaded")
-
-    if not file.filename.endswith(".csv"):
-        raise HTTPException(
-            status_code=400, detail="Only CSV files are accepted"
-        )
-
-    try:
-        contents = await file.read()
-        df = pd.read_csv(BytesIO(contents)).drop(
-            "order_purchase_date", axis=1
-        )
-        predictions = model.predict(df)
-        return {"predictions": predictions.tolist()}
-
-    except Exception as e:
-        raise HTTPException(
-            status_code=400, detail=f"Processing Error: {str(e)}"
-        ) from e
+import os
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from datetime import date
+from io import BytesIO
+from pathlib import Path
+from typing import List, Literal, Optional
+
+import numpy as np
+import pandas as pd
+from fastapi import FastAPI, HTTPException, Request, UploadFile
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
+
+from scr.batch_prediction import (
+    INPUT_FORMATS,
+    OUTPUT_ENCODERS,
+    OUTPUT_MEDIA_TYPES,
+    SPOOL_MAX_BYTES,
+    open_record_batches,
+    predict_record_batches,
+)
+from scr.forecast_cache import ForecastCache
+from scr.instrumentation import (
+    instrument_app,
+    record_prediction,
+    timed_predictions,
+)
+from scr.micro_batching import MicroBatcher
+from scr.model_cache import ModelCache
+from scr.model_pipeline.feature_store import FeatureStore, week_numbers
+
+os.environ.setdefault("MLFLOW_TRACKING_URI", "http://mlflow:5000")
+FEATURE_STORE_DIR = os.getenv(
+    "FEATURE_STORE_DIR", "./data/processed/feature_store"
+)
+
+# Load the Production model from the local model cache (the registry only
+# when the cache is empty), then follow new versions in the background
+model_cache = ModelCache()
+model_cache.load(required=True)
+
+# Memory-mapped features of every series and week, for /forecast
+feature_store = (
+    FeatureStore(FEATURE_STORE_DIR)
+    if (Path(FEATURE_STORE_DIR) / "manifest.json").exists()
+    else None
+)
+
+# Forecasts already computed by the served model version, by series key
+# and week for /forecast and by feature row hash for /predict-csv
+forecast_cache = ForecastCache()
+
+
+class SeriesKey(BaseModel):
+    product_category_name: str
+    customer_city: str
+    order_purchase_date: date
+
+
+class ForecastRequest(BaseModel):
+    keys: List[SeriesKey]
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    model_cache.start_refresh()
+    await forecast_batcher.start()
+    yield
+    await forecast_batcher.stop()
+    model_cache.stop_refresh()
+
+
+app = FastAPI(lifespan=lifespan)
+instrument_app(app, "api_csv")
+
+
+def predict_rows(model, model_version, features):
+    """
+    Predictions of the feature rows: the rows this model version already
+    predicted come from the forecast cache, only the others are predicted
+    """
+
+    row_keys = pd.util.hash_pandas_object(features, index=False).tolist()
+    predictions = forecast_cache.get_many(model_version, row_keys)
+    missing = [i for i, value in enumerate(predictions) if value is None]
+    if missing:
+        start = time.perf_counter()
+        new_predictions = model.predict(features.iloc[missing]).tolist()
+        record_prediction(
+            "api_csv",
+            "/predict-csv",
+            len(missing),
+            time.perf_counter() - start,
+        )
+        forecast_cache.put_many(
+            model_version, [row_keys[i] for i in missing], new_predictions
+        )
+        for i, value in zip(missing, new_predictions):
+            predictions[i] = value
+
+    return predictions
+
+
+@app.post("/predict-csv")
+async def predict_csv(file: Optional[UploadFile] = None):
+    if file is None:
+        raise HTTPException(status_code=400, detail="No file uploaded")
+
+    if not file.filename.endswith(".csv"):
+        raise HTTPException(
+            status_code=400, detail="Only CSV files are accepted"
+        )
+
+    # the same model for the whole request, even if a new one is swapped in
+    model, schema, model_version = model_cache.current
+    try:
+        contents = await file.read()
+        # parsed and predicted in a worker thread, off the event loop
+        df = await run_in_threadpool(pd.read_csv, BytesIO(contents))
+        predictions = await run_in_threadpool(
+            predict_rows, model, model_version, df[schema["feature_names"]]
+        )
+        return {
+            "model_version": model_version,
+            "predictions": predictions,
+        }
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=400, detail=f"Processing Error: {str(e)}"
+        ) from e
+
+
+@app.post("/predict-batch")
+async def predict_batch(
+    request: Request, output: Literal["ndjson", "arrow"] = "ndjson"
+):
+    content_type = request.headers.get("content-type", "").split(";")[0]
+    input_format = INPUT_FORMATS.get(content_type.strip())
+    if input_format is None:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Send the rows as one of {list(INPUT_FORMATS)}",
+        )
+
+    # the body is spooled to disk above SPOOL_MAX_BYTES: Parquet and Arrow
+    # files are read by random access
+    spool = (
+        tempfile.SpooledTemporaryFile(  # pylint: disable=consider-using-with
+            max_size=SPOOL_MAX_BYTES
+        )
+    )
+    async for chunk in request.stream():
+        spool.write(chunk)
+    spool.seek(0)
+
+    model, schema, model_version = model_cache.current
+    try:
+        batches = open_record_batches(
+            spool, input_format, schema["feature_types"]
+        )
+    except ValueError as e:
+        spool.close()
+        raise HTTPException(status_code=400, detail=str(e)) from e
+
+    def content():
+        with spool:
+            yield from OUTPUT_ENCODERS[output](
+                timed_predictions(
+                    predict_record_batches(
+                        model, batches, schema["cat_features"]
+                    ),
+                    "api_csv",
+                    "/predict-batch",
+                )
+            )
+
+    return StreamingResponse(
+        content(),
+        media_type=OUTPUT_MEDIA_TYPES[output],
+        headers={"X-Model-Version": model_version},
+    )
+
+
+def forecast_cache_keys(keys):
+    """
+    Forecast cache key of each (category, city, date) key: every date of a
+    week has the same forecast
+    """
+
+    weeks = week_numbers([key[2] for key in keys]).tolist()
+    return [(key[0], key[1], week) for key, week in zip(keys, weeks)]
+
+
+def forecast_keys(keys):
+    """
+    (forecast, model version) of each (category, city, date) key: the
+    forecast of the week after the week of the key, from the stored
+    features of the series at that week, None for unknown keys
+    """
+
+    model, schema, model_version = model_cache.current
+    categories = np.array([key[0] for key in keys], dtype=object)
+    cities = np.array([key[1] for key in keys], dtype=object)
+    rows = feature_store.find_rows(
+        categories, cities, [key[2] for key in keys]
+    )
+    is_found = rows >= 0
+
+    forecasts = np.full(len(rows), np.nan)
+    if is_found.any():
+        start = time.perf_counter()
+        forecasts[is_found] = model.predict(
+            feature_store.model_input(
+                rows[is_found],
+                categories[is_found],
+                cities[is_found],
+                schema["feature_names"],
+            )
+        )
+        record_prediction(
+            "api_csv",
+            "/forecast",
+            int(is_found.sum()),
+            time.perf_counter() - start,
+        )
+
+    found_rows = is_found.nonzero()[0].tolist()
+    cache_keys = forecast_cache_keys([keys[i] for i in found_rows])
+    forecast_cache.put_many(
+        model_version, cache_keys, forecasts[found_rows].tolist()
+    )
+
+    return [
+        (value if found else None, model_version)
+        for value, found in zip(forecasts.tolist(), is_found.tolist())
+    ]
+
+
+# The keys of concurrent /forecast requests are predicted together
+forecast_batcher = MicroBatcher(forecast_keys)
+
+
+@app.post("/forecast")
+async def forecast(request: ForecastRequest):
+    if feature_store is None:
+        raise HTTPException(
+            status_code=503,
+            detail=f"No feature store in {FEATURE_STORE_DIR}",
+        )
+
+    keys = [
+        (
+            key.product_category_name,
+            key.customer_city,
+            key.order_purchase_date,
+        )
+        for key in request.keys
+    ]
+    # only the keys missing from the cache wait for a batch
+    model_version = model_cache.current[2]
+    forecasts = forecast_cache.get_many(
+        model_version, forecast_cache_keys(keys)
+    )
+    missing = [i for i, value in enumerate(forecasts) if value is None]
+    if missing:
+        results = await forecast_batcher.submit([keys[i] for i in missing])
+        for i, (value, model_version) in zip(missing, results):
+            forecasts[i] = value
+
+    return {
+        "model_version": model_version,
+        "forecasts": [
+            {**key.model_dump(), "forecast": value}
+            for key, value in zip(request.keys, forecasts)
+        ],
+    }
+
+
+@app.get("/cache-stats")
+async def cache_stats():
+    return forecast_cache.stats()
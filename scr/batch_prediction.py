@@ -0,0 +1,139 @@
+import io
+import os
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from catboost import Pool
+
+BATCH_ROWS = int(os.getenv("BATCH_PREDICT_ROWS", "65536"))
+SPOOL_MAX_BYTES = int(os.getenv("BATCH_SPOOL_MAX_BYTES", str(64 * 2**20)))
+
+# content type of the request body -> input format
+INPUT_FORMATS = {
+    "text/csv": "csv",
+    "application/vnd.apache.parquet": "parquet",
+    "application/x-parquet": "parquet",
+    "application/vnd.apache.arrow.file": "arrow",
+    "application/vnd.apache.arrow.stream": "arrow_stream",
+}
+OUTPUT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+PREDICTION_SCHEMA = pa.schema([("prediction", pa.float64())])
+
+
+def csv_column_types(feature_types):
+    """
+    Arrow types of the CSV columns, so every block is parsed the same way
+    instead of re-inferring types block by block
+    """
+
+    return {
+        feature: pa.string() if input_type == "text" else pa.float64()
+        for feature, input_type in feature_types.items()
+    }
+
+
+def open_record_batches(
+    source, input_format, feature_types, batch_rows=BATCH_ROWS
+):
+    """
+    Read the feature columns of a seekable CSV, Parquet or Arrow IPC file
+    by record batches of at most batch_rows rows. The schema is checked
+    before the first batch: raises ValueError if the format is unknown or
+    features are missing
+    """
+
+    feature_names = list(feature_types)
+    try:
+        if input_format == "csv":
+            reader = pa_csv.open_csv(
+                source,
+                read_options=pa_csv.ReadOptions(block_size=16 * 2**20),
+                convert_options=pa_csv.ConvertOptions(
+                    column_types=csv_column_types(feature_types),
+                    include_columns=feature_names,
+                ),
+            )
+            schema, batches = reader.schema, reader
+        elif input_format == "parquet":
+            parquet_file = pq.ParquetFile(source)
+            schema = parquet_file.schema_arrow
+            batches = parquet_file.iter_batches(
+                batch_rows, columns=feature_names
+            )
+        elif input_format == "arrow":
+            reader = pa.ipc.open_file(source)
+            schema = reader.schema
+            batches = (
+                reader.get_batch(i) for i in range(reader.num_record_batches)
+            )
+        elif input_format == "arrow_stream":
+            reader = pa.ipc.open_stream(source)
+            schema, batches = reader.schema, reader
+        else:
+            raise ValueError(f"Unknown input format: {input_format}")
+    except pa.ArrowException as e:
+        raise ValueError(f"Invalid {input_format} file: {e}") from e
+
+    missing = [col for col in feature_names if col not in schema.names]
+    if missing:
+        raise ValueError(f"Missing features: {missing}")
+
+    return (
+        batch.select(feature_names).slice(offset, batch_rows)
+        for batch in batches
+        for offset in range(0, batch.num_rows, batch_rows)
+    )
+
+
+def predict_record_batches(model, batches, cat_features, thread_count=-1):
+    """
+    Native CatBoost predictions of each record batch, with the
+    categorical feature indexes of the model schema
+    """
+
+    for batch in batches:
+        yield model.predict(
+            Pool(batch.to_pandas(), cat_features=cat_features),
+            thread_count=thread_count,
+        )
+
+
+def ndjson_chunks(prediction_chunks):
+    """
+    One {"prediction": value} line per row
+    """
+
+    for predictions in prediction_chunks:
+        yield "".join(
+            f'{{"prediction": {value}}}\n' for value in predictions.tolist()
+        ).encode()
+
+
+def arrow_stream_chunks(prediction_chunks):
+    """
+    An Arrow IPC stream of the predictions, one record batch per chunk.
+    The bytes written for each batch are yielded as soon as it is written
+    """
+
+    sink = io.BytesIO()
+
+    def written_bytes():
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    with pa.ipc.new_stream(sink, PREDICTION_SCHEMA) as writer:
+        for predictions in prediction_chunks:
+            writer.write_batch(
+                pa.record_batch([predictions], schema=PREDICTION_SCHEMA)
+            )
+            yield written_bytes()
+    yield written_bytes()
+
+
+OUTPUT_ENCODERS = {"ndjson": ndjson_chunks, "arrow": arrow_stream_chunks}
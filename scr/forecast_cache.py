@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_MAX_SIZE = int(os.getenv("FORECAST_CACHE_MAX_SIZE", "100000"))
+CACHE_TTL_SECONDS = float(os.getenv("FORECAST_CACHE_TTL_SECONDS", "3600"))
+
+
+class ForecastCache:
+    """
+    Bounded LRU cache of forecasts with a time to live. Entries belong to
+    the model version that computed them: a lookup with another version
+    empties the cache, so a new Production model never serves the
+    forecasts of the previous one
+    """
+
+    def __init__(
+        self,
+        max_size=CACHE_MAX_SIZE,
+        ttl_seconds=CACHE_TTL_SECONDS,
+        clock=time.monotonic,
+    ):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.version = None
+        self.counts = {"hits": 0, "misses": 0, "evictions": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, version, keys):
+        """
+        Cached forecast of each key, None for the missing or expired ones
+        """
+
+        now = self.clock()
+        values = []
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.version = version
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] <= now:
+                    del self._entries[key]
+                    entry = None
+                if entry is None:
+                    self.counts["misses"] += 1
+                    values.append(None)
+                else:
+                    self._entries.move_to_end(key)
+                    self.counts["hits"] += 1
+                    values.append(entry[0])
+
+        return values
+
+    def put_many(self, version, keys, values):
+        """
+        Store forecasts computed by `version`, unless the cache already
+        moved to another version. The least recently used entries are
+        evicted above max_size
+        """
+
+        expires_at = self.clock() + self.ttl_seconds
+        with self._lock:
+            if version != self.version:
+                return
+            for key, value in zip(keys, values):
+                self._entries[key] = (value, expires_at)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.counts["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counts["hits"] + self.counts["misses"]
+            return {
+                "model_version": self.version,
+                "size": len(self._entries),
+                **self.counts,
+                "hit_ratio": self.counts["hits"] / lookups if lookups else 0,
+            }
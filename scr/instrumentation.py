@@ -0,0 +1,220 @@
+import logging
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    push_to_gateway,
+)
+
+from scr.profiling import profile_stage
+
+logging.basicConfig(
+    level=logging.INFO,
+    filename="app.log",
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+# host:port of the Pushgateway the pipeline stages push their metrics to
+PUSHGATEWAY = os.getenv("PROMETHEUS_PUSHGATEWAY")
+
+# Offline pipeline stages: short-lived processes, so their metrics are
+# kept apart and pushed at the end of the stage
+PIPELINE_REGISTRY = CollectorRegistry()
+STAGE_DURATION = Gauge(
+    "pipeline_stage_duration_seconds",
+    "Wall time of the last run of the stage",
+    ["stage"],
+    registry=PIPELINE_REGISTRY,
+)
+STAGE_PEAK_MEMORY = Gauge(
+    "pipeline_stage_peak_memory_bytes",
+    "Peak resident memory of the last run of the stage and its workers",
+    ["stage"],
+    registry=PIPELINE_REGISTRY,
+)
+STAGE_ROWS = Gauge(
+    "pipeline_stage_rows",
+    "Rows read or written by the last run of the stage, by dataset",
+    ["stage", "dataset", "operation"],
+    registry=PIPELINE_REGISTRY,
+)
+STAGE_LAST_SUCCESS = Gauge(
+    "pipeline_stage_last_success_timestamp_seconds",
+    "End time of the last successful run of the stage",
+    ["stage"],
+    registry=PIPELINE_REGISTRY,
+)
+CURRENT_STAGE = {"name": None}
+
+# Inference APIs, served on /metrics by instrument_app
+REQUEST_LATENCY = Histogram(
+    "api_request_duration_seconds",
+    "Time to the response headers of the API requests",
+    ["app", "endpoint", "method", "status"],
+)
+BATCH_SIZE = Histogram(
+    "api_batch_size_rows",
+    "Rows of each model prediction call",
+    ["app", "endpoint"],
+    buckets=[2**power for power in range(0, 19, 2)],
+)
+PREDICT_DURATION = Histogram(
+    "api_predict_duration_seconds",
+    "Time of each model prediction call",
+    ["app", "endpoint"],
+)
+PREDICTED_ROWS = Counter(
+    "api_predicted_rows",
+    "Rows predicted by the model (rate() gives the rows per second)",
+    ["app", "endpoint"],
+)
+MODEL_LOAD_DURATION = Histogram(
+    "model_load_duration_seconds",
+    "Time to load a model version, from the local cache or the registry",
+    ["source"],
+)
+MODEL_VERSION = Gauge(
+    "model_version_info",
+    "Model version in use (1 for the served version)",
+    ["model_name", "version"],
+)
+
+# Drift monitor service
+DATASET_DRIFT = Gauge("evidently_dataset_drift", "Status de Drift (0 ou 1)")
+DRIFT_SHARE = Gauge(
+    "evidently_drift_share", "Percentual de Features com Drift"
+)
+CURRENT_MAE = Gauge(
+    "monitor_current_mae", "MAE of the scored rows with a target"
+)
+
+
+def peak_memory_bytes():
+    """
+    Peak resident memory of this process or of its largest finished
+    child process (ru_maxrss is in kilobytes on Linux)
+    """
+
+    return 1024 * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+@contextmanager
+def track_stage(stage):
+    """
+    Time a pipeline stage and record its peak memory and the rows of the
+    datasets it reads and writes. Works as a decorator too. The metrics
+    are pushed when PROMETHEUS_PUSHGATEWAY is set, and logged. With
+    PIPELINE_PROFILE set the stage is profiled too
+    """
+
+    CURRENT_STAGE["name"] = stage
+    start = time.perf_counter()
+    try:
+        with profile_stage(stage):
+            yield
+        STAGE_LAST_SUCCESS.labels(stage).set_to_current_time()
+    finally:
+        CURRENT_STAGE["name"] = None
+        duration = time.perf_counter() - start
+        STAGE_DURATION.labels(stage).set(duration)
+        STAGE_PEAK_MEMORY.labels(stage).set(peak_memory_bytes())
+        logging.info(
+            "Stage %s took %.1fs, peak memory %.0fMB",
+            stage,
+            duration,
+            peak_memory_bytes() / 2**20,
+        )
+        if PUSHGATEWAY:
+            try:
+                push_to_gateway(
+                    PUSHGATEWAY,
+                    job="ecommerce_pipeline",
+                    grouping_key={"stage": stage},
+                    registry=PIPELINE_REGISTRY,
+                )
+            # the metrics must not fail the stage
+            except OSError:
+                logging.exception("Metrics of %s not pushed", stage)
+
+
+def record_rows(dataset, operation, rows):
+    """
+    Rows read or written in a dataset by the running stage, if any
+    """
+
+    if CURRENT_STAGE["name"] is not None:
+        STAGE_ROWS.labels(CURRENT_STAGE["name"], dataset, operation).inc(rows)
+
+
+def record_prediction(app, endpoint, rows, seconds):
+    BATCH_SIZE.labels(app, endpoint).observe(rows)
+    PREDICT_DURATION.labels(app, endpoint).observe(seconds)
+    PREDICTED_ROWS.labels(app, endpoint).inc(rows)
+
+
+def timed_predictions(prediction_chunks, app, endpoint):
+    """
+    Record each chunk of a generator of predictions as it is produced
+    """
+
+    chunks = iter(prediction_chunks)
+    while True:
+        start = time.perf_counter()
+        try:
+            predictions = next(chunks)
+        except StopIteration:
+            return
+        record_prediction(
+            app, endpoint, len(predictions), time.perf_counter() - start
+        )
+        yield predictions
+
+
+def record_model_load(model_name, version, source, seconds, previous=None):
+    MODEL_LOAD_DURATION.labels(source).observe(seconds)
+    if previous is not None:
+        MODEL_VERSION.labels(model_name, previous).set(0)
+    MODEL_VERSION.labels(model_name, version).set(1)
+
+
+def instrument_app(app, app_name):
+    """
+    Time every request of a FastAPI app, by route template, and serve the
+    metrics of the process on /metrics
+    """
+
+    # only the APIs need fastapi, not the pipeline stages
+    # pylint: disable=import-outside-toplevel
+    from fastapi import Response
+
+    @app.middleware("http")
+    async def record_latency(request, call_next):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            route = request.scope.get("route")
+            REQUEST_LATENCY.labels(
+                app_name,
+                route.path if route is not None else "unmatched",
+                request.method,
+                status,
+            ).observe(time.perf_counter() - start)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics():
+        return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,99 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_BATCH_SIZE = int(os.getenv("MICRO_BATCH_MAX_SIZE", "512"))
+MAX_WAIT_MS = float(os.getenv("MICRO_BATCH_MAX_WAIT_MS", "2"))
+NUM_WORKERS = int(os.getenv("MICRO_BATCH_WORKERS", "2"))
+
+
+class MicroBatcher:
+    """
+    Coalesce the items of concurrent requests into one call of
+    batch_fn(items) -> results (one per item), run in a worker thread.
+    A batch is sent when it has max_batch_size items or max_wait_ms after
+    its first request, and at most num_workers batches run at once while
+    the next ones fill up. Each request gets the results of its own items
+    """
+
+    def __init__(
+        self,
+        batch_fn,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_wait_ms=MAX_WAIT_MS,
+        num_workers=NUM_WORKERS,
+    ):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.num_workers = num_workers
+        self._executor = None
+        self._queue = None
+        self._task = None
+
+    async def start(self):
+        self._executor = ThreadPoolExecutor(self.num_workers)
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._executor.shutdown()
+
+    async def submit(self, items):
+        """
+        Results of the items, computed with the items of other requests
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((items, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        # the worker threads are busy while the semaphore is taken, and the
+        # requests queue up for the next batch in the meantime
+        workers = asyncio.Semaphore(self.num_workers)
+        batch_tasks = set()
+        while True:
+            requests = [await self._queue.get()]
+            batch_size = len(requests[0][0])
+            deadline = loop.time() + self.max_wait
+            while batch_size < self.max_batch_size:
+                try:
+                    request = await asyncio.wait_for(
+                        self._queue.get(), deadline - loop.time()
+                    )
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                batch_size += len(request[0])
+
+            await workers.acquire()
+            batch_task = asyncio.create_task(self._run_batch(requests))
+            batch_tasks.add(batch_task)
+            batch_task.add_done_callback(batch_tasks.discard)
+            batch_task.add_done_callback(lambda _: workers.release())
+
+    async def _run_batch(self, requests):
+        items = [
+            item for request_items, _ in requests for item in request_items
+        ]
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self.batch_fn, items
+            )
+        # the error of the batch is the error of each of its requests
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        start = 0
+        for request_items, future in requests:
+            stop = start + len(request_items)
+            if not future.done():
+                future.set_result(results[start:stop])
+            start = stop
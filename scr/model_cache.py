@@ -0,0 +1,232 @@
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from catboost import CatBoostRegressor
+
+from scr.instrumentation import record_model_load
+
+logging.basicConfig(
+    level=logging.INFO,
+    filename="app.log",
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+MODEL_NAME = "ecommerce_forecast"
+MODEL_STAGE = os.getenv("MODEL_STAGE", "Production")
+CACHE_DIR = os.getenv("MODEL_CACHE_DIR", "./final_model/cache")
+REFRESH_SECONDS = float(os.getenv("MODEL_REFRESH_SECONDS", "60"))
+
+
+def feature_schema(model):
+    """
+    Feature names, input types and categorical feature indexes of a
+    CatBoost model, from the model itself: categorical features are
+    "text", the others "number"
+    """
+
+    cat_indices = set(model.get_cat_feature_indices())
+
+    return {
+        "feature_names": list(model.feature_names_),
+        "cat_features": sorted(cat_indices),
+        "feature_types": {
+            feature: "text" if index in cat_indices else "number"
+            for index, feature in enumerate(model.feature_names_)
+        },
+    }
+
+
+def set_current_version(version, cache_dir=CACHE_DIR):
+    """
+    Point cache_dir/current.json to a cached version. The pointer is
+    replaced atomically, so readers see the old or the new version, never
+    a partial one
+    """
+
+    current_path = Path(cache_dir) / "current.json"
+    tmp_path = current_path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump({"version": str(version)}, file)
+    os.replace(tmp_path, current_path)
+
+
+def write_cache_entry(model, version, cache_dir=CACHE_DIR):
+    """
+    Save the native model and its schema manifest under
+    cache_dir/<version>/ and make it the current version
+    """
+
+    entry_dir = Path(cache_dir) / str(version)
+    entry_dir.mkdir(parents=True, exist_ok=True)
+    model.save_model(entry_dir / "model.cb")
+    with open(entry_dir / "schema.json", "w", encoding="utf-8") as file:
+        json.dump({"version": str(version), **feature_schema(model)}, file)
+    set_current_version(version, cache_dir)
+
+
+def read_cache_entry(cache_dir=CACHE_DIR, version=None):
+    """
+    Load the model and schema of a cached version (default: current).
+    Returns (model, schema), or None when the cache has no such entry
+    """
+
+    if version is None:
+        current_path = Path(cache_dir) / "current.json"
+        if not current_path.exists():
+            return None
+        with open(current_path, encoding="utf-8") as file:
+            version = json.load(file)["version"]
+
+    entry_dir = Path(cache_dir) / str(version)
+    if not (entry_dir / "model.cb").exists():
+        return None
+    with open(entry_dir / "schema.json", encoding="utf-8") as file:
+        schema = json.load(file)
+
+    return CatBoostRegressor().load_model(entry_dir / "model.cb"), schema
+
+
+# mlflow is imported by the registry calls only, out of the startup path
+# when the local cache is warm
+def registry_client():
+    import mlflow  # pylint: disable=import-outside-toplevel
+
+    return mlflow.MlflowClient()
+
+
+def load_registry_model(model_name, version):
+    import mlflow  # pylint: disable=import-outside-toplevel
+
+    return mlflow.catboost.load_model(f"models:/{model_name}/{version}")
+
+
+class ModelCache:
+    """
+    The served model, its schema and version, kept as one tuple. Requests
+    read `current` once and keep using that model while a refresh replaces
+    the tuple, so a new version is swapped in without dropping requests
+    """
+
+    def __init__(
+        self,
+        cache_dir=CACHE_DIR,
+        model_name=MODEL_NAME,
+        stage=MODEL_STAGE,
+        client=None,
+    ):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.stage = stage
+        self.client = client
+        self.current = None
+        self._stop = threading.Event()
+        self._refresh_thread = None
+
+    def load(self, required=False):
+        """
+        Startup: the current version of the local cache if there is one,
+        otherwise the registry version of the stage. With required, fail
+        when neither of them has a version
+        """
+
+        start = time.perf_counter()
+        entry = read_cache_entry(self.cache_dir)
+        if entry is not None:
+            model, schema = entry
+            self.current = (model, schema, schema["version"])
+            record_model_load(
+                self.model_name,
+                schema["version"],
+                "cache",
+                time.perf_counter() - start,
+            )
+            logging.info(
+                "Model version %s loaded from cache", schema["version"]
+            )
+        else:
+            self.refresh()
+
+        if required and self.current is None:
+            raise RuntimeError(
+                f"No {self.stage} version of {self.model_name} in the model "
+                f"cache nor in the registry"
+            )
+
+        return self.current
+
+    def refresh(self):
+        """
+        Swap to the latest registry version of the stage if it is not the
+        served one. New versions are exported to the local cache first.
+        Returns whether the model changed
+        """
+
+        client = self.client or registry_client()
+        latest = client.get_latest_versions(
+            self.model_name, stages=[self.stage]
+        )
+        if not latest:
+            return False
+        version = str(latest[0].version)
+        if self.current is not None and self.current[2] == version:
+            return False
+
+        start = time.perf_counter()
+        source = "cache"
+        entry = read_cache_entry(self.cache_dir, version)
+        if entry is None:
+            source = "registry"
+            write_cache_entry(
+                load_registry_model(self.model_name, version),
+                version,
+                self.cache_dir,
+            )
+            entry = read_cache_entry(self.cache_dir, version)
+        else:
+            set_current_version(version, self.cache_dir)
+
+        model, schema = entry
+        previous = None if self.current is None else self.current[2]
+        self.current = (model, schema, version)
+        record_model_load(
+            self.model_name,
+            version,
+            source,
+            time.perf_counter() - start,
+            previous,
+        )
+        logging.info("Serving model version %s", version)
+
+        return True
+
+    def _refresh_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            # a failed check must not stop the next ones
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception("Model refresh failed, keeping %s", self)
+
+    def start_refresh(self, interval=REFRESH_SECONDS):
+        """
+        Check the registry every `interval` seconds in a daemon thread
+        """
+
+        self._stop.clear()
+        self._refresh_thread = threading.Thread(
+            target=self._refresh_loop, args=(interval,), daemon=True
+        )
+        self._refresh_thread.start()
+
+    def stop_refresh(self):
+        self._stop.set()
+        if self._refresh_thread is not None:
+            self._refresh_thread.join()
+
+    def __repr__(self):
+        version = None if self.current is None else self.current[2]
+        return f"ModelCache({self.model_name}, version={version})"
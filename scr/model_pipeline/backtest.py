@@ -0,0 +1,253 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import click
+import pandas as pd
+from catboost import CatBoostRegressor
+
+from scr.instrumentation import track_stage
+from scr.model_pipeline.dataset_store import (
+    DEFAULT_FORMAT,
+    DEFAULT_ROOT,
+    get_dataset_store,
+)
+from scr.model_pipeline.evaluation import (
+    BASELINE_METHODS,
+    add_baseline_forecasts,
+    evaluate_forecasts,
+)
+from scr.model_pipeline.temporal_target_and_split import (
+    SERIES_COLS,
+    add_target,
+)
+from scr.profiling import profiled
+
+logging.basicConfig(
+    level=logging.INFO,
+    filename="app.log",
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+BACKTEST_DATA = {}
+
+
+@profiled
+def load_backtest_data(
+    source_path, storage_format, target_col_source, horizon
+):
+    """
+    Read model_data once per process, sorted by date, with the target, the
+    features and the baselines of every row. Rows without target are
+    dropped. Used as the initializer of the pool workers
+    """
+
+    store = get_dataset_store(source_path, storage_format)
+    target_col = f"target_{horizon}_semana"
+    df = add_target(store.read("model_data"), target_col_source, horizon)
+    df = df[df[target_col].notna()].reset_index(drop=True)
+
+    features_df = df.drop(["order_purchase_date", target_col], axis=1)
+    eval_df = add_baseline_forecasts(
+        df[["order_purchase_date", *SERIES_COLS, target_col_source]],
+        target_col_source,
+        SERIES_COLS,
+    )
+
+    BACKTEST_DATA.update(
+        dates=pd.DatetimeIndex(df["order_purchase_date"]),
+        features_df=features_df,
+        target=df[target_col].to_numpy(),
+        eval_df=eval_df.assign(actual_value=df[target_col].to_numpy()),
+        cat_cols=list(
+            features_df.select_dtypes(["object", "category"]).columns
+        ),
+    )
+
+
+def fold_ranges(dates, cutoffs, horizon=1, val_weeks=1, window_weeks=None):
+    """
+    Row ranges of each fold on date-sorted rows. Validation rows are the
+    val_weeks weeks from the cutoff, train rows are the ones whose target
+    week is not after the cutoff, from the start (expanding window) or from
+    window_weeks before the cutoff (sliding window).
+    Returns (cutoff, train_start, train_stop, val_start, val_stop) tuples
+    """
+
+    week = pd.Timedelta(7, unit="D")
+    folds = []
+    for cutoff in pd.DatetimeIndex(cutoffs):
+        train_start = 0
+        if window_weeks is not None:
+            train_start = dates.searchsorted(cutoff - window_weeks * week)
+        folds.append(
+            (
+                cutoff,
+                train_start,
+                dates.searchsorted(cutoff - horizon * week, side="right"),
+                dates.searchsorted(cutoff),
+                dates.searchsorted(cutoff + val_weeks * week),
+            )
+        )
+
+    return folds
+
+
+@profiled
+def evaluate_fold(fold, params, thread_count):
+    """
+    Train on the train range of the fold and evaluate the forecast and the
+    baselines on its validation range. Returns (metrics by series, overall
+    metrics) of the fold
+    """
+
+    cutoff, train_start, train_stop, val_start, val_stop = fold
+    features_df = BACKTEST_DATA["features_df"]
+
+    model = CatBoostRegressor(
+        **params,
+        cat_features=BACKTEST_DATA["cat_cols"],
+        thread_count=thread_count,
+        verbose=0,
+    )
+    model.fit(
+        features_df.iloc[train_start:train_stop],
+        BACKTEST_DATA["target"][train_start:train_stop],
+    )
+
+    eval_df = BACKTEST_DATA["eval_df"].iloc[val_start:val_stop]
+    eval_df = eval_df.assign(
+        forecast=model.predict(features_df.iloc[val_start:val_stop]).round()
+    )
+    methods = ["forecast", *BASELINE_METHODS]
+
+    return (
+        evaluate_forecasts(eval_df, "actual_value", methods, SERIES_COLS)
+        .assign(cutoff=cutoff)
+        .assign(train_rows=train_stop - train_start),
+        evaluate_forecasts(eval_df, "actual_value", methods)
+        .assign(cutoff=cutoff)
+        .assign(train_rows=train_stop - train_start),
+    )
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+# pylint: disable=too-many-locals
+@click.command()
+@click.option(
+    "--source-path",
+    default=DEFAULT_ROOT,
+    help="Location where the processed datasets were saved",
+)
+@click.option(
+    "--storage-format",
+    default=DEFAULT_FORMAT,
+    help="Format of the processed datasets (parquet or csv)",
+)
+@click.option(
+    "--target-col-source",
+    default="sales_amount_sum",
+    help="Column name used as the future target",
+)
+@click.option(
+    "--horizon",
+    default=1,
+    help="Number of weeks in the future to set the target",
+)
+@click.option(
+    "--first-cutoff",
+    default="2018-01-01",
+    help="First validation week (a monday)",
+)
+@click.option(
+    "--num-folds",
+    default=20,
+    help="Number of cutoffs to evaluate",
+)
+@click.option(
+    "--step-weeks",
+    default=1,
+    help="Weeks between two cutoffs",
+)
+@click.option(
+    "--val-weeks",
+    default=1,
+    help="Weeks of validation rows of each fold",
+)
+@click.option(
+    "--window-weeks",
+    default=None,
+    type=int,
+    help="Train on the last weeks before each cutoff (default: all of them)",
+)
+@click.option(
+    "--depth",
+    default=6,
+    help="CatBoost depth of the backtested model",
+)
+@click.option(
+    "--iterations",
+    default=200,
+    help="CatBoost iterations of the backtested model",
+)
+@click.option(
+    "--workers",
+    default=1,
+    help="Number of folds trained in parallel, each in its own process",
+)
+@track_stage("backtest")
+def run_backtest(
+    source_path: str,
+    storage_format: str,
+    target_col_source: str,
+    horizon: int,
+    first_cutoff: str,
+    num_folds: int,
+    step_weeks: int,
+    val_weeks: int,
+    window_weeks: int,
+    depth: int,
+    iterations: int,
+    workers: int,
+):
+
+    data_args = (source_path, storage_format, target_col_source, horizon)
+    load_backtest_data(*data_args)
+    cutoffs = pd.date_range(
+        first_cutoff, periods=num_folds, freq=f"{7 * step_weeks}D"
+    )
+    folds = fold_ranges(
+        BACKTEST_DATA["dates"], cutoffs, horizon, val_weeks, window_weeks
+    )
+    logging.info("Backtesting %s folds with %s workers", num_folds, workers)
+
+    run_fold = partial(
+        evaluate_fold,
+        params={"depth": depth, "iterations": iterations, "random_seed": 56},
+        thread_count=max(1, (os.cpu_count() or 1) // workers),
+    )
+    if workers > 1:
+        with ProcessPoolExecutor(
+            workers, initializer=load_backtest_data, initargs=data_args
+        ) as pool:
+            results = list(pool.map(run_fold, folds))
+    else:
+        results = list(map(run_fold, folds))
+
+    series_df = pd.concat(
+        [series for series, _ in results], ignore_index=True
+    )
+    fold_df = pd.concat([fold for _, fold in results], ignore_index=True)
+    logging.info(
+        "Mean metrics over the folds:\n%s",
+        fold_df.groupby("method")[["rmse", "mape", "wape", "bias"]].mean(),
+    )
+
+    store = get_dataset_store(source_path, storage_format)
+    store.write(series_df, f"backtest/{horizon}/series_metrics")
+    store.write(fold_df, f"backtest/{horizon}/fold_metrics")
+
+
+if __name__ == "__main__":
+    run_backtest()
@@ -1,4 +1,11 @@
 import logging
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from pathlib import Path
 
 import click
 import matplotlib.pyplot as plt
@@ -6,11 +13,32 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 from catboost import CatBoostRegressor
-from hyperopt import STATUS_OK, Trials, fmin, hp, tpe
+from hyperopt import (
+    JOB_STATE_DONE,
+    STATUS_OK,
+    Domain,
+    Trials,
+    hp,
+    space_eval,
+    tpe,
+)
+from hyperopt.base import spec_from_misc
 from hyperopt.pyll import scope
 from sklearn.metrics import mean_squared_error
 
 import mlflow
+from scr.instrumentation import track_stage
+from scr.model_pipeline.dataset_store import (
+    DEFAULT_FORMAT,
+    DEFAULT_ROOT,
+    get_dataset_store,
+)
+from scr.model_pipeline.evaluation import (
+    BASELINE_METHODS,
+    add_baseline_forecasts,
+    evaluate_forecasts,
+)
+from scr.profiling import profiled
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,80 +49,332 @@ logging.basicConfig(
 mlflow.set_tracking_uri("sqlite:///mlflow.db")
 mlflow.set_experiment("ecommerce_forecast")
 
+SEARCH_SPACE = {
+    "depth": scope.int(hp.quniform("depth", 1, 16, 1)),
+    "iterations": scope.int(hp.quniform("iterations", 10, 50, 1)),
+    "min_data_in_leaf": scope.int(hp.quniform("min_data_in_leaf", 1, 4, 1)),
+    "random_state": 42,
+}
+TPE_SEED = 42
+SERIES_COLS = ["product_category_name", "customer_city"]
+BASELINE_COL = "sales_amount_sum"
+NUM_RUNGS = 3
+TRIAL_DATA = {}
 
-def latest_value_forecast(
-    df, group_col, value_col, date_col, days_to_predict
-):
+
+def create_mape_chart_by_date(df):
+
+    df["mape"] = (df["actual_value"] - df["forecast"]) / df["actual_value"]
+
+    return sns.relplot(
+        data=df,
+        x="order_purchase_date",  # "month_min",
+        y="mape",  # "historical_mape",
+        kind="line",
+        hue="method",
+        row="customer_city",
+        col="product_category_name",
+        aspect=1,
+    )
+
+
+@profiled
+def load_trial_data(source_path, storage_format, split_data):
+    """
+    Read the train and validation datasets once per process, and compute
+    the baselines of the validation targets. Used as the initializer of the
+    pool workers
+    """
+
+    store = get_dataset_store(source_path, storage_format)
+    x_train = store.read(f"{split_data}/x_train").drop(
+        "order_purchase_date", axis=1
+    )
+    x_val = store.read(f"{split_data}/x_val")
+    y_val = store.read(f"{split_data}/y_val").dropna()
+
+    eval_df = x_val[: len(y_val)][
+        ["order_purchase_date", *SERIES_COLS, BASELINE_COL]
+    ]
+    eval_df = add_baseline_forecasts(eval_df, BASELINE_COL, SERIES_COLS)
+    eval_df["order_purchase_date"] += pd.to_timedelta(7, unit="D")
+    eval_df["actual_value"] = y_val.iloc[:, 0].to_numpy()
+
+    TRIAL_DATA.update(
+        x_train=x_train,
+        y_train=store.read(f"{split_data}/y_train"),
+        x_val=x_val.drop("order_purchase_date", axis=1),
+        y_val=y_val,
+        eval_df=eval_df,
+        cat_cols=list(x_train.select_dtypes(["object", "category"]).columns),
+    )
+
+
+def rung_budgets(iterations, reduction_factor, num_rungs=NUM_RUNGS):
     """
-    Forecast by replicating the last value for each group
-    Returns DataFrame with forecast dates and group values
+    Iterations after which a pruned trial is compared with the previous
+    ones: iterations / reduction_factor**k, for k from num_rungs - 1 to 0
     """
 
-    df = df.copy()
-    df[date_col] = df[date_col] + pd.to_timedelta(days_to_predict, unit="D")
-    df["forecast"] = df[value_col]
-    df["method"] = "latest_value_forecast"
+    return [
+        max(1, int(np.ceil(iterations / reduction_factor**k)))
+        for k in range(num_rungs - 1, -1, -1)
+    ]
+
+
+def is_pruned(loss, rung_history, reduction_factor):
+    """
+    Successive halving rule: only the best 1 / reduction_factor of the
+    trials that reached a rung go on training
+    """
 
-    return df[[date_col, *group_col, value_col, "forecast", "method"]]
+    if len(rung_history) < reduction_factor:
+        return False
+
+    return loss > np.quantile(rung_history, 1 / reduction_factor)
+
+
+@profiled
+def fit_model(params, thread_count, early_stopping_rounds, pruning=None):
+    """
+    Fit the sampled params with early stopping on the validation set. With
+    pruning ({"reduction_factor", "rung_losses"} of the previous trials) the
+    iterations are trained by rungs, and the fit stops at the first rung
+    where the trial is not among the best.
+    Returns (model, validation rmse at each rung reached, pruned)
+    """
+
+    x_train, y_train = TRIAL_DATA["x_train"], TRIAL_DATA["y_train"]
+    y_val = TRIAL_DATA["y_val"]
+    x_val = TRIAL_DATA["x_val"][: len(y_val)]
+
+    budgets = [params["iterations"]]
+    if pruning is not None:
+        budgets = rung_budgets(
+            params["iterations"], pruning["reduction_factor"]
+        )
+
+    model, trained, losses = None, 0, []
+    for rung, budget in enumerate(budgets):
+        if budget > trained:
+            stage = CatBoostRegressor(
+                **{**params, "iterations": budget - trained},
+                cat_features=TRIAL_DATA["cat_cols"],
+                thread_count=thread_count,
+                verbose=0,
+            )
+            stage.fit(
+                x_train,
+                y_train,
+                eval_set=(x_val, y_val),
+                early_stopping_rounds=early_stopping_rounds,
+                init_model=model,
+            )
+            model, trained = stage, budget
+
+        if pruning is None:
+            break
+        losses.append(
+            np.sqrt(mean_squared_error(y_val, model.predict(x_val).round()))
+        )
+        if rung < len(budgets) - 1 and is_pruned(
+            losses[-1],
+            pruning["rung_losses"][rung],
+            pruning["reduction_factor"],
+        ):
+            return model, losses, True
+
+    return model, losses, False
+
+
+def save_mape_chart(eval_df, artifact_dir):
+    """
+    MAPE by date of the forecast and of the latest value and moving average
+    baselines on the validation set. Returns the path of the saved chart
+    """
+
+    id_cols = [*SERIES_COLS, "order_purchase_date", "actual_value"]
+    forecast_df = pd.concat(
+        [
+            eval_df[id_cols].assign(forecast=eval_df[method], method=method)
+            for method in [*BASELINE_METHODS, "forecast"]
+        ],
+        ignore_index=True,
+    )
+
+    ax = create_mape_chart_by_date(forecast_df)
+    # pylint: disable=protected-access
+    fig = ax._figure
+    chart_path = Path(artifact_dir) / "historical_mape.png"
+    fig.savefig(chart_path)
+    plt.close(fig)
+
+    return str(chart_path)
+
+
+def trial_metrics(eval_df):
+    """
+    Overall metrics of the forecast and the baselines, and RMSE and MAPE of
+    the forecast by product, as MLflow metric names
+    """
+
+    metrics = {}
+    overall_df = evaluate_forecasts(
+        eval_df, "actual_value", ["forecast", *BASELINE_METHODS]
+    )
+    for row in overall_df.itertuples():
+        prefix = "" if row.method == "forecast" else f"{row.method}_"
+        for metric in ["rmse", "mape", "wape", "bias"]:
+            metrics[f"{prefix}{metric}"] = getattr(row, metric)
+
+    product_df = evaluate_forecasts(
+        eval_df, "actual_value", ["forecast"], ["product_category_name"]
+    )
+    for row in product_df.itertuples():
+        metrics[f"rmse_{row.product_category_name}"] = row.rmse
+        metrics[f"mape_{row.product_category_name}"] = row.mape
+
+    return metrics
+
+
+def predict_val(model):
+    y_pred = model.predict(TRIAL_DATA["x_val"]).round()
+    return y_pred[: len(TRIAL_DATA["y_val"])]
 
 
 # pylint: disable=too-many-arguments, too-many-positional-arguments
-def moving_average_forecast(
-    df, group_col, value_col, date_col, days_to_predict, window
+# pylint: disable=too-many-locals
+@profiled
+def evaluate_trial(
+    params,
+    artifact_dir,
+    thread_count,
+    early_stopping_rounds,
+    pruning=None,
+    with_chart=True,
 ):
     """
-    Forecast using moving average for each group
-    Returns DataFrame with forecast dates and group values
+    Fit and evaluate one configuration on the data of TRIAL_DATA. The model
+    and, with_chart, the MAPE chart are saved to artifact_dir, nothing is
+    sent to MLflow here so that trials can run in several processes
+    """
+
+    model, rung_losses, pruned = fit_model(
+        params, thread_count, early_stopping_rounds, pruning
+    )
+    model_path = Path(artifact_dir) / "model.cb"
+    model.save_model(model_path)
+
+    eval_df = TRIAL_DATA["eval_df"].assign(forecast=predict_val(model))
+    metrics = {"tree_count": model.tree_count_, **trial_metrics(eval_df)}
+
+    result = {
+        "loss": metrics["rmse"],
+        "status": STATUS_OK,
+        "metrics": metrics,
+        "model_path": str(model_path),
+        "rung_losses": rung_losses,
+        "pruned": pruned,
+    }
+    if with_chart:
+        result["chart_path"] = save_mape_chart(eval_df, artifact_dir)
+
+    return result
+
+
+@profiled
+def log_trial(run_name, params, result):
+    """
+    One MLflow run per trial, written from the main process only: the
+    SQLite tracking store does not cope with concurrent writers.
+    Returns the run id
     """
 
-    df = df.copy()
-    df[date_col] = df[date_col] + pd.to_timedelta(days_to_predict, unit="D")
-    for i in range(window):
-        df[f"lag{i}"] = df.groupby(group_col)[value_col].shift(i)
+    with mlflow.start_run(run_name=run_name) as run:
+        mlflow.log_params(params)
+        mlflow.set_tag("pruned", result["pruned"])
+        mlflow.log_metrics(result["metrics"])
+        if "chart_path" in result:
+            log_trial_artifacts(result)
 
-    lags = [f"lag{i}" for i in range(window)]
-    df["forecast"] = df[lags].mean(axis=1)
-    df["method"] = "ma_forecast"
+    return run.info.run_id
 
-    return df[[date_col, *group_col, value_col, "forecast", "method"]]
 
+def log_trial_artifacts(result):
+    model = CatBoostRegressor().load_model(result["model_path"])
+    mlflow.catboost.log_model(model, name="model")
+    mlflow.log_artifact(result["chart_path"])
 
-def calculate_mape(df):
-    return (df["actual_value"] - df["forecast"]) / df["actual_value"]
 
+def keep_best_trials(best_trials, results, top_k):
+    """
+    The top_k results with the lowest loss. The fitted models of the other
+    ones are deleted from the temporary directory
+    """
 
-def create_mape_chart_by_date(df):
+    ranked = sorted(best_trials + results, key=lambda result: result["loss"])
+    for result in ranked[top_k:]:
+        shutil.rmtree(Path(result["model_path"]).parent)
 
-    df["mape"] = list(
-        df.groupby(
-            [
-                "order_purchase_date",
-                "product_category_name",
-                "customer_city",
-                "method",
-            ]
-        ).apply(calculate_mape)
-    )
+    return ranked[:top_k]
 
-    return sns.relplot(
-        data=df,
-        x="order_purchase_date",  # "month_min",
-        y="mape",  # "historical_mape",
-        kind="line",
-        hue="method",
-        row="customer_city",
-        col="product_category_name",
-        aspect=1,
+
+def log_best_trials(best_trials):
+    """
+    Model and MAPE chart of the best trials of a search that deferred them,
+    added to the runs already logged
+    """
+
+    for result in best_trials:
+        model = CatBoostRegressor().load_model(result["model_path"])
+        result["chart_path"] = save_mape_chart(
+            TRIAL_DATA["eval_df"].assign(forecast=predict_val(model)),
+            Path(result["model_path"]).parent,
+        )
+        with mlflow.start_run(run_id=result["run_id"]):
+            log_trial_artifacts(result)
+
+
+def suggest_trials(domain, trials, rstate, num_new):
+    """
+    Ask TPE for the next `num_new` configurations. Seeds are drawn from
+    `rstate` once per batch, so a search is reproducible for a given
+    number of workers
+    """
+
+    new_docs = tpe.suggest(
+        trials.new_trial_ids(num_new),
+        domain,
+        trials,
+        rstate.integers(2**31 - 1),
     )
+    trials.insert_trial_docs(new_docs)
+    trials.refresh()
+
+    return [
+        (doc, space_eval(domain.expr, spec_from_misc(doc["misc"])))
+        for doc in new_docs
+    ]
+
 
+def complete_trial(doc, result):
+    doc["state"] = JOB_STATE_DONE
+    doc["result"] = {"loss": result["loss"], "status": result["status"]}
 
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
 # pylint: disable=too-many-locals
 @click.command()
 @click.option(
     "--source-path",
-    default="./data/processed/",
+    default=DEFAULT_ROOT,
     help="Location where the processed datasets were saved",
 )
+@click.option(
+    "--storage-format",
+    default=DEFAULT_FORMAT,
+    help="Format of the processed datasets (parquet or csv)",
+)
 @click.option(
     "--split-data",
     default="2018-05-01",
@@ -105,128 +385,132 @@ def create_mape_chart_by_date(df):
     default=15,
     help="The number of parameter evaluations for the optimizer to explore",
 )
-def run_optimization(source_path: str, split_data: str, num_trials: int):
+@click.option(
+    "--workers",
+    default=1,
+    help="Number of trials fitted in parallel, each in its own process",
+)
+@click.option(
+    "--thread-count",
+    default=None,
+    type=int,
+    help="CatBoost threads per trial (default: the cores split by workers)",
+)
+@click.option(
+    "--early-stopping-rounds",
+    default=10,
+    help="Stop a fit after this many iterations without validation gains",
+)
+@click.option(
+    "--pruning/--no-pruning",
+    default=False,
+    help="Stop unpromising trials after a fraction of their iterations",
+)
+@click.option(
+    "--reduction-factor",
+    default=3,
+    help="Pruning keeps the best 1/reduction_factor trials at each rung",
+)
+@click.option(
+    "--top-k",
+    default=None,
+    type=int,
+    help="Log params and metrics only, and the model and chart of the k "
+    "best trials at the end (default: all artifacts of every trial)",
+)
+@track_stage("catboost_optimization")
+def run_optimization(
+    source_path: str,
+    storage_format: str,
+    split_data: str,
+    num_trials: int,
+    workers: int,
+    thread_count: int,
+    early_stopping_rounds: int,
+    pruning: bool,
+    reduction_factor: int,
+    top_k: int,
+):
 
-    source_path = f"{source_path}{split_data}/"
-    logging.info("Loading datasets")
-    x_train = pd.read_csv(f"{source_path}x_train.csv").drop(
-        "order_purchase_date", axis=1
-    )
-    y_train = pd.read_csv(f"{source_path}y_train.csv")
-    x_val = pd.read_csv(f"{source_path}x_val.csv").drop(
-        "order_purchase_date", axis=1
+    thread_count = thread_count or max(1, (os.cpu_count() or 1) // workers)
+    logging.info(
+        "Tuning with %s workers of %s threads", workers, thread_count
     )
-    dates_val = pd.to_datetime(
-        pd.read_csv(f"{source_path}x_val.csv")["order_purchase_date"]
-    )
-    y_val = pd.read_csv(f"{source_path}y_val.csv")
-    cat_cols = list(x_train.select_dtypes("object").columns)
-
-    def objective(params):
 
-        mlflow.autolog()
-        with mlflow.start_run(run_name=f"catboost_tunning_{split_data}"):
-
-            mlflow.log_params(params)
-            model = CatBoostRegressor(
-                random_seed=56, cat_features=cat_cols, verbose=0
+    domain = Domain(evaluate_trial, SEARCH_SPACE)
+    trials = Trials()
+    rstate = np.random.default_rng(TPE_SEED)
+    data_args = (source_path, storage_format, split_data)
+    rung_losses = [[] for _ in range(NUM_RUNGS)]
+    best_trials = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir, ExitStack() as stack:
+        pool = None
+        if workers > 1:
+            pool = stack.enter_context(
+                ProcessPoolExecutor(
+                    workers, initializer=load_trial_data, initargs=data_args
+                )
             )
-            model.fit(x_train, y_train)
-
-            mlflow.catboost.log_model(model, name="model")
-            y_pred = model.predict(x_val).round()
-
-            y_val.dropna(inplace=True)
-            y_pred = y_pred[: len(y_val)]
-            rmse = np.sqrt(mean_squared_error(y_val, y_pred))
-            mape = (
-                np.mean(
-                    np.abs(
-                        (np.array(y_val) - np.array(y_pred)) / np.array(y_val)
-                    )
+        else:
+            logging.info("Loading datasets")
+            load_trial_data(*data_args)
+
+        while len(trials) < num_trials:
+            batch = suggest_trials(
+                domain,
+                trials,
+                rstate,
+                min(workers, num_trials - len(trials)),
+            )
+            artifact_dirs = [
+                Path(tmp_dir) / str(doc["tid"]) for doc, _ in batch
+            ]
+            for artifact_dir in artifact_dirs:
+                artifact_dir.mkdir()
+
+            run_trial = partial(
+                evaluate_trial,
+                thread_count=thread_count,
+                early_stopping_rounds=early_stopping_rounds,
+                pruning=(
+                    {
+                        "reduction_factor": reduction_factor,
+                        "rung_losses": rung_losses,
+                    }
+                    if pruning
+                    else None
+                ),
+                with_chart=top_k is None,
+            )
+            results = list(
+                (map if pool is None else pool.map)(
+                    run_trial, [params for _, params in batch], artifact_dirs
                 )
-                * 100
             )
-            mlflow.log_metric("rmse", rmse)
-            mlflow.log_metric("mape", mape)
-
-            for prod in list(set(x_val["product_category_name"])):
-                y_val_aux = y_val[
-                    x_val[: len(y_val)]["product_category_name"] == prod
-                ]
-                y_pred_aux = y_pred[
-                    x_val[: len(y_val)]["product_category_name"] == prod
-                ]
-                rmse = np.sqrt(mean_squared_error(y_val_aux, y_pred_aux))
-                mlflow.log_metric(f"rmse_{prod}", rmse)
-                mape = (
-                    np.mean(
-                        np.abs(
-                            (np.array(y_val_aux) - np.array(y_pred_aux))
-                            / np.array(y_val_aux)
-                        )
-                    )
-                    * 100
+
+            for (doc, params), result in zip(batch, results):
+                result["run_id"] = log_trial(
+                    f"catboost_tunning_{split_data}", params, result
                 )
-                mlflow.log_metric(f"mape_{prod}", mape)
-
-            target_col = "actual_value"  # f"target_{horizon}_semana"
-            group_col = ["product_category_name", "customer_city"]
-            date_col = "order_purchase_date"
-            days = 7
-            window = 3
-
-            x_val_aux = x_val[: len(y_val)][[*group_col]]
-            x_val_aux["actual_value"] = y_val
-            x_val_aux["forecast"] = y_pred
-            x_val_aux["order_purchase_date"] = dates_val[
-                : len(y_val)
-            ] + pd.to_timedelta(days, unit="D")
-            x_val_aux["method"] = "forecast"
-
-            forecast_df = pd.concat(
-                [
-                    latest_value_forecast(
-                        x_val_aux, group_col, target_col, date_col, days
-                    ),
-                    moving_average_forecast(
-                        x_val_aux,
-                        group_col,
-                        target_col,
-                        date_col,
-                        days,
-                        window,
-                    ),
-                    x_val_aux,
-                ]
-            )  # .drop(target_col, axis=1)
-
-            ax = create_mape_chart_by_date(forecast_df)
-            # pylint: disable=protected-access
-            fig = ax._figure
-            mlflow.log_figure(fig, "historical_mape.png")
-            plt.close(fig)
-
-        return {"loss": rmse, "status": STATUS_OK}
-
-    search_space = {
-        "depth": scope.int(hp.quniform("depth", 1, 20, 1)),
-        "iterations": scope.int(hp.quniform("iterations", 10, 50, 1)),
-        "min_data_in_leaf": scope.int(
-            hp.quniform("min_data_in_leaf", 1, 4, 1)
-        ),
-        "random_state": 42,
-    }
+                complete_trial(doc, result)
+                for rung, loss in enumerate(result["rung_losses"]):
+                    rung_losses[rung].append(loss)
+            trials.refresh()
+            if top_k is not None:
+                best_trials = keep_best_trials(best_trials, results, top_k)
+            logging.info(
+                "%s/%s trials, best rmse %s",
+                len(trials),
+                num_trials,
+                min(trials.losses()),
+            )
 
-    rstate = np.random.default_rng(42)
-    fmin(
-        fn=objective,
-        space=search_space,
-        algo=tpe.suggest,
-        max_evals=num_trials,
-        trials=Trials(),
-        rstate=rstate,
-    )
+        if top_k is not None:
+            logging.info("Logging artifacts of the %s best trials", top_k)
+            if not TRIAL_DATA:
+                load_trial_data(*data_args)
+            log_best_trials(best_trials)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,14 @@
 import logging
+import os
+from functools import lru_cache
 
+import numpy as np
 import pandas as pd
-from workalendar.america import Brazil
+from workalendar.america import Brazil, BrazilSaoPauloCity
+
+from scr.instrumentation import track_stage
+from scr.model_pipeline.dataset_store import get_dataset_store
+from scr.profiling import profiled
 
 logging.basicConfig(
     level=logging.INFO,
@@ -9,6 +16,82 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s",
 )
 
+HOLIDAY_CALENDARS = {
+    "brazil": Brazil,
+    "sao_paulo": BrazilSaoPauloCity,
+}
+RAW_PATH = "./data/raw/"
+SELECTED_PROD_LIST = [
+    "cama_mesa_banho",
+    "beleza_saude",
+    "esporte_lazer",
+    "informatica_acessorios",
+    "moveis_decoracao",
+]
+SELECTED_CITIES_LIST = ["sao paulo"]
+# "all" builds every category x city series, for a single global model
+SERIES_SCOPES = {
+    "selected": (SELECTED_PROD_LIST, SELECTED_CITIES_LIST),
+    "all": (None, None),
+}
+SERIES_SCOPE = os.getenv("SERIES_SCOPE", "selected")
+FIRST_MONTH = "2017-01-01"
+LAST_MONTH = "2018-08-01"
+WEEKLY_AGGREGATIONS = {
+    "year": "min",
+    "month": "min",
+    "day_of_month": "max",
+    "flag_holiday": "max",
+    "flag_approved_order": "mean",
+    "flag_new_client": "mean",
+    "daytime_in_minutes": ["mean", "median", "min", "max"],
+    "sales_amount": ["sum", "mean", "median", "min", "max"],
+    "sales_value": ["sum", "mean", "median", "min", "max"],
+    "freight": ["mean", "median", "min", "max"],
+    "product_weight_g": ["mean", "median"],
+}
+CLIENT_KEY_COLS = [
+    "customer_id",
+    "product_category_name",
+    "customer_state",
+    "customer_city",
+]
+SERIES_KEY_COLS = ["product_category_name", "customer_state", "customer_city"]
+GAP_FILL_COLS = [
+    f"{col}_{stat}"
+    for col in ["sales_amount", "sales_value"]
+    for stat in WEEKLY_AGGREGATIONS[col]
+]
+
+
+def add_timestamp_features(df, timestamp_col):
+    """
+    Parse the purchase timestamp once and derive the week start (monday),
+    the calendar date, the month start and the minute of the day using
+    datetime64 arithmetic
+    """
+
+    timestamp = pd.to_datetime(df[timestamp_col]).to_numpy(
+        dtype="datetime64[ns]"
+    )
+    days = timestamp.astype("datetime64[D]")
+    # 1970-01-01 was a thursday, shift by 3 to get monday-based weekdays
+    weekday = (days.view("int64") + 3) % 7
+    minutes = (timestamp - days).astype("timedelta64[m]").view("int64")
+    missing = np.isnat(timestamp)
+
+    df[timestamp_col] = timestamp
+    df["order_purchase_date"] = (days - weekday).astype("datetime64[ns]")
+    df["order_purchase_original_date"] = days.astype("datetime64[ns]")
+    df["order_purchase_month"] = days.astype("datetime64[M]").astype(
+        "datetime64[ns]"
+    )
+    df["daytime_in_minutes"] = (
+        np.where(missing, np.nan, minutes) if missing.any() else minutes
+    )
+
+    return df
+
 
 def add_temporal_features(df, date_col):
     df["year"] = df[date_col].dt.year
@@ -19,51 +102,73 @@ def add_temporal_features(df, date_col):
     return df
 
 
-def add_holidays(df, cal):
-    df = df.merge(
-        pd.concat(
-            [
-                pd.DataFrame(
-                    cal.holidays(2017),
-                    columns=["order_purchase_date", "holiday"],
-                ),
-                pd.DataFrame(
-                    cal.holidays(2018),
-                    columns=["order_purchase_date", "holiday"],
-                ),
-            ]
-        ).astype(dtype={"order_purchase_date": "datetime64[ns]"}),
-        how="left",
-    ).fillna({"holiday": "missing"})
-    df["flag_holiday"] = (df["holiday"] != "missing").astype(int)
+@lru_cache(maxsize=None)
+def holiday_index(cal_class, first_year, last_year):
+    """
+    Sorted holiday dates (datetime64) and their names for every year in
+    [first_year, last_year], computed once per calendar and year range
+    """
+
+    holidays = {}
+    for year in range(first_year, last_year + 1):
+        for day, name in cal_class().holidays(year):
+            holidays.setdefault(day, name)
+
+    dates = sorted(holidays)
+    return (
+        np.array(dates, dtype="datetime64[ns]"),
+        np.array([holidays[day] for day in dates], dtype=object),
+    )
+
+
+@profiled
+def add_holidays(df, cal, date_col="order_purchase_date"):
+    dates = df[date_col].to_numpy(dtype="datetime64[ns]")
+    years = df[date_col].dt.year
+    # no year bounds in an empty chunk (e.g. a week without orders)
+    if years.isna().all():
+        df["holiday"] = "missing"
+        df["flag_holiday"] = 0
+        return df
+
+    holiday_dates, holiday_names = holiday_index(
+        type(cal), int(years.min()), int(years.max())
+    )
+
+    position = np.searchsorted(holiday_dates, dates).clip(
+        max=max(len(holiday_dates) - 1, 0)
+    )
+    is_holiday = (
+        holiday_dates[position] == dates
+        if len(holiday_dates)
+        else np.zeros(len(dates), dtype=bool)
+    )
+
+    df["holiday"] = np.where(is_holiday, holiday_names[position], "missing")
+    df["flag_holiday"] = is_holiday.astype(int)
 
     return df
 
 
-def detect_new_clients(df, key_col_list):
-    df["flag_new_client"] = df.groupby(key_col_list).cumcount() + 1
+@profiled
+def detect_new_clients(df, key_col_list, seen_df=None):
+    df["flag_new_client"] = (
+        df.groupby(key_col_list, observed=True).cumcount() + 1
+    )
     df["flag_new_client"] = (df["flag_new_client"] == 1).astype(int)
+    if seen_df is not None:
+        seen = pd.MultiIndex.from_frame(df[key_col_list]).isin(
+            pd.MultiIndex.from_frame(seen_df[key_col_list])
+        )
+        df.loc[seen, "flag_new_client"] = 0
 
     return df
 
 
+@profiled
 def aggregate_cols_by_dates(df, key_cols_list):
     df = df.copy()
-    df = df.groupby(key_cols_list).agg(
-        {
-            "year": "min",
-            "month": "min",
-            "day_of_month": "max",
-            "flag_holiday": "max",
-            "flag_approved_order": "mean",
-            "flag_new_client": "mean",
-            "daytime_in_minutes": ["mean", "median", "min", "max"],
-            "sales_amount": ["sum", "mean", "median", "min", "max"],
-            "sales_value": ["sum", "mean", "median", "min", "max"],
-            "freight": ["mean", "median", "min", "max"],
-            "product_weight_g": ["mean", "median"],
-        }
-    )
+    df = df.groupby(key_cols_list).agg(WEEKLY_AGGREGATIONS)
 
     df.columns = df.columns.droplevel(1) + "_" + df.columns.droplevel(0)
     df = df.reset_index()
@@ -72,48 +177,75 @@ def aggregate_cols_by_dates(df, key_cols_list):
 
 
 def filter_products_and_cities(df, prod_list, cities_list):
-    return df[
-        (df["product_category_name"].isin(prod_list))
-        & (df["customer_city"].isin(cities_list))
-    ]
-
-
-def avoid_gap_dates(df, date_col, key_cols_list):
-    start_date = df[date_col].min()
-    final_date = df[date_col].max()
-    logging.info(final_date - start_date)
-
-    dates_df = pd.DataFrame(
-        {date_col: pd.date_range(start=start_date, end=final_date, freq="D")}
+    """
+    Orders of the products and cities of the lists (None keeps all of them)
+    """
+
+    keep = np.ones(len(df), dtype=bool)
+    if prod_list is not None:
+        keep &= df["product_category_name"].isin(prod_list).to_numpy()
+    if cities_list is not None:
+        keep &= df["customer_city"].isin(cities_list).to_numpy()
+
+    return df[keep]
+
+
+@profiled
+def avoid_gap_dates(df, date_col, key_cols_list, dates=None, series_df=None):
+    """
+    Add the weeks without orders of every series of the weekly aggregated df,
+    with zero sales. The full index is built from the codes of the existing
+    series and the weeks, so its size is the one of the weekly output.
+    `dates` and `series_df` optionally extend the weeks and series to cover.
+    The key columns are returned as categoricals built from those codes
+    """
+
+    if dates is None:
+        dates = pd.date_range(
+            start=df[date_col].min(), end=df[date_col].max(), freq="7D"
+        )
+    series_df = pd.concat([series_df, df[key_cols_list]])
+    series = pd.MultiIndex.from_frame(
+        series_df[key_cols_list].astype(object).drop_duplicates()
+    ).sort_values()
+
+    num_dates, num_series = len(dates), len(series)
+    full_index = pd.MultiIndex(
+        levels=[pd.DatetimeIndex(dates), *series.levels],
+        codes=[
+            np.repeat(np.arange(num_dates), num_series),
+            *(np.tile(codes, num_dates) for codes in series.codes),
+        ],
+        names=[date_col, *key_cols_list],
     )
 
-    dates_df = dates_df.merge(
-        df[key_cols_list].drop_duplicates(), how="cross"
+    filled_df = (
+        df.set_index([date_col, *key_cols_list])
+        .reindex(full_index)
+        .fillna(value=dict.fromkeys(GAP_FILL_COLS, 0))
+        .reset_index(drop=True)
     )
-
-    return df.merge(dates_df, how="right").fillna(
-        value={
-            "sales_amount_sum": 0,
-            "sales_amount_mean": 0,
-            "sales_amount_median": 0,
-            "sales_amount_min": 0,
-            "sales_amount_max": 0,
-            "sales_value_sum": 0,
-            "sales_value_mean": 0,
-            "sales_value_median": 0,
-            "sales_value_min": 0,
-            "sales_value_max": 0,
-        }
+    keys = {date_col: full_index.get_level_values(date_col)}
+    for col, codes, level in zip(
+        key_cols_list, full_index.codes[1:], full_index.levels[1:]
+    ):
+        keys[col] = pd.Categorical.from_codes(codes, level)
+
+    return pd.concat([pd.DataFrame(keys), filled_df], axis=1)
+
+
+@profiled
+def read_raw_datasets(raw_path=RAW_PATH):
+    return (
+        pd.read_csv(f"{raw_path}olist_orders_dataset.csv"),
+        pd.read_csv(f"{raw_path}olist_order_items_dataset.csv"),
+        pd.read_csv(f"{raw_path}olist_products_dataset.csv"),
+        pd.read_csv(f"{raw_path}olist_customers_dataset.csv"),
     )
 
 
-if __name__ == "__main__":
-    logging.info("Reading datasets")
-    orders_df = pd.read_csv("./data/raw/olist_orders_dataset.csv")
-    order_items_df = pd.read_csv("./data/raw/olist_order_items_dataset.csv")
-    products_df = pd.read_csv("./data/raw/olist_products_dataset.csv")
-    customers_df = pd.read_csv("./data/raw/olist_customers_dataset.csv")
-
+@profiled
+def join_orders(orders_df, order_items_df, products_df, customers_df):
     order_items_df = (
         order_items_df.groupby(["order_id", "product_id"])
         .agg(
@@ -124,95 +256,82 @@ if __name__ == "__main__":
         .reset_index()
     )
 
-    logging.info("Join initial datasets")
     joined_df = (
         orders_df.merge(order_items_df, how="left", on=["order_id"])
         .merge(products_df, how="left", on=["product_id"])
         .merge(customers_df, how="left", on=["customer_id"])
     )
+    joined_df = add_timestamp_features(joined_df, "order_purchase_timestamp")
 
-    logging.info("Improve date features")
-    joined_df["order_purchase_timestamp"] = pd.to_datetime(
-        joined_df["order_purchase_timestamp"]
-    )
-    joined_df["order_purchase_date"] = [
-        pd.to_datetime(day) - pd.Timedelta(days=day.weekday())
-        for day in joined_df["order_purchase_timestamp"].dt.normalize()
-    ]
-    joined_df["order_purchase_original_date"] = pd.to_datetime(
-        joined_df["order_purchase_timestamp"]
-    ).dt.normalize()
-    joined_df["order_purchase_month"] = pd.to_datetime(
-        pd.to_datetime(joined_df["order_purchase_timestamp"]).dt.strftime(
-            "%Y-%m-01"
-        )
-    )
-    joined_df["daytime_in_minutes"] = (
-        pd.to_datetime(joined_df["order_purchase_timestamp"]).dt.hour * 60
-        + pd.to_datetime(joined_df["order_purchase_timestamp"]).dt.minute
-    )
-    joined_df = joined_df.sort_values("order_purchase_original_date")
-
-    logging.info("Filter dataset")
-    selected_prod_list = [
-        "cama_mesa_banho",
-        "beleza_saude",
-        "esporte_lazer",
-        "informatica_acessorios",
-        "moveis_decoracao",
-    ]
-    selected_cities_list = ["sao paulo"]
-
-    joined_df = joined_df[
-        (joined_df["order_purchase_month"] >= pd.to_datetime("2017-01-01"))
-        & (joined_df["order_purchase_month"] <= pd.to_datetime("2018-08-01"))
-    ]
-
-    logging.info("Add new features")
-    joined_df["flag_approved_order"] = (
-        ~joined_df["order_status"].isin(["unavailable", "canceled"])
+    return joined_df.sort_values("order_purchase_original_date")
+
+
+@profiled
+def add_order_features(df, cal, seen_clients_df=None):
+    df["flag_approved_order"] = (
+        ~df["order_status"].isin(["unavailable", "canceled"])
     ).astype(int)
-    joined_df = add_temporal_features(
-        joined_df, date_col="order_purchase_original_date"
-    )
-    brazilian_cal = Brazil()
-    joined_df = add_holidays(joined_df, cal=brazilian_cal)
-    joined_df = detect_new_clients(
-        joined_df,
-        [
-            "customer_id",
-            "product_category_name",
-            "customer_state",
-            "customer_city",
-        ],
-    )
+    df = add_temporal_features(df, date_col="order_purchase_original_date")
+    df = add_holidays(df, cal=cal)
+
+    return detect_new_clients(df, CLIENT_KEY_COLS, seen_clients_df)
+
+
+@profiled
+def aggregate_weekly(df, series_scope=SERIES_SCOPE, dates=None):
+    """
+    Weekly national aggregates by category and weekly aggregates of the
+    products and cities of the series scope, over the weeks of `dates`
+    (default: those of df). Returns (national_df, final_df)
+    """
 
-    logging.info("Aggregate dataset weekly")
     national_df = aggregate_cols_by_dates(
-        joined_df, ["order_purchase_date", "product_category_name"]
+        df, ["order_purchase_date", "product_category_name"]
     )
-    joined_df = filter_products_and_cities(
-        joined_df,
-        prod_list=selected_prod_list,
-        cities_list=selected_cities_list,
-    )
-    joined_df = avoid_gap_dates(
-        joined_df,
-        "order_purchase_original_date",
-        ["product_category_name", "customer_state", "customer_city"],
+    prod_list, cities_list = SERIES_SCOPES[series_scope]
+    df = filter_products_and_cities(
+        df, prod_list=prod_list, cities_list=cities_list
     )
     final_df = aggregate_cols_by_dates(
-        joined_df,
-        [
-            "order_purchase_date",
-            "product_category_name",
-            "customer_state",
-            "customer_city",
-        ],
+        df, ["order_purchase_date", *SERIES_KEY_COLS]
     )
-
-    logging.info("Write datasets")
-    national_df.to_csv(
-        "./data/processed/national_orders_by_week.csv", index=False
+    final_df = avoid_gap_dates(
+        final_df, "order_purchase_date", SERIES_KEY_COLS, dates=dates
     )
-    final_df.to_csv("./data/processed/orders_by_week.csv", index=False)
+
+    return national_df, final_df
+
+
+if __name__ == "__main__":
+    with track_stage("data_preparation"):
+        logging.info("Reading datasets")
+        raw_dfs = read_raw_datasets()
+
+        logging.info("Join initial datasets")
+        joined_df = join_orders(*raw_dfs)
+
+        logging.info("Filter dataset")
+        joined_df = joined_df[
+            (joined_df["order_purchase_month"] >= pd.to_datetime(FIRST_MONTH))
+            & (
+                joined_df["order_purchase_month"]
+                <= pd.to_datetime(LAST_MONTH)
+            )
+        ]
+
+        logging.info("Add new features")
+        holiday_cal = HOLIDAY_CALENDARS[
+            os.getenv("HOLIDAY_CALENDAR", "brazil")
+        ]
+        joined_df = add_order_features(joined_df, cal=holiday_cal())
+
+        logging.info("Aggregate dataset weekly")
+        national_df, final_df = aggregate_weekly(joined_df)
+
+        logging.info("Write datasets")
+        store = get_dataset_store()
+        store.write(national_df, "national_orders_by_week")
+        store.write(final_df, "orders_by_week")
+        store.write(
+            joined_df[CLIENT_KEY_COLS].drop_duplicates(), "state/seen_clients"
+        )
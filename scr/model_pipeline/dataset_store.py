@@ -0,0 +1,241 @@
+import abc
+import logging
+import os
+import shutil
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from scr.instrumentation import record_rows
+from scr.profiling import profiled
+
+logging.basicConfig(
+    level=logging.INFO,
+    filename="app.log",
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+DEFAULT_ROOT = "./data/processed/"
+DEFAULT_FORMAT = os.getenv("DATASET_STORE_FORMAT", "parquet")
+DATE_COL = "order_purchase_date"
+
+
+class DatasetStore(abc.ABC):
+    """
+    Datasets shared between the pipeline stages, addressed by name
+    (e.g. "model_data" or "2018-05-01/x_val") under a root directory
+    """
+
+    extension = ""
+
+    def __init__(self, root=DEFAULT_ROOT):
+        self.root = Path(root)
+
+    def path(self, name):
+        return self.root / f"{name}{self.extension}"
+
+    def exists(self, name):
+        return self.path(name).exists()
+
+    def columns(self, name):
+        """
+        Column names of a dataset, without reading its rows
+        """
+
+        return self._columns(self.path(name))
+
+    @profiled
+    def write(self, df, name):
+        if isinstance(df, pd.Series):
+            df = df.to_frame()
+        path = self.path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        logging.info("Writing %s rows to %s", len(df), path)
+        self._write(df, path)
+        record_rows(name, "write", len(df))
+
+    @profiled
+    def append(self, df, name):
+        """
+        Add rows to an existing dataset without rewriting it. Columns are
+        matched by name with the ones already stored
+        """
+
+        path = self.path(name)
+        if not path.exists():
+            self.write(df, name)
+            return
+        logging.info("Appending %s rows to %s", len(df), path)
+        self._append(df, path)
+        record_rows(name, "append", len(df))
+
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    @profiled
+    def read(
+        self,
+        name,
+        columns=None,
+        start_date=None,
+        end_date=None,
+        date_col=DATE_COL,
+        isin=None,
+    ):
+        """
+        Read a dataset keeping only `columns` and the rows where
+        start_date <= date_col < end_date (both bounds optional) and, for
+        every column of `isin`, the value is one of the given values
+        """
+
+        path = self.path(name)
+        logging.info("Reading %s", path)
+        df = self._read(
+            path,
+            columns,
+            date_col,
+            None if start_date is None else pd.Timestamp(start_date),
+            None if end_date is None else pd.Timestamp(end_date),
+            {} if isin is None else isin,
+        )
+        record_rows(name, "read", len(df))
+
+        return df
+
+    @abc.abstractmethod
+    def _write(self, df, path):
+        pass
+
+    @abc.abstractmethod
+    def _append(self, df, path):
+        pass
+
+    @abc.abstractmethod
+    def _columns(self, path):
+        pass
+
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    @abc.abstractmethod
+    def _read(self, path, columns, date_col, start_date, end_date, isin):
+        pass
+
+
+class ParquetDatasetStore(DatasetStore):
+    """
+    Columnar storage: dtypes (datetimes, categoricals) survive the round
+    trip, and both column projection and the date filter are pushed down
+    to the Parquet reader
+    """
+
+    extension = ".parquet"
+
+    def _write(self, df, path):
+        if path.is_dir():
+            shutil.rmtree(path)
+        df.to_parquet(path, engine="pyarrow", index=False)
+
+    def _append(self, df, path):
+        """
+        Appended datasets become a directory of part files, which the
+        reader scans as a single dataset
+        """
+
+        if path.is_file():
+            first_part = path.with_suffix(".part")
+            path.rename(first_part)
+            path.mkdir()
+            first_part.rename(path / "part-00000.parquet")
+
+        parts = sorted(path.glob("part-*.parquet"))
+        schema = pq.read_schema(parts[0])
+        table = pa.Table.from_pandas(
+            df[schema.names], schema=schema, preserve_index=False
+        )
+        pq.write_table(table, path / f"part-{len(parts):05d}.parquet")
+
+    def _columns(self, path):
+        return pq.ParquetDataset(path).schema.names
+
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    def _read(self, path, columns, date_col, start_date, end_date, isin):
+        filters = []
+        if start_date is not None:
+            filters.append((date_col, ">=", start_date))
+        if end_date is not None:
+            filters.append((date_col, "<", end_date))
+        for col, values in isin.items():
+            filters.append((col, "in", list(values)))
+
+        return pd.read_parquet(
+            path,
+            engine="pyarrow",
+            columns=columns,
+            filters=filters or None,
+        )
+
+
+class CsvDatasetStore(DatasetStore):
+    """
+    Plain CSV files, kept to inspect the datasets by hand. Dtypes are
+    re-inferred on read and the date filter is applied in memory
+    """
+
+    extension = ".csv"
+
+    def _write(self, df, path):
+        df.to_csv(path, index=False)
+
+    def _append(self, df, path):
+        header = pd.read_csv(path, nrows=0).columns
+        df[header].to_csv(path, mode="a", header=False, index=False)
+
+    def _columns(self, path):
+        return list(pd.read_csv(path, nrows=0).columns)
+
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    def _read(self, path, columns, date_col, start_date, end_date, isin):
+        header = pd.read_csv(path, nrows=0).columns
+        filtered = start_date is not None or end_date is not None
+        usecols = columns
+        if columns is not None:
+            usecols = list(
+                dict.fromkeys(
+                    [*columns, *([date_col] if filtered else []), *isin]
+                )
+            )
+
+        parse_dates = date_col in header and (
+            usecols is None or date_col in usecols
+        )
+        df = pd.read_csv(
+            path,
+            usecols=usecols,
+            parse_dates=[date_col] if parse_dates else None,
+        )
+        if start_date is not None:
+            df = df[df[date_col] >= start_date]
+        if end_date is not None:
+            df = df[df[date_col] < end_date]
+        for col, values in isin.items():
+            df = df[df[col].isin(values)]
+
+        if columns is not None:
+            df = df[columns]
+
+        return df.reset_index(drop=True)
+
+
+DATASET_STORES = {
+    "parquet": ParquetDatasetStore,
+    "csv": CsvDatasetStore,
+}
+
+
+def get_dataset_store(root=DEFAULT_ROOT, storage_format=DEFAULT_FORMAT):
+    if storage_format not in DATASET_STORES:
+        raise ValueError(
+            f"Unknown storage format {storage_format!r}, "
+            f"expected one of {sorted(DATASET_STORES)}"
+        )
+
+    return DATASET_STORES[storage_format](root)
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+from scr.model_pipeline.feature_engineering import (
+    group_index,
+    grouped_rolling_features,
+)
+
+METRIC_LIST = ["rmse", "mape", "wape", "bias", "count"]
+BASELINE_METHODS = ["latest_value_forecast", "ma_forecast"]
+
+
+def group_codes(df, group_cols):
+    """
+    Integer code of the group of every row (-1 for missing keys) and the
+    keys of each code. Without group_cols every row is in the same group
+    """
+
+    if not group_cols:
+        return np.zeros(len(df), dtype=np.int64), pd.DataFrame(index=[0])
+
+    grouped = df.groupby(group_cols, sort=True, observed=True)
+    codes = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    keys_df = grouped.size().index.to_frame(index=False)
+
+    return codes, keys_df
+
+
+def segment_metrics(actual, forecast, codes, num_groups):
+    """
+    RMSE, MAPE, WAPE and bias (mean forecast - actual) of every group at
+    once, with one np.bincount per sum. Rows with a missing value or code
+    are skipped, and MAPE skips the rows where the actual value is zero
+    """
+
+    actual = np.asarray(actual, dtype="float64")
+    forecast = np.asarray(forecast, dtype="float64")
+    is_valid = ~np.isnan(actual) & ~np.isnan(forecast) & (codes >= 0)
+    actual, forecast, codes = (
+        actual[is_valid],
+        forecast[is_valid],
+        codes[is_valid],
+    )
+
+    error = forecast - actual
+    is_nonzero = actual != 0
+    abs_pct_error = np.abs(error[is_nonzero] / actual[is_nonzero])
+
+    def total(weights=None, group=codes):
+        return np.bincount(group, weights, minlength=num_groups)
+
+    count = total()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return pd.DataFrame(
+            {
+                "rmse": np.sqrt(total(error**2) / count),
+                "mape": 100
+                * total(abs_pct_error, codes[is_nonzero])
+                / total(group=codes[is_nonzero]),
+                "wape": 100 * total(np.abs(error)) / total(np.abs(actual)),
+                "bias": total(error) / count,
+                "count": count,
+            }
+        )
+
+
+def add_baseline_forecasts(df, history_col, series_cols, window=3):
+    """
+    Naive forecasts for every row of df, ordered by date inside each series:
+    the last known value of history_col (latest_value_forecast) and its
+    moving average over `window` rows of the series, NaN skipped
+    (ma_forecast)
+    """
+
+    order, position, _ = group_index(df, series_cols)
+    history = df[history_col].to_numpy(dtype="float64")
+
+    ma_forecast = np.empty(len(df))
+    ma_forecast[order] = grouped_rolling_features(
+        history[order][:, None], position, window
+    )[0][:, 0]
+
+    return df.assign(latest_value_forecast=history, ma_forecast=ma_forecast)
+
+
+def evaluate_forecasts(df, actual_col, forecast_cols, group_cols=None):
+    """
+    Metrics of every forecast column for each group of group_cols (overall
+    without them). Returns one row per group and forecast column ("method")
+    """
+
+    codes, keys_df = group_codes(df, group_cols)
+    actual = df[actual_col].to_numpy(dtype="float64")
+
+    metrics_df = [
+        keys_df.assign(method=col).join(
+            segment_metrics(
+                actual, df[col].to_numpy(), codes, len(keys_df)
+            ).set_index(keys_df.index)
+        )
+        for col in forecast_cols
+    ]
+
+    return pd.concat(metrics_df, ignore_index=True)
@@ -1,69 +1,577 @@
 import logging
+import os
 
+import numpy as np
 import pandas as pd
 
+from scr.instrumentation import track_stage
+from scr.model_pipeline.dataset_store import get_dataset_store
+from scr.profiling import profiled
+
 logging.basicConfig(
     level=logging.INFO,
     filename="app.log",
     format="%(asctime)s - %(levelname)s - %(message)s",
 )
 
+DEFAULT_LAGS = (1, 2, 3, 4, 12)
+DEFAULT_WINDOWS = (4, 12)
+DEFAULT_EWM_SPANS = (4, 12)
+KEY_COL_LIST = ["product_category_name", "customer_city"]
+SELECTED_FEAT_LIST = [
+    "flag_approved_order_mean",
+    "daytime_in_minutes_mean",
+    "sales_amount_mean",
+    "sales_amount_sum",
+    "sales_value_sum",
+    "freight_mean",
+    "product_weight_g_mean",
+    "flag_approved_order_mean_national",
+    "flag_new_client_mean",
+    "flag_new_client_mean_national",
+    "daytime_in_minutes_mean_national",
+    "sales_amount_mean_national",
+    "freight_mean_national",
+    "product_weight_g_mean_national",
+]
+ROLLING_FEAT_LIST = [
+    "sales_amount_sum",
+    "sales_value_sum",
+    "sales_amount_mean",
+]
+SERIES_CHUNK_SIZE = int(os.getenv("SERIES_CHUNK_SIZE", "2000"))
+
+
+def lag_col_name(col, lag):
+    return f"{col}_lag" if lag == 1 else f"{col}_lag{lag}"
+
+
+def group_index(df, key_col_list):
+    """
+    Group the rows once: returns the permutation that makes every series
+    contiguous (keeping the row order inside each series), the position of
+    each sorted row inside its series and the series code of each sorted
+    row (-1 for rows with a missing key)
+    """
+
+    codes = (
+        df.groupby(key_col_list, sort=False, observed=True)
+        .ngroup()
+        .fillna(-1)
+        .to_numpy(dtype=np.int32)
+    )
+    order = np.argsort(codes, kind="stable")
+    sorted_codes = codes[order]
+
+    row_number = np.arange(len(order))
+    is_start = np.ones(len(order), dtype=bool)
+    is_start[1:] = sorted_codes[1:] != sorted_codes[:-1]
+    position = row_number - np.maximum.accumulate(
+        np.where(is_start, row_number, 0)
+    )
+
+    return order, position, sorted_codes
+
+
+def grouped_cumsum(values, position):
+    """
+    Cumulative sum restarting at every series of group-contiguous values
+    """
+
+    total = np.cumsum(values, axis=0)
+    start = np.arange(len(position)) - position
+    before_start = np.where(
+        (start > 0)[:, None], total[np.maximum(start - 1, 0)], 0
+    )
+
+    return total - before_start
+
+
+def historical_totals(values, position, initial_sum=None, initial_count=None):
+    """
+    Running sum (NaN skipped) and row count of each series up to and
+    including every row, continuing from the totals accumulated before the
+    first row of the series when `initial_sum`/`initial_count` are given
+    """
+
+    total = grouped_cumsum(np.where(np.isnan(values), 0, values), position)
+    count = (position + 1).astype("float64")
+    if initial_sum is not None:
+        start = np.arange(len(position)) - position
+        total += np.nan_to_num(initial_sum[start])
+        count += np.nan_to_num(initial_count[start])
+
+    return total, count
+
+
+def initial_totals(historical_initial, feat_list, order):
+    if historical_initial is None:
+        return None, None
+
+    return (
+        historical_initial[
+            [f"{col}_historical_sum" for col in feat_list]
+        ].to_numpy(dtype="float64")[order],
+        historical_initial["historical_count"].to_numpy(dtype="float64")[
+            order
+        ],
+    )
+
+
+# pylint: disable=too-many-locals
+@profiled
+def add_tendency_features(
+    df, feat_list, key_col_list, lags=DEFAULT_LAGS, historical_initial=None
+):
+    feat_list = list(dict.fromkeys(feat_list))
+    order, position, sorted_codes = group_index(df, key_col_list)
+    unsorted = np.empty_like(order)
+    unsorted[order] = np.arange(len(order))
+    missing_key = sorted_codes < 0
+
+    values = df[feat_list].to_numpy(dtype="float64")[order]
+
+    lagged_values = {}
+    for lag in lags:
+        lagged = np.full_like(values, np.nan)
+        lagged[lag:] = values[:-lag]
+        lagged[(position < lag) | missing_key] = np.nan
+        lagged_values[lag] = lagged[unsorted]
+
+    historical_sum, count = historical_totals(
+        values,
+        position,
+        *initial_totals(historical_initial, feat_list, order),
+    )
+    historical_mean = historical_sum / count[:, None]
+    historical_mean[np.isnan(values) | missing_key[:, None]] = np.nan
+    with np.errstate(divide="ignore", invalid="ignore"):
+        historical_diff = (values - historical_mean) / historical_mean
+    historical_mean = historical_mean[unsorted]
+    historical_diff = historical_diff[unsorted]
+
+    features = {}
+    for i, col in enumerate(feat_list):
+        for lag in lags:
+            features[lag_col_name(col, lag)] = lagged_values[lag][:, i]
+        features[f"{col}_historical_mean"] = historical_mean[:, i]
+        features[f"{col}_historical_diff"] = historical_diff[:, i]
+
+    return pd.concat(
+        [
+            df.drop(columns=list(features), errors="ignore"),
+            pd.DataFrame(features, index=df.index),
+        ],
+        axis=1,
+    )
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+def tendency_state(
+    df,
+    feat_list,
+    key_col_list,
+    lags=DEFAULT_LAGS,
+    historical_initial=None,
+    date_col="order_purchase_date",
+):
+    """
+    Last max(lags) rows of each series with the running sums and counts
+    behind the historical means: everything update_tendency_features
+    needs to process a new week
+    """
+
+    feat_list = list(dict.fromkeys(feat_list))
+    order, position, _ = group_index(df, key_col_list)
+    unsorted = np.empty_like(order)
+    unsorted[order] = np.arange(len(order))
+    values = df[feat_list].to_numpy(dtype="float64")[order]
+
+    historical_sum, count = historical_totals(
+        values,
+        position,
+        *initial_totals(historical_initial, feat_list, order),
+    )
+    state_df = pd.concat(
+        [
+            df[[*key_col_list, date_col, *feat_list]],
+            pd.DataFrame(
+                historical_sum[unsorted],
+                columns=[f"{col}_historical_sum" for col in feat_list],
+                index=df.index,
+            ),
+        ],
+        axis=1,
+    )
+    state_df["historical_count"] = count[unsorted]
+
+    return state_df.groupby(key_col_list, observed=True).tail(max(lags))
+
+
+def select_new_rows(features_df, is_new, new_df):
+    """
+    Rows of `new_df` in `features_df`, with the columns of `new_df` first
+    """
+
+    new_cols = [col for col in features_df.columns if col not in new_df]
+    return features_df.loc[is_new, [*new_df.columns, *new_cols]].reset_index(
+        drop=True
+    )
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+@profiled
+def update_tendency_features(
+    state_df,
+    new_df,
+    feat_list,
+    key_col_list,
+    lags=DEFAULT_LAGS,
+    date_col="order_purchase_date",
+):
+    """
+    Lag and historical features for newly arrived rows using only the saved
+    state instead of the whole history. Returns the new rows with their
+    features and the updated state
+    """
+
+    feat_list = list(dict.fromkeys(feat_list))
+    total_cols = [f"{col}_historical_sum" for col in feat_list]
+
+    first_df = state_df.groupby(key_col_list, observed=True).head(1)
+    before_df = first_df[key_col_list].copy()
+    for col, total_col in zip(feat_list, total_cols):
+        before_df[total_col] = first_df[total_col] - first_df[col].fillna(0)
+    before_df["historical_count"] = first_df["historical_count"] - 1
+
+    is_new = np.r_[np.zeros(len(state_df), bool), np.ones(len(new_df), bool)]
+    history_df = pd.concat(
+        [state_df.drop(columns=[*total_cols, "historical_count"]), new_df],
+        ignore_index=True,
+    )
+    historical_initial = history_df[key_col_list].merge(
+        before_df, how="left", on=key_col_list
+    )
+
+    features_df = add_tendency_features(
+        history_df, feat_list, key_col_list, lags, historical_initial
+    )
+    new_state_df = tendency_state(
+        history_df,
+        feat_list,
+        key_col_list,
+        lags,
+        historical_initial,
+        date_col,
+    )
+
+    return select_new_rows(features_df, is_new, new_df), new_state_df
+
+
+def grouped_rolling_min_max(values, position, window):
+    """
+    Rolling min and max (NaN-aware) of group-contiguous values in O(n) with
+    the van Herk/Gil-Werman block algorithm. Every series is preceded by
+    window - 1 NaN rows so that no window crosses two series
+    """
+
+    padding = window - 1
+    series_number = np.cumsum(position == 0) - 1
+    padded_row = np.arange(len(position)) + padding * (series_number + 1)
 
-def add_tendency_features(df, feat_list, key_col_list):
-    for col in feat_list:
-        df[f"{col}_lag"] = df.groupby(key_col_list)[col].shift(1)
-        df[f"{col}_lag2"] = df.groupby(key_col_list)[col].shift(2)
-        df[f"{col}_lag3"] = df.groupby(key_col_list)[col].shift(3)
-        df[f"{col}_lag4"] = df.groupby(key_col_list)[col].shift(4)
-        df[f"{col}_lag12"] = df.groupby(key_col_list)[col].shift(12)
+    num_blocks = -(-(padded_row[-1] + 1) // window) if len(position) else 0
+    padded = np.full((num_blocks * window, values.shape[1]), np.nan)
+    padded[padded_row] = values
+    blocks = padded.reshape(num_blocks, window, values.shape[1])
 
-        df[f"{col}_historical_mean"] = df.groupby(key_col_list)[col].cumsum()
-        df[f"{col}_historical_mean"] = df[f"{col}_historical_mean"] / (
-            df.groupby(key_col_list).cumcount() + 1
+    results = []
+    for func in (np.fmin, np.fmax):
+        prefix = func.accumulate(blocks, axis=1).reshape(padded.shape)
+        suffix = (func.accumulate(blocks[:, ::-1], axis=1)[:, ::-1]).reshape(
+            padded.shape
         )
-        df[f"{col}_historical_diff"] = (
-            df[col] - df[f"{col}_historical_mean"]
-        ) / df[f"{col}_historical_mean"]
+        results.append(func(suffix[padded_row - padding], prefix[padded_row]))
 
-    return df
+    return results
 
 
-if __name__ == "__main__":
-    logging.info("Reading datasets")
-    final_df = pd.read_csv("./data/processed/orders_by_week.csv")
-    national_df = pd.read_csv("./data/processed/national_orders_by_week.csv")
-
-    selected_feat_list = [
-        "flag_approved_order_mean",
-        "daytime_in_minutes_mean",
-        "sales_amount_mean",
-        "sales_amount_sum",
-        "sales_value_sum",
-        "freight_mean",
-        "product_weight_g_mean",
-        "flag_approved_order_mean",
-        "flag_approved_order_mean_national",
-        "flag_new_client_mean",
-        "flag_new_client_mean_national",
-        "daytime_in_minutes_mean_national",
-        "sales_amount_mean_national",
-        "freight_mean_national",
-        "product_weight_g_mean_national",
+def grouped_rolling_features(values, position, window):
+    """
+    Rolling mean, std, min and max over the last `window` rows of each
+    series (current row included, NaN skipped), using cumulative sums
+    """
+
+    is_valid = ~np.isnan(values)
+    clean = np.where(is_valid, values, 0)
+    row_number = np.arange(len(position))
+    window_start = row_number - np.minimum(position, window - 1)
+
+    rolling = []
+    for stat_values in (is_valid.astype("float64"), clean, clean**2):
+        total = np.cumsum(stat_values, axis=0)
+        before_start = np.where(
+            (window_start > 0)[:, None],
+            total[np.maximum(window_start - 1, 0)],
+            0,
+        )
+        rolling.append(total - before_start)
+    count, total, total_squares = rolling
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(count > 0, total / count, np.nan)
+        variance = (total_squares - count * mean**2) / (count - 1)
+    rolling_min, rolling_max = grouped_rolling_min_max(
+        values, position, window
+    )
+    # constant windows would otherwise keep the cumulative sums round-off
+    variance[rolling_min == rolling_max] = 0
+    std = np.where(count > 1, np.sqrt(np.clip(variance, 0, None)), np.nan)
+
+    return mean, std, rolling_min, rolling_max
+
+
+def grouped_ewm(values, position, span, initial=None):
+    """
+    Exponentially weighted mean of each series, equivalent to
+    ewm(span=span, adjust=False, ignore_na=True).mean(). `initial` holds,
+    for every row, the mean of the series before its first row (NaN when
+    the series starts from scratch). Loops over the positions, not rows
+    """
+
+    alpha = 2 / (span + 1)
+    ewm = np.empty_like(values)
+    if initial is None:
+        initial = np.full_like(values, np.nan)
+
+    rows_by_position = np.argsort(position, kind="stable")
+    bounds = np.searchsorted(
+        position[rows_by_position], np.arange(1, position.max(initial=0) + 1)
+    )
+    for i, rows in enumerate(np.split(rows_by_position, bounds)):
+        previous = ewm[rows - 1] if i else initial[rows]
+        current = values[rows]
+        ewm[rows] = np.where(
+            np.isnan(previous),
+            current,
+            np.where(
+                np.isnan(current),
+                previous,
+                (1 - alpha) * previous + alpha * current,
+            ),
+        )
+
+    return ewm
+
+
+def rolling_col_names(col, windows, ewm_spans):
+    names = [
+        f"{col}_rolling_{stat}{window}"
+        for window in windows
+        for stat in ("mean", "std", "min", "max")
     ]
+    return names + [f"{col}_ewm{span}" for span in ewm_spans]
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+@profiled
+def add_rolling_features(
+    df,
+    feat_list,
+    key_col_list,
+    windows=DEFAULT_WINDOWS,
+    ewm_spans=DEFAULT_EWM_SPANS,
+    ewm_initial=None,
+):
+    """
+    Rolling mean/std/min/max and exponentially weighted means of each
+    (key_col_list) series, rows in chronological order. `ewm_initial`
+    continues the EWM of series seen before (see update_rolling_features)
+    """
+
+    feat_list = list(dict.fromkeys(feat_list))
+    order, position, sorted_codes = group_index(df, key_col_list)
+    unsorted = np.empty_like(order)
+    unsorted[order] = np.arange(len(order))
+    # rows with a missing key belong to no series, as in the tendency
+    # features
+    missing_key = sorted_codes < 0
+    values = df[feat_list].to_numpy(dtype="float64")[order]
+
+    stats = {}
+    for window in windows:
+        for stat, stat_values in zip(
+            ("mean", "std", "min", "max"),
+            grouped_rolling_features(values, position, window),
+        ):
+            stat_values[missing_key] = np.nan
+            stats[f"rolling_{stat}{window}"] = stat_values[unsorted]
+    for span in ewm_spans:
+        initial = None
+        if ewm_initial is not None:
+            initial = ewm_initial[
+                [f"{col}_ewm{span}" for col in feat_list]
+            ].to_numpy(dtype="float64")[order]
+        ewm = grouped_ewm(values, position, span, initial)
+        ewm[missing_key] = np.nan
+        stats[f"ewm{span}"] = ewm[unsorted]
+
+    features = {}
+    for i, col in enumerate(feat_list):
+        for name in rolling_col_names("", windows, ewm_spans):
+            features[f"{col}{name}"] = stats[name[1:]][:, i]
+
+    return pd.concat(
+        [
+            df.drop(columns=list(features), errors="ignore"),
+            pd.DataFrame(features, index=df.index),
+        ],
+        axis=1,
+    )
+
+
+def rolling_state(df, feat_list, key_col_list, windows=DEFAULT_WINDOWS):
+    """
+    Last max(windows) - 1 rows of each series, with their EWM columns:
+    everything update_rolling_features needs to process a new week
+    """
+
+    ewm_cols = [col for col in df.columns if "_ewm" in col]
+    tail_size = max(windows) - 1
+    state_df = df.groupby(key_col_list, observed=True).tail(tail_size)
+
+    return state_df[[*key_col_list, *dict.fromkeys(feat_list), *ewm_cols]]
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+@profiled
+def update_rolling_features(
+    state_df,
+    new_df,
+    feat_list,
+    key_col_list,
+    windows=DEFAULT_WINDOWS,
+    ewm_spans=DEFAULT_EWM_SPANS,
+):
+    """
+    Rolling and EWM features for newly arrived rows using only the saved
+    state instead of the whole history. Returns the new rows with their
+    features and the updated state
+    """
 
-    logging.info("Add historical features")
-    final_df = final_df.sort_values("order_purchase_date")
-    final_df = final_df.merge(
+    feat_list = list(dict.fromkeys(feat_list))
+    ewm_cols = [col for col in state_df.columns if "_ewm" in col]
+    last_ewm = state_df.groupby(key_col_list, observed=True)[ewm_cols].last()
+    is_new = np.r_[np.zeros(len(state_df), bool), np.ones(len(new_df), bool)]
+    history_df = pd.concat(
+        [state_df.drop(columns=ewm_cols), new_df], ignore_index=True
+    )
+
+    history_df = add_rolling_features(
+        history_df, feat_list, key_col_list, windows, ewm_spans=()
+    )
+    new_features_df = add_rolling_features(
+        select_new_rows(history_df, is_new, new_df),
+        feat_list,
+        key_col_list,
+        windows=(),
+        ewm_spans=ewm_spans,
+        ewm_initial=new_df[key_col_list].merge(
+            last_ewm, how="left", left_on=key_col_list, right_index=True
+        ),
+    )
+    new_features_df = new_features_df[
+        [
+            *new_df.columns,
+            *(
+                f"{col}{name}"
+                for col in feat_list
+                for name in rolling_col_names("", windows, ewm_spans)
+            ),
+        ]
+    ]
+
+    new_state_df = rolling_state(
+        pd.concat([state_df, new_features_df], ignore_index=True),
+        feat_list,
+        key_col_list,
+        windows,
+    )
+
+    return new_features_df, new_state_df
+
+
+@profiled
+def merge_national(final_df, national_df):
+    return final_df.sort_values("order_purchase_date").merge(
         national_df,
         how="left",
         on=["order_purchase_date", "product_category_name"],
         suffixes=("", "_national"),
     )
-    final_df = add_tendency_features(
-        final_df,
-        feat_list=selected_feat_list,
-        key_col_list=["product_category_name", "customer_city"],
+
+
+def series_chunks(df, key_col_list, chunk_size):
+    """
+    Row positions of df split in chunks of at most chunk_size series, every
+    series being in a single chunk
+    """
+
+    chunk_ids = (
+        df.groupby(key_col_list, sort=False, observed=True)
+        .ngroup()
+        .fillna(-1)
+        .to_numpy(dtype=np.int32)
+        // chunk_size
+    )
+    order = np.argsort(chunk_ids, kind="stable")
+    bounds = np.searchsorted(
+        chunk_ids[order], np.arange(1, chunk_ids.max(initial=0) + 1)
     )
 
-    logging.info("Write datasets")
-    final_df.to_csv("./data/processed/model_data.csv", index=False)
+    return np.split(order, bounds)
+
+
+@profiled
+def build_model_data(store, series_chunk_size=SERIES_CHUNK_SIZE):
+    """
+    Features of every series written to model_data, with their states. The
+    series are processed by chunks, so memory is bound by the chunk size
+    and not by the number of series
+    """
+
+    final_df = store.read("orders_by_week")
+    national_df = store.read("national_orders_by_week")
+
+    tendency_states, rolling_states = [], []
+    for number, rows in enumerate(
+        series_chunks(final_df, KEY_COL_LIST, series_chunk_size)
+    ):
+        logging.info("Add features of series chunk %s", number)
+        chunk_df = merge_national(final_df.iloc[rows], national_df)
+        chunk_df = add_tendency_features(
+            chunk_df, feat_list=SELECTED_FEAT_LIST, key_col_list=KEY_COL_LIST
+        )
+        chunk_df = add_rolling_features(
+            chunk_df, feat_list=ROLLING_FEAT_LIST, key_col_list=KEY_COL_LIST
+        )
+
+        if number:
+            store.append(chunk_df, "model_data")
+        else:
+            store.write(chunk_df, "model_data")
+        tendency_states.append(
+            tendency_state(chunk_df, SELECTED_FEAT_LIST, KEY_COL_LIST)
+        )
+        rolling_states.append(
+            rolling_state(chunk_df, ROLLING_FEAT_LIST, KEY_COL_LIST)
+        )
+
+    store.write(
+        pd.concat(tendency_states, ignore_index=True), "state/tendency"
+    )
+    store.write(pd.concat(rolling_states, ignore_index=True), "state/rolling")
+
+
+if __name__ == "__main__":
+    with track_stage("feature_engineering"):
+        build_model_data(get_dataset_store())
@@ -0,0 +1,244 @@
+import json
+import logging
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+
+from scr.instrumentation import track_stage
+from scr.model_pipeline.dataset_store import (
+    DEFAULT_FORMAT,
+    DEFAULT_ROOT,
+    get_dataset_store,
+)
+from scr.profiling import profiled
+
+logging.basicConfig(
+    level=logging.INFO,
+    filename="app.log",
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+TEXT_COLS = ["product_category_name", "customer_state", "customer_city"]
+EPOCH_MONDAY = np.datetime64("1970-01-05", "D")
+OBJECT_INPUT_MAX_ROWS = 128
+
+
+def week_numbers(dates):
+    """
+    Weeks since 1970-01-05 (a monday): every day of a week has the number
+    of its monday
+    """
+
+    days = np.asarray(dates, dtype="datetime64[D]") - EPOCH_MONDAY
+    return days.astype(np.int64) // 7
+
+
+def lookup_keys(series_codes, weeks):
+    """
+    Sortable int64 key of (series, week): series code in the high bits
+    """
+
+    return (np.asarray(series_codes, dtype=np.int64) << 32) | np.asarray(
+        weeks, dtype=np.int64
+    )
+
+
+# pylint: disable=too-many-locals
+@profiled
+def export_feature_store(store, out_dir, columns_per_read=32):
+    """
+    Write the model_data features as a float32 matrix (features.npy) sorted
+    by (category, city, week) key, with the sorted keys (keys.npy), the
+    state of each row (states.npy) and the vocabularies (manifest.json).
+    A city name present in several states keeps the series with the most
+    sales of the week. Features are read a few columns at a time
+    """
+
+    key_df = store.read(
+        "model_data",
+        columns=["order_purchase_date", *TEXT_COLS, "sales_amount_sum"],
+    )
+    categories = sorted(key_df["product_category_name"].astype(str).unique())
+    cities = sorted(key_df["customer_city"].astype(str).unique())
+    states = sorted(key_df["customer_state"].astype(str).unique())
+    category_codes = pd.Categorical(
+        key_df["product_category_name"].astype(str), categories=categories
+    ).codes
+    city_codes = pd.Categorical(
+        key_df["customer_city"].astype(str), categories=cities
+    ).codes
+    keys = lookup_keys(
+        category_codes.astype(np.int64) * len(cities) + city_codes,
+        week_numbers(key_df["order_purchase_date"]),
+    )
+
+    # by key, the most sales first, then the first row of each key
+    order = np.lexsort((-key_df["sales_amount_sum"].to_numpy(), keys))
+    order = order[np.r_[True, keys[order][1:] != keys[order][:-1]]]
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    np.save(out_dir / "keys.npy", keys[order])
+    np.save(
+        out_dir / "states.npy",
+        pd.Categorical(key_df["customer_state"].astype(str), states)
+        .codes[order]
+        .astype(np.int16),
+    )
+
+    feature_cols = [
+        col
+        for col in store.columns("model_data")
+        if col not in ["order_purchase_date", *TEXT_COLS]
+    ]
+    features = np.lib.format.open_memmap(
+        out_dir / "features.npy",
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(order), len(feature_cols)),
+    )
+    for first_col in range(0, len(feature_cols), columns_per_read):
+        read_cols = feature_cols[first_col:][:columns_per_read]
+        last_col = first_col + len(read_cols)
+        features[:, first_col:last_col] = store.read(
+            "model_data", columns=read_cols
+        ).to_numpy(dtype=np.float32)[order]
+    features.flush()
+
+    with open(out_dir / "manifest.json", "w", encoding="utf-8") as file:
+        json.dump(
+            {
+                "feature_cols": feature_cols,
+                "categories": categories,
+                "cities": cities,
+                "states": states,
+            },
+            file,
+        )
+    logging.info(
+        "Feature store of %s rows written to %s", len(order), out_dir
+    )
+
+
+class FeatureStore:
+    """
+    Read side of the feature store: the keys and vocabularies are in
+    memory, the feature matrix is memory-mapped and only the rows of the
+    requested keys are read
+    """
+
+    def __init__(self, store_dir):
+        store_dir = Path(store_dir)
+        with open(store_dir / "manifest.json", encoding="utf-8") as file:
+            manifest = json.load(file)
+        self.feature_cols = manifest["feature_cols"]
+        self.category_index = {
+            category: code
+            for code, category in enumerate(manifest["categories"])
+        }
+        self.city_index = {
+            city: code for code, city in enumerate(manifest["cities"])
+        }
+        self.states = np.array(manifest["states"], dtype=object)
+        self.keys = np.load(store_dir / "keys.npy")
+        self.state_codes = np.load(store_dir / "states.npy")
+        self.features = np.load(store_dir / "features.npy", mmap_mode="r")
+
+    def find_rows(self, categories, cities, dates):
+        """
+        Row of each (category, city, date) key, -1 for unknown keys. Any
+        date of a week finds the row of that week
+        """
+
+        category_codes = np.array(
+            [
+                self.category_index.get(category, -1)
+                for category in categories
+            ],
+            dtype=np.int64,
+        )
+        city_codes = np.array(
+            [self.city_index.get(city, -1) for city in cities], dtype=np.int64
+        )
+        is_known = (category_codes >= 0) & (city_codes >= 0)
+        keys = lookup_keys(
+            np.where(
+                is_known,
+                category_codes * len(self.city_index) + city_codes,
+                0,
+            ),
+            week_numbers(dates),
+        )
+        rows = np.minimum(
+            np.searchsorted(self.keys, keys), len(self.keys) - 1
+        )
+        is_found = is_known & (self.keys[rows] == keys)
+
+        return np.where(is_found, rows, -1)
+
+    def model_input(self, rows, categories, cities, feature_names):
+        """
+        Features of the given rows (all found) in the order of the model
+        features, the text features from the request keys and the stored
+        states
+        """
+
+        text_values = {
+            "product_category_name": np.asarray(categories, dtype=object),
+            "customer_city": np.asarray(cities, dtype=object),
+            "customer_state": self.states[self.state_codes[rows]],
+        }
+        col_index = {col: i for i, col in enumerate(self.feature_cols)}
+        features = self.features[rows]
+        # CatBoost predicts small batches faster from an object array and
+        # large ones faster from a DataFrame
+        if len(rows) <= OBJECT_INPUT_MAX_ROWS:
+            model_input = np.empty((len(rows), len(feature_names)), object)
+            for position, name in enumerate(feature_names):
+                model_input[:, position] = (
+                    text_values[name]
+                    if name in text_values
+                    else features[:, col_index[name]]
+                )
+            return model_input
+
+        return pd.DataFrame(
+            {
+                name: (
+                    text_values[name]
+                    if name in text_values
+                    else features[:, col_index[name]]
+                )
+                for name in feature_names
+            }
+        )
+
+
+@click.command()
+@click.option(
+    "--source-path",
+    default=DEFAULT_ROOT,
+    help="Location where the processed datasets were saved",
+)
+@click.option(
+    "--storage-format",
+    default=DEFAULT_FORMAT,
+    help="Format of the processed datasets (parquet or csv)",
+)
+@click.option(
+    "--out-dir",
+    default=f"{DEFAULT_ROOT}feature_store",
+    help="Location where the feature store is written",
+)
+@track_stage("feature_store_export")
+def run_export(source_path: str, storage_format: str, out_dir: str):
+
+    export_feature_store(
+        get_dataset_store(source_path, storage_format), out_dir
+    )
+
+
+if __name__ == "__main__":
+    run_export()
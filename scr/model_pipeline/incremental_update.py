@@ -0,0 +1,192 @@
+import logging
+import os
+
+import click
+import pandas as pd
+
+from scr.instrumentation import track_stage
+from scr.model_pipeline.data_preparation import (
+    CLIENT_KEY_COLS,
+    HOLIDAY_CALENDARS,
+    RAW_PATH,
+    SERIES_KEY_COLS,
+    add_order_features,
+    aggregate_weekly,
+    avoid_gap_dates,
+    join_orders,
+)
+from scr.model_pipeline.dataset_store import (
+    DEFAULT_FORMAT,
+    DEFAULT_ROOT,
+    get_dataset_store,
+)
+from scr.model_pipeline.feature_engineering import (
+    KEY_COL_LIST,
+    ROLLING_FEAT_LIST,
+    SELECTED_FEAT_LIST,
+    merge_national,
+    update_rolling_features,
+    update_tendency_features,
+)
+from scr.model_pipeline.streaming_ingestion import ITEM_DTYPES, ORDER_DTYPES
+
+logging.basicConfig(
+    level=logging.INFO,
+    filename="app.log",
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+RAW_CHUNK_SIZE = 200_000
+
+
+def read_filtered_csv(path, keep_rows, chunksize, **read_csv_args):
+    """
+    Rows of a CSV selected by keep_rows(chunk), read by chunks so that
+    only the selected rows are kept in memory
+    """
+
+    return pd.concat(
+        [
+            chunk[keep_rows(chunk)]
+            for chunk in pd.read_csv(
+                path, chunksize=chunksize, **read_csv_args
+            )
+        ],
+        ignore_index=True,
+    )
+
+
+def read_week_raw_datasets(raw_path, week_start, chunksize=RAW_CHUNK_SIZE):
+    """
+    Raw tables restricted to the orders purchased in the week starting at
+    `week_start`, with their items and customers. The orders, items and
+    customers files are read by chunks and only the rows of the week are
+    kept; products are a lookup and are read whole
+    """
+
+    def in_week(chunk):
+        purchase = pd.to_datetime(chunk["order_purchase_timestamp"])
+        return (purchase >= week_start) & (
+            purchase < week_start + pd.Timedelta(7, "D")
+        )
+
+    orders_df = read_filtered_csv(
+        f"{raw_path}olist_orders_dataset.csv",
+        in_week,
+        chunksize,
+        usecols=list(ORDER_DTYPES),
+        dtype=ORDER_DTYPES,
+    )
+    order_items_df = read_filtered_csv(
+        f"{raw_path}olist_order_items_dataset.csv",
+        lambda chunk: chunk["order_id"].isin(orders_df["order_id"]),
+        chunksize,
+        usecols=list(ITEM_DTYPES),
+        dtype=ITEM_DTYPES,
+    )
+    customers_df = read_filtered_csv(
+        f"{raw_path}olist_customers_dataset.csv",
+        lambda chunk: chunk["customer_id"].isin(orders_df["customer_id"]),
+        chunksize,
+        usecols=["customer_id", "customer_city", "customer_state"],
+    )
+    products_df = pd.read_csv(
+        f"{raw_path}olist_products_dataset.csv",
+        usecols=["product_id", "product_category_name", "product_weight_g"],
+    )
+
+    return orders_df, order_items_df, products_df, customers_df
+
+
+# pylint: disable=too-many-locals
+@click.command()
+@click.option(
+    "--week",
+    required=True,
+    help="Monday of the week of orders to ingest",
+)
+@click.option(
+    "--raw-path",
+    default=RAW_PATH,
+    help="Location of the raw Olist datasets",
+)
+@click.option(
+    "--source-path",
+    default=DEFAULT_ROOT,
+    help="Location where the processed datasets were saved",
+)
+@click.option(
+    "--storage-format",
+    default=DEFAULT_FORMAT,
+    help="Format of the processed datasets (parquet or csv)",
+)
+@track_stage("incremental_update")
+def run_incremental_update(
+    week: str, raw_path: str, source_path: str, storage_format: str
+):
+
+    week_start = pd.Timestamp(week)
+    if week_start.weekday() != 0:
+        raise click.BadParameter(f"{week} is not a monday", param_hint="week")
+
+    store = get_dataset_store(source_path, storage_format)
+    tendency_state_df = store.read("state/tendency")
+    rolling_state_df = store.read("state/rolling")
+    if tendency_state_df["order_purchase_date"].max() >= week_start:
+        raise click.BadParameter(
+            f"week {week} was already processed", param_hint="week"
+        )
+
+    logging.info("Reading orders of week %s", week)
+    joined_df = join_orders(*read_week_raw_datasets(raw_path, week_start))
+    # only the clients of the week can be seen before
+    seen_clients_df = None
+    if len(joined_df):
+        seen_clients_df = store.read(
+            "state/seen_clients",
+            isin={"customer_id": joined_df["customer_id"].unique()},
+        )
+
+    logging.info("Add new features")
+    holiday_cal = HOLIDAY_CALENDARS[os.getenv("HOLIDAY_CALENDAR", "brazil")]
+    joined_df = add_order_features(
+        joined_df, cal=holiday_cal(), seen_clients_df=seen_clients_df
+    )
+
+    logging.info("Aggregate week")
+    # the weeks come from --week, as a week may have no orders
+    national_df, final_df = aggregate_weekly(joined_df, dates=[week_start])
+    final_df = avoid_gap_dates(
+        final_df,
+        "order_purchase_date",
+        SERIES_KEY_COLS,
+        dates=[week_start],
+        series_df=store.read(
+            "orders_by_week",
+            columns=SERIES_KEY_COLS,
+            start_date=tendency_state_df["order_purchase_date"].max(),
+        ),
+    )
+    week_df = merge_national(final_df, national_df)
+
+    logging.info("Update historical and rolling features")
+    week_df, tendency_state_df = update_tendency_features(
+        tendency_state_df, week_df, SELECTED_FEAT_LIST, KEY_COL_LIST
+    )
+    week_df, rolling_state_df = update_rolling_features(
+        rolling_state_df, week_df, ROLLING_FEAT_LIST, KEY_COL_LIST
+    )
+
+    logging.info("Write datasets")
+    store.append(national_df, "national_orders_by_week")
+    store.append(final_df, "orders_by_week")
+    store.append(week_df, "model_data")
+    store.append(
+        joined_df[CLIENT_KEY_COLS].drop_duplicates(), "state/seen_clients"
+    )
+    store.write(tendency_state_df, "state/tendency")
+    store.write(rolling_state_df, "state/rolling")
+
+
+if __name__ == "__main__":
+    run_incremental_update()
@@ -0,0 +1,244 @@
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import click
+import pandas as pd
+from catboost import CatBoostRegressor
+
+import mlflow
+from scr.instrumentation import track_stage
+from scr.model_pipeline.dataset_store import (
+    DEFAULT_FORMAT,
+    DEFAULT_ROOT,
+    get_dataset_store,
+)
+from scr.model_pipeline.evaluation import (
+    BASELINE_METHODS,
+    add_baseline_forecasts,
+    evaluate_forecasts,
+)
+from scr.model_pipeline.temporal_target_and_split import SERIES_COLS
+from scr.profiling import profiled
+
+logging.basicConfig(
+    level=logging.INFO,
+    filename="app.log",
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+mlflow.set_tracking_uri("sqlite:///mlflow.db")
+mlflow.set_experiment("ecommerce_forecast")
+
+BASELINE_COL = "sales_amount_sum"
+SPLIT_DATA = {}
+
+
+@profiled
+def load_split_data(source_path, storage_format, split_data):
+    """
+    Read a multi-horizon split (one y column per horizon) once per process,
+    with the baselines of the validation rows. Used as the initializer of
+    the pool workers
+    """
+
+    store = get_dataset_store(source_path, storage_format)
+    x_train = store.read(f"{split_data}/x_train").drop(
+        "order_purchase_date", axis=1
+    )
+    x_val = store.read(f"{split_data}/x_val")
+    eval_df = add_baseline_forecasts(
+        x_val[["order_purchase_date", *SERIES_COLS, BASELINE_COL]],
+        BASELINE_COL,
+        SERIES_COLS,
+    )
+
+    SPLIT_DATA.update(
+        x_train=x_train,
+        y_train=store.read(f"{split_data}/y_train"),
+        x_val=x_val.drop("order_purchase_date", axis=1),
+        y_val=store.read(f"{split_data}/y_val"),
+        eval_df=eval_df,
+        cat_cols=list(x_train.select_dtypes(["object", "category"]).columns),
+    )
+
+
+@profiled
+def fit_horizon_model(target_col, params, thread_count, model_dir):
+    """
+    Direct strategy: a model of a single horizon, trained on the rows with a
+    target at that horizon. Returns the path of the saved model
+    """
+
+    y_train = SPLIT_DATA["y_train"][target_col]
+    has_target = y_train.notna().to_numpy()
+
+    model = CatBoostRegressor(
+        **params,
+        cat_features=SPLIT_DATA["cat_cols"],
+        thread_count=thread_count,
+        verbose=0,
+    )
+    model.fit(SPLIT_DATA["x_train"][has_target], y_train[has_target])
+    model_path = Path(model_dir) / f"{target_col}.cb"
+    model.save_model(model_path)
+
+    return str(model_path)
+
+
+@profiled
+def fit_multi_output_model(params, thread_count, model_dir):
+    """
+    A single MultiRMSE model of every horizon, trained on the rows with all
+    their targets. Returns the path of the saved model
+    """
+
+    y_train = SPLIT_DATA["y_train"]
+    has_targets = y_train.notna().all(axis=1).to_numpy()
+
+    model = CatBoostRegressor(
+        **params,
+        loss_function="MultiRMSE",
+        cat_features=SPLIT_DATA["cat_cols"],
+        thread_count=thread_count,
+        verbose=0,
+    )
+    model.fit(SPLIT_DATA["x_train"][has_targets], y_train[has_targets])
+    model_path = Path(model_dir) / "multi_horizon.cb"
+    model.save_model(model_path)
+
+    return str(model_path)
+
+
+def horizon_metrics(predictions_df):
+    """
+    Metrics of the forecast and the baselines at every horizon, from the
+    validation predictions (one column per target column)
+    """
+
+    y_val = SPLIT_DATA["y_val"]
+    metrics_df = [
+        evaluate_forecasts(
+            SPLIT_DATA["eval_df"].assign(
+                actual_value=y_val[target_col].to_numpy(),
+                forecast=predictions_df[target_col].to_numpy(),
+            ),
+            "actual_value",
+            ["forecast", *BASELINE_METHODS],
+        ).assign(target=target_col)
+        for target_col in y_val.columns
+    ]
+
+    return pd.concat(metrics_df, ignore_index=True)
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+# pylint: disable=too-many-locals
+@click.command()
+@click.option(
+    "--source-path",
+    default=DEFAULT_ROOT,
+    help="Location where the processed datasets were saved",
+)
+@click.option(
+    "--storage-format",
+    default=DEFAULT_FORMAT,
+    help="Format of the processed datasets (parquet or csv)",
+)
+@click.option(
+    "--split-data",
+    default="2018-05-01",
+    help="Split date of a split made with --max-horizon",
+)
+@click.option(
+    "--strategy",
+    default="direct",
+    type=click.Choice(["direct", "multirmse"]),
+    help="One model per horizon (direct) or a single MultiRMSE model",
+)
+@click.option(
+    "--depth",
+    default=6,
+    help="CatBoost depth of the models",
+)
+@click.option(
+    "--iterations",
+    default=200,
+    help="CatBoost iterations of the models",
+)
+@click.option(
+    "--workers",
+    default=1,
+    help="Number of horizon models trained in parallel (direct strategy)",
+)
+@track_stage("multi_horizon")
+def run_multi_horizon_training(
+    source_path: str,
+    storage_format: str,
+    split_data: str,
+    strategy: str,
+    depth: int,
+    iterations: int,
+    workers: int,
+):
+
+    data_args = (source_path, storage_format, split_data)
+    load_split_data(*data_args)
+    target_cols = list(SPLIT_DATA["y_train"].columns)
+    params = {"depth": depth, "iterations": iterations, "random_seed": 56}
+    logging.info("Training %s on %s", strategy, target_cols)
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        if strategy == "multirmse":
+            model = CatBoostRegressor().load_model(
+                fit_multi_output_model(params, os.cpu_count(), model_dir)
+            )
+            models = {"model": model}
+            predictions_df = pd.DataFrame(
+                model.predict(SPLIT_DATA["x_val"]), columns=target_cols
+            )
+        else:
+            fit_model = partial(
+                fit_horizon_model,
+                params=params,
+                thread_count=max(1, (os.cpu_count() or 1) // workers),
+                model_dir=model_dir,
+            )
+            if workers > 1:
+                with ProcessPoolExecutor(
+                    workers, initializer=load_split_data, initargs=data_args
+                ) as pool:
+                    model_paths = list(pool.map(fit_model, target_cols))
+            else:
+                model_paths = list(map(fit_model, target_cols))
+            models = {
+                f"model_{target_col}": CatBoostRegressor().load_model(path)
+                for target_col, path in zip(target_cols, model_paths)
+            }
+            predictions_df = pd.DataFrame(
+                {
+                    target_col: model.predict(SPLIT_DATA["x_val"])
+                    for target_col, model in zip(target_cols, models.values())
+                }
+            )
+
+    metrics_df = horizon_metrics(predictions_df.round())
+    store = get_dataset_store(source_path, storage_format)
+    store.write(metrics_df, f"{split_data}/multi_horizon_metrics")
+
+    with mlflow.start_run(run_name=f"catboost_{strategy}_{split_data}"):
+        mlflow.log_params({**params, "strategy": strategy})
+        for row in metrics_df[
+            metrics_df["method"] == "forecast"
+        ].itertuples():
+            mlflow.log_metric(f"rmse_{row.target}", row.rmse)
+            mlflow.log_metric(f"mape_{row.target}", row.mape)
+        for name, model in models.items():
+            mlflow.catboost.log_model(model, name=name)
+
+
+if __name__ == "__main__":
+    run_multi_horizon_training()
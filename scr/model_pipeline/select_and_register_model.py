@@ -1,6 +1,8 @@
 import logging
 
 import mlflow
+from scr.instrumentation import track_stage
+from scr.model_cache import write_cache_entry
 
 logging.basicConfig(
     level=logging.INFO,
@@ -37,12 +39,22 @@ def load_best_model():
     #     dst_path="final_model",
     # )
 
-    mlflow.register_model(best_model_uri, "ecommerce_forecast")
+    model_version = mlflow.register_model(
+        best_model_uri, "ecommerce_forecast"
+    )
 
     client.transition_model_version_stage(
-        name="ecommerce_forecast", version=1, stage="Production"
+        name="ecommerce_forecast",
+        version=model_version.version,
+        stage="Production",
+    )
+
+    # native model and feature schema for a fast start of the API
+    write_cache_entry(
+        mlflow.catboost.load_model(best_model_uri), model_version.version
     )
 
 
 if __name__ == "__main__":
-    load_best_model()
+    with track_stage("select_and_register_model"):
+        load_best_model()
@@ -0,0 +1,437 @@
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+import click
+import pandas as pd
+
+from scr.instrumentation import track_stage
+from scr.model_pipeline.data_preparation import (
+    CLIENT_KEY_COLS,
+    FIRST_MONTH,
+    HOLIDAY_CALENDARS,
+    LAST_MONTH,
+    RAW_PATH,
+    SERIES_KEY_COLS,
+    SERIES_SCOPE,
+    SERIES_SCOPES,
+    WEEKLY_AGGREGATIONS,
+    add_holidays,
+    add_temporal_features,
+    add_timestamp_features,
+    avoid_gap_dates,
+    detect_new_clients,
+    filter_products_and_cities,
+)
+from scr.model_pipeline.dataset_store import (
+    DEFAULT_FORMAT,
+    DEFAULT_ROOT,
+    get_dataset_store,
+)
+from scr.profiling import profiled
+
+logging.basicConfig(
+    level=logging.INFO,
+    filename="app.log",
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+NATIONAL_KEY_COLS = ["order_purchase_date", "product_category_name"]
+CITY_KEY_COLS = [
+    "order_purchase_date",
+    "product_category_name",
+    "customer_state",
+    "customer_city",
+]
+ORDER_DTYPES = {
+    "order_id": "object",
+    "customer_id": "object",
+    "order_status": "category",
+    "order_purchase_timestamp": "object",
+}
+ITEM_DTYPES = {
+    "order_id": "object",
+    "product_id": "object",
+    "price": "float64",
+    "freight_value": "float64",
+}
+COMPACT_DTYPES = {
+    "year": "int16",
+    "month": "int8",
+    "day_of_month": "int8",
+    "flag_holiday": "int8",
+    "flag_approved_order": "int8",
+    "daytime_in_minutes": "int16",
+}
+# Pieces of each WEEKLY_AGGREGATIONS statistic that can be merged between
+# chunks. Medians are rebuilt from value counts instead
+PARTIAL_STATS = {
+    "min": ("min",),
+    "max": ("max",),
+    "sum": ("sum",),
+    "mean": ("sum", "count"),
+    "median": (),
+}
+MERGE_STATS = {"min": "min", "max": "max", "sum": "sum", "count": "sum"}
+
+
+def aggregation_items():
+    for col, stats in WEEKLY_AGGREGATIONS.items():
+        for stat in [stats] if isinstance(stats, str) else stats:
+            yield col, stat
+
+
+def load_lookups(raw_path):
+    """
+    Products and customers indexed by id, with categorical city, state
+    and category
+    """
+
+    products_df = pd.read_csv(
+        f"{raw_path}olist_products_dataset.csv",
+        usecols=["product_id", "product_category_name", "product_weight_g"],
+        dtype={"product_category_name": "category"},
+    ).set_index("product_id")
+    customers_df = pd.read_csv(
+        f"{raw_path}olist_customers_dataset.csv",
+        usecols=["customer_id", "customer_city", "customer_state"],
+        dtype={"customer_city": "category", "customer_state": "category"},
+    ).set_index("customer_id")
+
+    return products_df, customers_df
+
+
+def write_partitions(df, key_col, path, chunk_number, num_partitions):
+    """
+    Spool the rows of a chunk into `num_partitions` directories by the hash
+    of `key_col`, so that all the rows of a key end up in one partition
+    """
+
+    partition = pd.util.hash_array(df[key_col].to_numpy()) % num_partitions
+    for number, part_df in df.groupby(partition):
+        part_path = path / f"p{number:03d}"
+        part_path.mkdir(parents=True, exist_ok=True)
+        part_df.to_parquet(
+            part_path / f"part-{chunk_number:05d}.parquet", index=False
+        )
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+@profiled
+def spool_orders(
+    raw_path, spool_path, customers_df, cal, chunksize, num_partitions
+):
+    orders = pd.read_csv(
+        f"{raw_path}olist_orders_dataset.csv",
+        usecols=list(ORDER_DTYPES),
+        dtype=ORDER_DTYPES,
+        chunksize=chunksize,
+    )
+    for chunk_number, chunk in enumerate(orders):
+        chunk = add_timestamp_features(chunk, "order_purchase_timestamp")
+        chunk = chunk[
+            (chunk["order_purchase_month"] >= pd.to_datetime(FIRST_MONTH))
+            & (chunk["order_purchase_month"] <= pd.to_datetime(LAST_MONTH))
+        ].copy()
+        chunk["flag_approved_order"] = ~chunk["order_status"].isin(
+            ["unavailable", "canceled"]
+        )
+        chunk = add_temporal_features(
+            chunk, date_col="order_purchase_original_date"
+        )
+        chunk = add_holidays(chunk, cal=cal)
+
+        customers = customers_df.reindex(chunk["customer_id"])
+        chunk["customer_city"] = customers["customer_city"].array
+        chunk["customer_state"] = customers["customer_state"].array
+
+        write_partitions(
+            chunk[
+                [
+                    "order_id",
+                    "customer_id",
+                    "customer_city",
+                    "customer_state",
+                    "order_purchase_date",
+                    "order_purchase_original_date",
+                    *COMPACT_DTYPES,
+                ]
+            ].astype(COMPACT_DTYPES),
+            "order_id",
+            spool_path / "orders",
+            chunk_number,
+            num_partitions,
+        )
+
+
+@profiled
+def spool_items(raw_path, spool_path, chunksize, num_partitions):
+    items = pd.read_csv(
+        f"{raw_path}olist_order_items_dataset.csv",
+        usecols=list(ITEM_DTYPES),
+        dtype=ITEM_DTYPES,
+        chunksize=chunksize,
+    )
+    for chunk_number, chunk in enumerate(items):
+        write_partitions(
+            chunk,
+            "order_id",
+            spool_path / "items",
+            chunk_number,
+            num_partitions,
+        )
+
+
+@profiled
+def join_partition(spool_path, partition, products_df):
+    """
+    Orders of one partition joined to their items and products. Every
+    item of an order lives in the same partition as the order
+    """
+
+    orders_df = pd.read_parquet(spool_path / "orders" / partition)
+    items_path = spool_path / "items" / partition
+    items_df = (
+        pd.read_parquet(items_path)
+        if items_path.exists()
+        else pd.DataFrame(columns=list(ITEM_DTYPES)).astype(ITEM_DTYPES)
+    )
+
+    items_df = (
+        items_df.groupby(["order_id", "product_id"])
+        .agg(
+            sales_amount=("price", "count"),
+            sales_value=("price", "sum"),
+            freight=("freight_value", "sum"),
+        )
+        .reset_index()
+    )
+    joined_df = orders_df.merge(items_df, how="left", on=["order_id"])
+    products = products_df.reindex(joined_df["product_id"])
+    joined_df["product_category_name"] = products[
+        "product_category_name"
+    ].array
+    joined_df["product_weight_g"] = products["product_weight_g"].to_numpy()
+
+    return joined_df.drop(columns=["order_id", "product_id"])
+
+
+def partial_aggregates(df, key_cols):
+    """
+    Mergeable pieces of WEEKLY_AGGREGATIONS by group: sums, counts, mins
+    and maxes, plus the value counts of the columns aggregated by median
+    """
+
+    spec = {}
+    for col, stat in aggregation_items():
+        for partial_stat in PARTIAL_STATS[stat]:
+            spec.setdefault(f"{col}_{partial_stat}", (col, partial_stat))
+
+    value_counts = {
+        col: df.groupby([*key_cols, col], observed=True).size()
+        for col, stat in aggregation_items()
+        if stat == "median"
+    }
+
+    return df.groupby(key_cols, observed=True).agg(**spec), value_counts
+
+
+def merge_partials(partials, other):
+    if partials is None:
+        return other
+
+    partial_df = pd.concat([partials[0], other[0]])
+    partial_df = partial_df.groupby(
+        level=list(range(partial_df.index.nlevels)), observed=True
+    ).agg({col: MERGE_STATS[col.rsplit("_", 1)[1]] for col in partial_df})
+
+    value_counts = {}
+    for col, counts in partials[1].items():
+        counts = pd.concat([counts, other[1][col]])
+        value_counts[col] = counts.groupby(
+            level=list(range(counts.index.nlevels)), observed=True
+        ).sum()
+
+    return partial_df, value_counts
+
+
+def median_from_counts(counts):
+    """
+    Median by group from a Series of value counts indexed by
+    (*group keys, value)
+    """
+
+    key_levels = list(range(counts.index.nlevels - 1))
+    counts = counts.sort_index()
+    cumulative = counts.groupby(level=key_levels, observed=True).cumsum()
+    total = counts.groupby(level=key_levels, observed=True).transform("sum")
+    value = counts.index.get_level_values(-1).to_series(index=counts.index)
+
+    middle = pd.DataFrame(
+        {
+            "lower": value.where(cumulative > (total - 1) // 2),
+            "upper": value.where(cumulative > total // 2),
+        }
+    ).groupby(level=key_levels, observed=True)
+
+    return (middle["lower"].first() + middle["upper"].first()) / 2
+
+
+def finalize_aggregates(partials):
+    """
+    Same columns as aggregate_cols_by_dates, built from merged partials
+    """
+
+    partial_df, value_counts = partials
+    final_df = pd.DataFrame(index=partial_df.index)
+    for col, stat in aggregation_items():
+        if stat == "mean":
+            count = partial_df[f"{col}_count"]
+            final_df[f"{col}_mean"] = partial_df[f"{col}_sum"] / count.where(
+                count > 0
+            )
+        elif stat == "median":
+            final_df[f"{col}_median"] = median_from_counts(
+                value_counts[col]
+            ).reindex(partial_df.index)
+        else:
+            final_df[f"{col}_{stat}"] = partial_df[f"{col}_{stat}"]
+
+    final_df = final_df.reset_index()
+    for col in final_df.select_dtypes("category"):
+        final_df[col] = final_df[col].astype(object)
+
+    return final_df
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+@profiled
+def ingest_raw_datasets(
+    raw_path,
+    spool_path,
+    store,
+    cal,
+    chunksize,
+    num_partitions,
+    series_scope=SERIES_SCOPE,
+):
+    """
+    Weekly national and city datasets, same as data_preparation, reading the
+    raw tables by chunks. Memory is bounded by the chunk size, the size of
+    one partition and the number of weekly groups
+    """
+
+    products_df, customers_df = load_lookups(raw_path)
+
+    logging.info("Spool orders and items by order")
+    spool_orders(
+        raw_path, spool_path, customers_df, cal, chunksize, num_partitions
+    )
+    spool_items(raw_path, spool_path, chunksize, num_partitions)
+
+    logging.info("Join partitions and spool them by client")
+    for partition in sorted(os.listdir(spool_path / "orders")):
+        write_partitions(
+            join_partition(spool_path, partition, products_df),
+            "customer_id",
+            spool_path / "rows",
+            int(partition[1:]),
+            num_partitions,
+        )
+
+    logging.info("Aggregate partitions weekly")
+    national_partials = city_partials = None
+    for number, partition in enumerate(
+        sorted(os.listdir(spool_path / "rows"))
+    ):
+        rows_df = pd.read_parquet(spool_path / "rows" / partition)
+        rows_df = rows_df.sort_values(
+            "order_purchase_original_date", kind="stable"
+        )
+        rows_df = detect_new_clients(rows_df, CLIENT_KEY_COLS)
+
+        national_partials = merge_partials(
+            national_partials, partial_aggregates(rows_df, NATIONAL_KEY_COLS)
+        )
+        city_partials = merge_partials(
+            city_partials,
+            partial_aggregates(
+                filter_products_and_cities(
+                    rows_df, *SERIES_SCOPES[series_scope]
+                ),
+                CITY_KEY_COLS,
+            ),
+        )
+
+        seen_clients_df = (
+            rows_df[CLIENT_KEY_COLS].drop_duplicates().astype(object)
+        )
+        if number:
+            store.append(seen_clients_df, "state/seen_clients")
+        else:
+            store.write(seen_clients_df, "state/seen_clients")
+
+    return finalize_aggregates(national_partials), avoid_gap_dates(
+        finalize_aggregates(city_partials),
+        "order_purchase_date",
+        SERIES_KEY_COLS,
+    )
+
+
+@click.command()
+@click.option(
+    "--raw-path",
+    default=RAW_PATH,
+    help="Location of the raw Olist datasets",
+)
+@click.option(
+    "--source-path",
+    default=DEFAULT_ROOT,
+    help="Location where the processed datasets are saved",
+)
+@click.option(
+    "--storage-format",
+    default=DEFAULT_FORMAT,
+    help="Format of the processed datasets (parquet or csv)",
+)
+@click.option(
+    "--chunksize",
+    default=500_000,
+    help="Number of raw rows read at once",
+)
+@click.option(
+    "--num-partitions",
+    default=16,
+    help="Number of spool partitions, raise it for bigger datasets",
+)
+@track_stage("streaming_ingestion")
+def run_streaming_ingestion(
+    raw_path: str,
+    source_path: str,
+    storage_format: str,
+    chunksize: int,
+    num_partitions: int,
+):
+
+    store = get_dataset_store(source_path, storage_format)
+    holiday_cal = HOLIDAY_CALENDARS[os.getenv("HOLIDAY_CALENDAR", "brazil")]
+    Path(source_path).mkdir(parents=True, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(dir=source_path) as spool_path:
+        national_df, final_df = ingest_raw_datasets(
+            raw_path,
+            Path(spool_path),
+            store,
+            holiday_cal(),
+            chunksize,
+            num_partitions,
+        )
+
+    logging.info("Write datasets")
+    store.write(national_df, "national_orders_by_week")
+    store.write(final_df, "orders_by_week")
+
+
+if __name__ == "__main__":
+    run_streaming_ingestion()
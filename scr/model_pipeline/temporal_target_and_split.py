@@ -1,15 +1,128 @@
 from datetime import timedelta
-from pathlib import Path
 
 import click
+import numpy as np
 import pandas as pd
 
+from scr.instrumentation import track_stage
+from scr.model_pipeline.dataset_store import (
+    DEFAULT_FORMAT,
+    DEFAULT_ROOT,
+    get_dataset_store,
+)
+from scr.model_pipeline.feature_engineering import group_index
+from scr.profiling import profiled
+
+SERIES_COLS = ["product_category_name", "customer_city"]
+COLUMNS_PER_READ = 32
+
+
+def target_col_name(horizon):
+    return f"target_{horizon}_semana"
+
+
+@profiled
+def add_targets(df, target_col_source, horizons):
+    """
+    Sort df by date and add, for every horizon, target_{horizon}_semana:
+    the value of target_col_source `horizon` weeks later in the same series.
+    The series are grouped once and every horizon is a shift of the
+    group-contiguous values
+    """
+
+    df = df.sort_values("order_purchase_date", kind="stable")
+    order, _, sorted_codes = group_index(df, SERIES_COLS)
+    values = df[target_col_source].to_numpy(dtype="float64")[order]
+
+    targets = {}
+    for horizon in horizons:
+        shifted = np.full(len(values), np.nan)
+        is_same_series = (
+            sorted_codes[horizon:] == sorted_codes[:-horizon]
+        ) & (sorted_codes[horizon:] >= 0)
+        shifted[:-horizon][is_same_series] = values[horizon:][is_same_series]
+        targets[target_col_name(horizon)] = np.empty(len(values))
+        targets[target_col_name(horizon)][order] = shifted
+
+    return df.assign(**targets)
 
+
+def add_target(df, target_col_source, horizon):
+    """
+    Sort df by date and add target_{horizon}_semana, the value of
+    target_col_source `horizon` weeks later in the same series
+    """
+
+    return add_targets(df, target_col_source, [horizon])
+
+
+@profiled
+def split_model_data(
+    store, target_col_source, horizons, split_data, columns_per_read
+):
+    """
+    Train and validation rows of model_data, sorted by date, with the
+    targets of the horizons. The targets are built on the key columns only
+    and the features are read columns_per_read columns at a time, floats as
+    float32 (what CatBoost trains on), so the wide float64 model_data is
+    never in memory at once.
+    Returns (x_train, y_train, x_val, y_val)
+    """
+
+    target_cols = [target_col_name(horizon) for horizon in horizons]
+    key_df = add_targets(
+        store.read(
+            "model_data",
+            columns=["order_purchase_date", *SERIES_COLS, target_col_source],
+        ).reset_index(drop=True),
+        target_col_source,
+        horizons,
+    )
+    # positions of the sorted rows in model_data
+    order = key_df.index.to_numpy()
+    is_train = (
+        key_df["order_purchase_date"] < pd.to_datetime(split_data)
+    ).to_numpy()
+    is_val = (
+        key_df["order_purchase_date"]
+        >= pd.to_datetime(split_data) + timedelta(days=7)
+    ).to_numpy()
+
+    train_dfs, val_dfs = [], []
+    feature_cols = store.columns("model_data")
+    for first_col in range(0, len(feature_cols), columns_per_read):
+        df = store.read(
+            "model_data",
+            columns=feature_cols[first_col:][:columns_per_read],
+        )
+        float_cols = df.select_dtypes("float64").columns
+        df[float_cols] = df[float_cols].astype("float32")
+        df = df.iloc[order].reset_index(drop=True)
+        train_dfs.append(df[is_train])
+        val_dfs.append(df[is_val].reset_index(drop=True))
+
+    y_df = key_df[target_cols].reset_index(drop=True)
+
+    return (
+        pd.concat(train_dfs, axis=1),
+        y_df[is_train],
+        pd.concat(val_dfs, axis=1),
+        y_df[is_val].reset_index(drop=True),
+    )
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+# pylint: disable=too-many-locals
 @click.command()
 @click.option(
-    "--input-path",
-    default="./data/processed/model_data.csv",
-    help="Path to the data",
+    "--source-path",
+    default=DEFAULT_ROOT,
+    help="Location where the processed datasets were saved",
+)
+@click.option(
+    "--storage-format",
+    default=DEFAULT_FORMAT,
+    help="Format of the processed datasets (parquet or csv)",
 )
 @click.option(
     "--target-col-source",
@@ -21,47 +134,46 @@ import pandas as pd
     default=1,
     help="Number of weeks in the future to set the target",
 )
+@click.option(
+    "--max-horizon",
+    default=None,
+    type=int,
+    help="Build the targets of every horizon from 1 to max_horizon weeks "
+    "at once (multi-horizon mode, replaces --horizon)",
+)
 @click.option(
     "--split-data",
     default="2018-05-01",
     help="Split date between train/test datasets. First date in test file",
 )
+@click.option(
+    "--columns-per-read",
+    default=COLUMNS_PER_READ,
+    help="Columns of model_data read at once",
+)
+@track_stage("temporal_target_and_split")
 def add_target_and_split_by_product(
-    input_path, target_col_source, horizon, split_data
+    source_path,
+    storage_format,
+    target_col_source,
+    horizon,
+    max_horizon,
+    split_data,
+    columns_per_read,
 ):
 
-    df = pd.read_csv(input_path)
-    df["order_purchase_date"] = pd.to_datetime(df["order_purchase_date"])
-    df = df.sort_values("order_purchase_date")
-
-    df[f"target_{horizon}_semana"] = df.groupby(
-        ["product_category_name", "customer_city"]
-    )[target_col_source].shift(-horizon)
-
-    # split_data = pd.to_datetime(split_data).date()
-    df_train = df[df["order_purchase_date"] < pd.to_datetime(split_data)]
-    df_val = df[
-        df["order_purchase_date"]
-        >= pd.to_datetime(split_data) + timedelta(days=7)
-    ]
-
-    x_train = df_train.drop(f"target_{horizon}_semana", axis=1)
-    y_train = df_train[f"target_{horizon}_semana"]
-    x_val = df_val.drop(f"target_{horizon}_semana", axis=1)
-    y_val = df_val[f"target_{horizon}_semana"]
-
-    data_dir = (
-        Path.home()
-        / "ecommerce_demand_forecast"
-        / "data"
-        / "processed"
-        / split_data
+    horizons = [horizon]
+    if max_horizon is not None:
+        horizons = list(range(1, max_horizon + 1))
+    store = get_dataset_store(source_path, storage_format)
+    x_train, y_train, x_val, y_val = split_model_data(
+        store, target_col_source, horizons, split_data, columns_per_read
     )
-    data_dir.mkdir(exist_ok=True, mode=0o755)
-    x_train.to_csv(f"./data/processed/{split_data}/x_train.csv", index=False)
-    y_train.to_csv(f"./data/processed/{split_data}/y_train.csv", index=False)
-    x_val.to_csv(f"./data/processed/{split_data}/x_val.csv", index=False)
-    y_val.to_csv(f"./data/processed/{split_data}/y_val.csv", index=False)
+
+    store.write(x_train, f"{split_data}/x_train")
+    store.write(y_train, f"{split_data}/y_train")
+    store.write(x_val, f"{split_data}/x_val")
+    store.write(y_val, f"{split_data}/y_val")
 
 
 if __name__ == "__main__":
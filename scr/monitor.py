@@ -1,63 +1,312 @@
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
 import click
-import mlflow
 import pandas as pd
-from evidently.metric_preset import DataDriftPreset, RegressionPreset
-from evidently.report import Report
+
+import mlflow
+from scr.instrumentation import track_stage
+from scr.model_cache import ModelCache
+from scr.model_pipeline.dataset_store import (
+    DEFAULT_FORMAT,
+    DEFAULT_ROOT,
+    get_dataset_store,
+)
+from scr.model_pipeline.temporal_target_and_split import (
+    SERIES_COLS,
+    add_target,
+    target_col_name,
+)
+from scr.monitoring.window_stats import WindowStats, drift_report
+
+logging.basicConfig(
+    level=logging.INFO,
+    filename="app.log",
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
 
 mlflow.set_tracking_uri("sqlite:///mlflow.db")
 client = mlflow.MlflowClient()
 
+# model of the worker processes, loaded once by each of them
+MONITOR_MODEL = {}
+
+
+def load_monitor_model():
+    model_cache = ModelCache()
+    MONITOR_MODEL["current"] = model_cache.load(required=True)
+
+
+def week_stats(
+    week_start, source_path, storage_format, target_col_source, sketch_dir
+):
+    """
+    Statistics of the model_data rows of the week starting at week_start,
+    of their predictions and of their 1 week targets, read from the next
+    week as in the temporal split. The statistics of a week before the
+    current window are saved in sketch_dir and read back by later runs
+    """
+
+    model, schema, _ = MONITOR_MODEL["current"]
+    sketch_path = (
+        None
+        if sketch_dir is None
+        else Path(sketch_dir) / f"{week_start:%Y-%m-%d}.json"
+    )
+    if sketch_path is not None and sketch_path.exists():
+        with open(sketch_path, encoding="utf-8") as file:
+            return WindowStats.from_dict(json.load(file))
+
+    store = get_dataset_store(source_path, storage_format)
+    week_end = week_start + pd.Timedelta(days=7)
+    feature_names = schema["feature_names"]
+    df = store.read(
+        "model_data",
+        columns=list(
+            dict.fromkeys(
+                [
+                    "order_purchase_date",
+                    *SERIES_COLS,
+                    target_col_source,
+                    *feature_names,
+                ]
+            )
+        ),
+        start_date=week_start,
+        end_date=week_end + pd.Timedelta(days=7),
+    )
+    df = add_target(df, target_col_source, 1).sort_index()
+    df = df[df["order_purchase_date"] < week_end]
+    stats = WindowStats.for_schema(schema)
+    if len(df):
+        stats.update(
+            df[feature_names].assign(
+                prediction=model.predict(df[feature_names]),
+                target=df[target_col_name(1)],
+            )
+        )
+
+    if sketch_path is not None:
+        sketch_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(sketch_path, "w", encoding="utf-8") as file:
+            json.dump(stats.to_dict(), file)
+
+    return stats
+
+
+def window_stats(weeks, stats_fn, workers):
+    """
+    Statistics of the weeks computed in parallel, merged into one
+    """
+
+    if workers > 1:
+        with ProcessPoolExecutor(
+            workers, initializer=load_monitor_model
+        ) as pool:
+            week_results = list(pool.map(stats_fn, weeks))
+    else:
+        week_results = list(map(stats_fn, weeks))
+
+    stats = week_results[0]
+    for other in week_results[1:]:
+        stats.merge(other)
+
+    return stats
+
+
+def evidently_html_report(store, model, current_date, reference_date):
+    """
+    Evidently report of the validation splits of both dates, saved in
+    reports/evidently_report.html
+    """
+
+    # pylint: disable=import-outside-toplevel
+    from evidently.metric_preset import DataDriftPreset, RegressionPreset
+    from evidently.report import Report
+
+    current_data = store.read(f"{current_date}/x_val").drop(
+        "order_purchase_date", axis=1
+    )
+    reference_data = store.read(f"{reference_date}/x_val").drop(
+        "order_purchase_date", axis=1
+    )
+    reference_data["prediction"] = model.predict(reference_data)
+    current_data["prediction"] = model.predict(current_data)
+    reference_data["target"] = store.read(f"{reference_date}/y_val").iloc[
+        :, 0
+    ]
+    current_data["target"] = store.read(f"{current_date}/y_val").iloc[:, 0]
+
+    report = Report(metrics=[DataDriftPreset(), RegressionPreset()])
+    report.run(reference_data=reference_data, current_data=current_data)
+    report.save_html("reports/evidently_report.html")
+
 
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+# pylint: disable=too-many-locals
 @click.command()
 @click.option(
     "--source-path",
-    default="./data/processed/",
+    default=DEFAULT_ROOT,
     help="Location where the processed datasets were saved",
 )
+@click.option(
+    "--storage-format",
+    default=DEFAULT_FORMAT,
+    help="Format of the processed datasets (parquet or csv)",
+)
 @click.option(
     "--current-date",
     default="2018-05-01",
     help="Current date prediction",
 )
-def run_monitor(source_path: str, current_date: str):
+@click.option(
+    "--target-col-source",
+    default="sales_amount_sum",
+    help="Column name used as the future target",
+)
+@click.option(
+    "--current-weeks",
+    default=1,
+    help="Weeks of the current window, from the current date",
+)
+@click.option(
+    "--reference-weeks",
+    default=1,
+    help="Weeks of the reference window, before the current date",
+)
+@click.option(
+    "--drift-method",
+    default="psi",
+    type=click.Choice(["psi", "ks", "wasserstein"]),
+    help="Drift score of the numeric columns",
+)
+@click.option(
+    "--workers",
+    default=1,
+    help="Processes computing the statistics of the weeks",
+)
+@click.option(
+    "--sketch-dir",
+    default="./reports/sketches",
+    help="Location of the saved statistics of past weeks",
+)
+@click.option(
+    "--html-report/--no-html-report",
+    default=False,
+    help="Also save the Evidently report of the validation splits",
+)
+@track_stage("monitor")
+def run_monitor(
+    source_path: str,
+    storage_format: str,
+    current_date: str,
+    target_col_source: str,
+    current_weeks: int,
+    reference_weeks: int,
+    drift_method: str,
+    workers: int,
+    sketch_dir: str,
+    html_report: bool,
+):
 
-    current_path = f"{source_path}{current_date}"
-    reference_date = pd.to_datetime(current_date) - pd.to_timedelta(
-        7, unit="D"
-    )
-    reference_date = reference_date.strftime("%Y-%m-%d")
-    reference_path = f"{source_path}{reference_date}"
+    current_start = pd.Timestamp(current_date)
+    reference_starts = [
+        current_start - pd.Timedelta(days=7 * week)
+        for week in range(reference_weeks, 0, -1)
+    ]
+    current_starts = [
+        current_start + pd.Timedelta(days=7 * week)
+        for week in range(current_weeks)
+    ]
 
-    # Load current and reference data
-    current_data = pd.read_csv(f"{current_path}/x_val.csv").drop(
-        "order_purchase_date", axis=1
+    # Statistics of each week of all the series, without keeping the rows:
+    # the weeks merge into the reference and current windows
+    load_monitor_model()
+    model, _, model_version = MONITOR_MODEL["current"]
+    stats_args = {
+        "source_path": source_path,
+        "storage_format": storage_format,
+        "target_col_source": target_col_source,
+    }
+    reference = window_stats(
+        reference_starts,
+        partial(
+            week_stats,
+            **stats_args,
+            sketch_dir=f"{sketch_dir}/{model_version}",
+        ),
+        workers,
     )
-    reference_data = pd.read_csv(f"{reference_path}/x_val.csv").drop(
-        "order_purchase_date", axis=1
+    current = window_stats(
+        current_starts,
+        partial(week_stats, **stats_args, sketch_dir=None),
+        workers,
+    )
+    report = drift_report(reference, current, drift_method)
+    logging.info(
+        "Drift of %s rows against %s rows: %s columns drifted, MAE %s "
+        "(reference %s)",
+        report["rows"],
+        report["reference_rows"],
+        len(report["drifted_columns"]),
+        report["mae"],
+        report["reference_errors"]["mae"],
     )
 
-    # Load model
-    model = mlflow.catboost.load_model("models:/ecommerce_forecast/1")
-
-    # Predictions
-    reference_data["prediction"] = model.predict(
-        reference_data
-    )  # pd.read_csv(f"{reference_path}/y_val.csv")
-    current_data["prediction"] = model.predict(current_data)
-
-    # Prepare data to report
-    reference_data["target"] = pd.read_csv(f"{reference_path}/y_val.csv")
-    current_data["target"] = pd.read_csv(f"{current_path}/y_val.csv")
-
-    # Create and save report
-    report = Report(metrics=[DataDriftPreset(), RegressionPreset()])
-    report.run(reference_data=reference_data, current_data=current_data)
-    report.save_html("reports/evidently_report.html")
+    os.makedirs("reports", exist_ok=True)
+    with open("reports/drift_report.json", "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    if html_report:
+        evidently_html_report(
+            get_dataset_store(source_path, storage_format),
+            model,
+            current_date,
+            f"{current_start - pd.Timedelta(days=7):%Y-%m-%d}",
+        )
 
     mlflow.set_tracking_uri("sqlite:///mlflow.db")
     mlflow.set_experiment("ecommerce_forecast_reports")
     with mlflow.start_run(run_name=f"catboost_report_{current_date}"):
-        mlflow.log_artifact("reports/evidently_report.html")
+        mlflow.log_params(
+            {
+                "model_version": model_version,
+                "drift_method": drift_method,
+                "reference_weeks": reference_weeks,
+                "current_weeks": current_weeks,
+            }
+        )
+        mlflow.log_metrics(
+            {
+                "dataset_drift": int(report["dataset_drift"]),
+                "share_of_drifted_columns": report[
+                    "share_of_drifted_columns"
+                ],
+                "current_rows": report["rows"],
+                "reference_rows": report["reference_rows"],
+            }
+        )
+        # errors of the windows whose rows have a target
+        errors = {
+            "current_mae": report["mae"],
+            "current_rmse": report["rmse"],
+            "reference_mae": report["reference_errors"]["mae"],
+            "reference_rmse": report["reference_errors"]["rmse"],
+        }
+        mlflow.log_metrics(
+            {
+                name: value
+                for name, value in errors.items()
+                if value is not None
+            }
+        )
+        mlflow.log_artifact("reports/drift_report.json")
+        if html_report:
+            mlflow.log_artifact("reports/evidently_report.html")
 
 
 if __name__ == "__main__":
@@ -1,89 +1,211 @@
+import json
+import logging
+import os
 import time
+from pathlib import Path
 
 import click
 import pandas as pd
-from evidently.metric_preset import DataDriftPreset, RegressionPreset
-from evidently.report import Report
-from prometheus_client import Gauge, start_http_server
+from prometheus_client import start_http_server
 
 import mlflow
+from scr.instrumentation import CURRENT_MAE, DATASET_DRIFT, DRIFT_SHARE
+from scr.model_cache import ModelCache
+from scr.model_pipeline.dataset_store import (
+    DEFAULT_FORMAT,
+    DEFAULT_ROOT,
+    get_dataset_store,
+)
+from scr.monitoring.window_stats import WindowStats, drift_report
 
-# Initiate Prometheus server in port
-start_http_server(3030)
+logging.basicConfig(
+    level=logging.INFO,
+    filename="app.log",
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
 
 mlflow.set_tracking_uri("sqlite:///mlflow.db")
-client = mlflow.MlflowClient()
 
 
+def scored_split(model, schema, store, split_date):
+    """
+    Features of the validation split of split_date with the model
+    predictions and the target
+    """
+
+    df = store.read(f"{split_date}/x_val")[schema["feature_names"]]
+    df["prediction"] = model.predict(df)
+    df["target"] = store.read(f"{split_date}/y_val").iloc[:, 0].to_numpy()
+
+    return df
+
+
+def write_json(data, path):
+    """
+    Replace path atomically, so a stopped monitor never leaves half a file
+    """
+
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    if not path.exists():
+        return None
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def new_scored_files(scored_dir, ingested, split_name):
+    """
+    Parquet files of scored rows not ingested yet. Files are written once
+    (to a temporary name, then renamed) and never appended to. Of the
+    validation splits scored by the monitor, only split_name (the one of
+    the served model version) is taken
+    """
+
+    return sorted(
+        path.name
+        for path in Path(scored_dir).glob("*.parquet")
+        if path.name not in ingested
+        and (path.name == split_name or not path.name.startswith("x_val_v"))
+    )
+
+
+# pylint: disable=too-many-arguments, too-many-positional-arguments
+# pylint: disable=too-many-locals
 @click.command()
 @click.option(
     "--source-path",
-    default="./data/processed/",
+    default=DEFAULT_ROOT,
     help="Location where the processed datasets were saved",
 )
+@click.option(
+    "--storage-format",
+    default=DEFAULT_FORMAT,
+    help="Format of the processed datasets (parquet or csv)",
+)
 @click.option(
     "--current-date",
     default="2018-05-01",
     help="Current date prediction",
 )
-def run_monitor(source_path: str, current_date: str):
-
-    # Cria métricas Prometheus
-    drift_status = Gauge(
-        "evidently_dataset_drift", "Status de Drift (0 ou 1)"
-    )
-    drift_share = Gauge(
-        "evidently_drift_share", "Percentual de Features com Drift"
-    )
+@click.option(
+    "--state-dir",
+    default="./reports/monitor_state",
+    help="Location of the saved window statistics",
+)
+@click.option(
+    "--scored-dir",
+    default=None,
+    help="Parquet files of scored rows of the current week "
+    "(default <source-path>scored/<current-date>)",
+)
+@click.option(
+    "--interval",
+    default=3600,
+    help="Seconds between two checks of the scored rows",
+)
+@click.option(
+    "--drift-method",
+    default="psi",
+    type=click.Choice(["psi", "ks", "wasserstein"]),
+    help="Drift score of the numeric columns",
+)
+def run_monitor(
+    source_path: str,
+    storage_format: str,
+    current_date: str,
+    state_dir: str,
+    scored_dir: str,
+    interval: int,
+    drift_method: str,
+):
+
+    # Initiate Prometheus server in port
+    start_http_server(3030)
 
-    current_path = f"{source_path}{current_date}"
     reference_date = pd.to_datetime(current_date) - pd.to_timedelta(
         7, unit="D"
     )
     reference_date = reference_date.strftime("%Y-%m-%d")
-    reference_path = f"{source_path}{reference_date}"
-
-    # Load current and reference data
-    current_data = pd.read_csv(f"{current_path}/x_val.csv").drop(
-        "order_purchase_date", axis=1
-    )
-    reference_data = pd.read_csv(f"{reference_path}/x_val.csv").drop(
-        "order_purchase_date", axis=1
-    )
 
-    # Load model
-    model = mlflow.catboost.load_model("models:/ecommerce_forecast/1")
+    store = get_dataset_store(source_path, storage_format)
+    model_cache = ModelCache()
+    model, schema, model_version = model_cache.load(required=True)
 
-    # Predictions
-    reference_data["prediction"] = model.predict(
-        reference_data
-    )  # pd.read_csv(f"{reference_path}/y_val.csv")
-    current_data["prediction"] = model.predict(current_data)
-
-    # Prepare data to report
-    reference_data["target"] = pd.read_csv(f"{reference_path}/y_val.csv")
-    current_data["target"] = pd.read_csv(f"{current_path}/y_val.csv")
-    print(current_data.head())
-
-    def calculate_metrics(reference_df, current_df):
-
-        report = Report(metrics=[DataDriftPreset(), RegressionPreset()])
-        report.run(reference_data=reference_df, current_data=current_df)
-
-        results = report.as_dict()
-
-        # Extrai métricas
-        drift_status.set(
-            1 if results["metrics"][0]["result"]["dataset_drift"] else 0
-        )
-        drift_share.set(
-            results["metrics"][0]["result"]["share_of_drifted_columns"] * 100
+    # The reference week is scored and summarized once per model version,
+    # then read back
+    state_dir = Path(state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    reference_path = (
+        state_dir / f"reference_sketch_{reference_date}_v{model_version}.json"
+    )
+    reference_data = read_json(reference_path)
+    if reference_data is None:
+        reference = WindowStats.for_schema(schema)
+        reference.update(scored_split(model, schema, store, reference_date))
+        write_json(
+            {"model_version": model_version, **reference.to_dict()},
+            reference_path,
         )
-
-    # Executa a cada hora (simplificado)
+        logging.info("Reference statistics of %s saved", reference_date)
+    else:
+        reference = WindowStats.from_dict(reference_data)
+
+    # The scored rows of the current week start with its validation split,
+    # scored by the served model version
+    scored_dir = Path(scored_dir or f"{source_path}scored/{current_date}")
+    scored_dir.mkdir(parents=True, exist_ok=True)
+    split_path = scored_dir / f"x_val_v{model_version}.parquet"
+    current_path = (
+        state_dir / f"current_sketch_{current_date}_v{model_version}.json"
+    )
+    current_data = read_json(current_path)
+    if current_data is None:
+        if not split_path.exists():
+            scored_split(model, schema, store, current_date).to_parquet(
+                split_path.with_suffix(".tmp")
+            )
+            os.replace(split_path.with_suffix(".tmp"), split_path)
+        current, ingested = WindowStats.for_schema(schema), []
+    else:
+        current = WindowStats.from_dict(current_data["stats"])
+        ingested = current_data["ingested"]
+
+    # Executa a cada hora (simplificado): only the new scored rows are read,
+    # and the drift is computed again only when there are new rows
+    report = None
     while True:
-        calculate_metrics(reference_data, current_data)
-        time.sleep(3600)
+        new_files = new_scored_files(
+            scored_dir, set(ingested), split_path.name
+        )
+        for name in new_files:
+            current.update(pd.read_parquet(scored_dir / name))
+            ingested.append(name)
+        if new_files or report is None:
+            report = drift_report(reference, current, drift_method)
+            write_json(
+                {
+                    "ingested": ingested,
+                    "stats": current.to_dict(),
+                    "report": report,
+                },
+                current_path,
+            )
+            DATASET_DRIFT.set(1 if report["dataset_drift"] else 0)
+            DRIFT_SHARE.set(report["share_of_drifted_columns"] * 100)
+            if report["mae"] is not None:
+                CURRENT_MAE.set(report["mae"])
+            logging.info(
+                "Drift of %s rows (%s new files): %s columns drifted",
+                report["rows"],
+                len(new_files),
+                len(report["drifted_columns"]),
+            )
+        time.sleep(interval)
 
 
 if __name__ == "__main__":
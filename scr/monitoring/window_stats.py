@@ -0,0 +1,347 @@
+from collections import Counter
+
+import numpy as np
+
+RELATIVE_ACCURACY = 0.01
+NUM_BINS = 10
+# proportions are floored so an empty bin does not make the PSI infinite
+MIN_PROPORTION = 1e-4
+# a column drifts above the threshold of the method, the dataset when at
+# least DRIFT_SHARE of its columns drift
+DRIFT_THRESHOLDS = {"psi": 0.1, "ks": 0.1, "wasserstein": 0.1}
+DRIFT_SHARE = 0.5
+
+
+class NumericSketch:
+    """
+    Mergeable histogram of a numeric column on fixed logarithmic buckets:
+    a non-zero value x falls in bucket ceil(log(|x|) / log(gamma)) of its
+    sign, so a bucket holds values within relative_accuracy of each other
+    whatever the data, and the sketches of any set of rows merge by adding
+    their bucket counts. Zeros and missing values are counted apart, and
+    the sum and sum of squares are exact
+    """
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.buckets = {"positive": Counter(), "negative": Counter()}
+        self.counts = {"values": 0, "zero": 0, "missing": 0}
+        self.moments = {"sum": 0.0, "sum_squares": 0.0}
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        is_missing = np.isnan(values)
+        values = values[~is_missing]
+        self.counts["missing"] += int(is_missing.sum())
+        self.counts["values"] += len(values)
+        self.counts["zero"] += int((values == 0).sum())
+        self.moments["sum"] += float(values.sum())
+        self.moments["sum_squares"] += float((values**2).sum())
+
+        for sign, side_values in [
+            ("positive", values[values > 0]),
+            ("negative", -values[values < 0]),
+        ]:
+            keys, key_counts = np.unique(
+                np.ceil(np.log(side_values) / np.log(self.gamma)),
+                return_counts=True,
+            )
+            self.buckets[sign].update(
+                dict(zip(keys.astype(int).tolist(), key_counts.tolist()))
+            )
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Sketches of different accuracies")
+        for sign, buckets in other.buckets.items():
+            self.buckets[sign].update(buckets)
+        for name, count in other.counts.items():
+            self.counts[name] += count
+        for name, moment in other.moments.items():
+            self.moments[name] += moment
+
+        return self
+
+    def points(self):
+        """
+        Sorted value of each non-empty bucket (the value of least relative
+        error of the bucket, and 0 for zeros) and its count
+        """
+
+        points = {
+            sign * 2 * self.gamma**key / (self.gamma + 1): count
+            for sign, buckets in [
+                (1, self.buckets["positive"]),
+                (-1, self.buckets["negative"]),
+            ]
+            for key, count in buckets.items()
+        }
+        if self.counts["zero"]:
+            points[0.0] = self.counts["zero"]
+        values = np.array(sorted(points))
+
+        return values, np.array([points[v] for v in values], dtype=float)
+
+    def std(self):
+        count = self.counts["values"]
+        if not count:
+            return 0.0
+        mean = self.moments["sum"] / count
+        return max(self.moments["sum_squares"] / count - mean**2, 0) ** 0.5
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "buckets": {
+                sign: dict(buckets) for sign, buckets in self.buckets.items()
+            },
+            "counts": self.counts,
+            "moments": self.moments,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["relative_accuracy"])
+        # JSON keys are strings
+        sketch.buckets = {
+            sign: Counter({int(key): n for key, n in buckets.items()})
+            for sign, buckets in data["buckets"].items()
+        }
+        sketch.counts = dict(data["counts"])
+        sketch.moments = dict(data["moments"])
+
+        return sketch
+
+
+class WindowStats:
+    """
+    Statistics of a window of scored rows: a NumericSketch of each numeric
+    column, the value counts of each categorical column and the running
+    sums of the prediction errors. Updated batch by batch in O(batch
+    rows), merged with the statistics of other rows (other workers, other
+    weeks) and saved as JSON
+    """
+
+    def __init__(
+        self,
+        numeric_columns,
+        categorical_columns,
+        relative_accuracy=RELATIVE_ACCURACY,
+    ):
+        self.rows = 0
+        self.numeric = {
+            col: NumericSketch(relative_accuracy) for col in numeric_columns
+        }
+        self.categorical = {col: Counter() for col in categorical_columns}
+        self.errors = {"rows": 0, "abs": 0.0, "squared": 0.0, "sum": 0.0}
+
+    @classmethod
+    def for_schema(cls, schema, relative_accuracy=RELATIVE_ACCURACY):
+        """
+        Empty statistics of the features of a model schema and of its
+        predictions
+        """
+
+        feature_types = schema["feature_types"]
+        text_columns = [
+            col for col, kind in feature_types.items() if kind == "text"
+        ]
+        return cls(
+            [
+                *[col for col in feature_types if col not in text_columns],
+                "prediction",
+            ],
+            text_columns,
+            relative_accuracy,
+        )
+
+    def update(self, df):
+        """
+        Add a batch of rows. The errors are summed over the rows with both
+        a target and a prediction
+        """
+
+        self.rows += len(df)
+        for col, sketch in self.numeric.items():
+            sketch.update(df[col].to_numpy(float))
+        for col, counts in self.categorical.items():
+            counts.update(df[col].astype(str).value_counts().to_dict())
+
+        if {"target", "prediction"} <= set(df.columns):
+            errors = (df["prediction"] - df["target"]).dropna().to_numpy()
+            self.errors["rows"] += len(errors)
+            self.errors["abs"] += float(np.abs(errors).sum())
+            self.errors["squared"] += float((errors**2).sum())
+            self.errors["sum"] += float(errors.sum())
+
+    def merge(self, other):
+        self.rows += other.rows
+        for col, sketch in self.numeric.items():
+            sketch.merge(other.numeric[col])
+        for col, counts in self.categorical.items():
+            counts.update(other.categorical[col])
+        for name, value in other.errors.items():
+            self.errors[name] += value
+
+        return self
+
+    def to_dict(self):
+        return {
+            "rows": self.rows,
+            "numeric": {
+                col: sketch.to_dict() for col, sketch in self.numeric.items()
+            },
+            "categorical": {
+                col: dict(counts) for col, counts in self.categorical.items()
+            },
+            "errors": self.errors,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls([], [])
+        stats.rows = data["rows"]
+        stats.numeric = {
+            col: NumericSketch.from_dict(sketch)
+            for col, sketch in data["numeric"].items()
+        }
+        stats.categorical = {
+            col: Counter(counts)
+            for col, counts in data["categorical"].items()
+        }
+        stats.errors = dict(data["errors"])
+
+        return stats
+
+
+def psi(expected_counts, actual_counts):
+    """
+    Population stability index of two count vectors on the same bins
+    """
+
+    expected = np.maximum(
+        np.asarray(expected_counts) / max(np.sum(expected_counts), 1),
+        MIN_PROPORTION,
+    )
+    actual = np.maximum(
+        np.asarray(actual_counts) / max(np.sum(actual_counts), 1),
+        MIN_PROPORTION,
+    )
+
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def numeric_drift(reference, current, num_bins=NUM_BINS):
+    """
+    PSI on the deciles of the reference (missing values in a bin of their
+    own), Kolmogorov-Smirnov statistic and Wasserstein distance divided by
+    the reference standard deviation, from the buckets of two sketches
+    """
+
+    ref_values, ref_counts = reference.points()
+    cur_values, cur_counts = current.points()
+    values = np.union1d(ref_values, cur_values)
+    if values.size == 0:
+        return {"psi": 0.0, "ks": 0.0, "wasserstein": 0.0}
+    ref_counts = np.bincount(
+        np.searchsorted(values, ref_values), ref_counts, len(values)
+    )
+    cur_counts = np.bincount(
+        np.searchsorted(values, cur_values), cur_counts, len(values)
+    )
+    ref_cdf = np.cumsum(ref_counts) / max(ref_counts.sum(), 1)
+    cur_cdf = np.cumsum(cur_counts) / max(cur_counts.sum(), 1)
+    cdf_gap = np.abs(ref_cdf - cur_cdf)
+
+    inner_quantiles = np.linspace(0, 1, num_bins + 1)[1:-1]
+    edges = np.unique(
+        values[
+            np.minimum(
+                np.searchsorted(ref_cdf, inner_quantiles), len(values) - 1
+            )
+        ]
+    )
+    bins = np.searchsorted(edges, values, side="right")
+    std = reference.std()
+
+    return {
+        "psi": psi(
+            [
+                *np.bincount(bins, ref_counts, len(edges) + 1),
+                reference.counts["missing"],
+            ],
+            [
+                *np.bincount(bins, cur_counts, len(edges) + 1),
+                current.counts["missing"],
+            ],
+        ),
+        "ks": float(cdf_gap.max()),
+        "wasserstein": float(np.sum(cdf_gap[:-1] * np.diff(values)))
+        / (std if std > 0 else 1),
+    }
+
+
+def error_metrics(stats):
+    """
+    MAE, RMSE and mean error of the rows of stats with a target, None
+    without such rows
+    """
+
+    error_rows = stats.errors["rows"]
+    if not error_rows:
+        return {"mae": None, "rmse": None, "mean_error": None}
+
+    return {
+        "mae": stats.errors["abs"] / error_rows,
+        "rmse": (stats.errors["squared"] / error_rows) ** 0.5,
+        "mean_error": stats.errors["sum"] / error_rows,
+    }
+
+
+def drift_report(reference, current, method="psi", threshold=None):
+    """
+    Drift scores of each column between the reference and current
+    statistics, the drifted columns by the scores of `method` (PSI for
+    categorical columns) and the errors of both windows. Nothing is scored
+    while a window is empty
+    """
+
+    threshold = DRIFT_THRESHOLDS[method] if threshold is None else threshold
+    is_scored = reference.rows > 0 and current.rows > 0
+    scores = {
+        col: numeric_drift(sketch, current.numeric[col])
+        for col, sketch in reference.numeric.items()
+        if is_scored
+    }
+    for col, counts in reference.categorical.items() if is_scored else []:
+        categories = sorted(set(counts) | set(current.categorical[col]))
+        scores[col] = {
+            "psi": psi(
+                [counts.get(c, 0) for c in categories],
+                [current.categorical[col].get(c, 0) for c in categories],
+            )
+        }
+
+    drifted = sorted(
+        col
+        for col, col_scores in scores.items()
+        if (
+            col_scores[method] > threshold
+            if method in col_scores
+            else col_scores["psi"] > DRIFT_THRESHOLDS["psi"]
+        )
+    )
+    share = len(drifted) / len(scores) if scores else 0
+
+    return {
+        "rows": current.rows,
+        "reference_rows": reference.rows,
+        "method": method,
+        "scores": scores,
+        "drifted_columns": drifted,
+        "share_of_drifted_columns": share,
+        "dataset_drift": bool(scores) and share >= DRIFT_SHARE,
+        **error_metrics(current),
+        "reference_errors": error_metrics(reference),
+    }
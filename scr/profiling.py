@@ -0,0 +1,297 @@
+import cProfile
+import functools
+import html
+import json
+import logging
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+logging.basicConfig(
+    level=logging.INFO,
+    filename="app.log",
+    format="%(asctime)s - %(levelname)s - %(message)s",
+)
+
+# PIPELINE_PROFILE=1 times the profiled functions of the stages, and a
+# comma-separated list may add "cprofile" and "tracemalloc" dumps, e.g.
+# PIPELINE_PROFILE=cprofile,tracemalloc
+PROFILE_ENV = "PIPELINE_PROFILE"
+# report directory of the running stage, inherited by worker processes
+PROFILE_DIR_ENV = "PIPELINE_PROFILE_DIR"
+REPORT_ROOT = "./reports/profiling"
+PROFILING_EXPERIMENT = "ecommerce_forecast_profiling"
+TOP_ALLOCATIONS = 30
+
+# calls, wall and CPU seconds and allocation peak of each function
+FUNCTION_STATS = {}
+# enabled flag, pid of the stage process, pid of the process the
+# FUNCTION_STATS belong to (forked workers start from a copy of the stage
+# ones) and nesting of the profiled calls
+SESSION = {"enabled": False, "pid": None, "stats_pid": None, "depth": 0}
+# allocation peak of each running profiled call, with tracemalloc
+PEAK_STACK = []
+
+
+def profile_modes():
+    """
+    Profiling modes asked by PIPELINE_PROFILE, empty when profiling is off
+    """
+
+    value = os.getenv(PROFILE_ENV, "")
+    if value in ("", "0"):
+        return set()
+
+    return {"timing", *value.split(",")}
+
+
+# workers spawned by a profiled stage profile their calls too
+SESSION["enabled"] = bool(profile_modes()) and PROFILE_DIR_ENV in os.environ
+
+
+def dump_worker_stats():
+    """
+    Worker processes leave their function statistics in the report
+    directory of the stage, merged into the stage report at the end
+    """
+
+    report_dir = os.getenv(PROFILE_DIR_ENV)
+    if report_dir is None:
+        return
+    worker_path = Path(report_dir) / "workers" / f"{os.getpid()}.json"
+    worker_path.parent.mkdir(exist_ok=True)
+    with open(worker_path, "w", encoding="utf-8") as file:
+        json.dump(FUNCTION_STATS, file)
+
+
+def profiled(func):
+    """
+    Record the calls, wall time, CPU time and, under tracemalloc, the
+    allocation peak of func while profiling is on
+    """
+
+    # named after the file, as the stage modules run as __main__
+    name = f"{Path(func.__code__.co_filename).stem}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not SESSION["enabled"]:
+            return func(*args, **kwargs)
+
+        if SESSION["stats_pid"] != os.getpid():
+            FUNCTION_STATS.clear()
+            SESSION["stats_pid"] = os.getpid()
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            start_memory, peak = tracemalloc.get_traced_memory()
+            # the peak of the caller so far, before the reset for this call
+            if PEAK_STACK:
+                PEAK_STACK[-1] = max(PEAK_STACK[-1], peak)
+            tracemalloc.reset_peak()
+            PEAK_STACK.append(0)
+        SESSION["depth"] += 1
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats = FUNCTION_STATS.setdefault(
+                name,
+                {
+                    "calls": 0,
+                    "wall_seconds": 0.0,
+                    "cpu_seconds": 0.0,
+                    "peak_alloc_bytes": None,
+                },
+            )
+            stats["calls"] += 1
+            stats["wall_seconds"] += time.perf_counter() - start_wall
+            stats["cpu_seconds"] += time.process_time() - start_cpu
+            if tracing:
+                peak = max(
+                    PEAK_STACK.pop(), tracemalloc.get_traced_memory()[1]
+                )
+                if PEAK_STACK:
+                    PEAK_STACK[-1] = max(PEAK_STACK[-1], peak)
+                stats["peak_alloc_bytes"] = max(
+                    stats["peak_alloc_bytes"] or 0, peak - start_memory
+                )
+            SESSION["depth"] -= 1
+            if SESSION["depth"] == 0 and os.getpid() != SESSION["pid"]:
+                dump_worker_stats()
+
+    return wrapper
+
+
+def merge_function_stats(all_stats):
+    """
+    Sum the calls and times of the stage process and of its workers, and
+    keep the largest allocation peak
+    """
+
+    merged = {}
+    for stats in all_stats:
+        for name, func_stats in stats.items():
+            if name not in merged:
+                merged[name] = dict(func_stats)
+                continue
+            total = merged[name]
+            for key in ["calls", "wall_seconds", "cpu_seconds"]:
+                total[key] += func_stats[key]
+            peaks = [
+                peak
+                for peak in [
+                    total["peak_alloc_bytes"],
+                    func_stats["peak_alloc_bytes"],
+                ]
+                if peak is not None
+            ]
+            total["peak_alloc_bytes"] = max(peaks, default=None)
+
+    return dict(
+        sorted(
+            merged.items(),
+            key=lambda item: item[1]["wall_seconds"],
+            reverse=True,
+        )
+    )
+
+
+def worker_stats(report_dir):
+    all_stats = []
+    for worker_path in sorted(Path(report_dir).glob("workers/*.json")):
+        with open(worker_path, encoding="utf-8") as file:
+            all_stats.append(json.load(file))
+
+    return all_stats
+
+
+def html_row(name, stats):
+    peak = stats["peak_alloc_bytes"]
+    peak_text = "-" if peak is None else f"{peak / 2**20:.1f}"
+
+    return (
+        f"<tr><td>{html.escape(name)}</td><td>{stats['calls']}</td>"
+        f"<td>{stats['wall_seconds']:.3f}</td>"
+        f"<td>{stats['cpu_seconds']:.3f}</td><td>{peak_text}</td></tr>"
+    )
+
+
+def write_html_report(report, path):
+    rows = "".join(
+        html_row(name, stats) for name, stats in report["functions"].items()
+    )
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(
+            f"""<!DOCTYPE html>
+<html>
+<body>
+    <h2>{html.escape(report["stage"])}: {report["wall_seconds"]:.1f}s wall,
+    {report["cpu_seconds"]:.1f}s CPU</h2>
+    <table border="1">
+        <tr><th>Function</th><th>Calls</th><th>Wall (s)</th>
+        <th>CPU (s)</th><th>Peak allocations (MB)</th></tr>
+        {rows}
+    </table>
+</body>
+</html>
+"""
+        )
+
+
+def log_report(report_dir, report):
+    """
+    Log the report directory to its own MLflow run of the profiling
+    experiment, tagged with the stage
+    """
+
+    # mlflow is only imported by the stages run with profiling on
+    # pylint: disable=import-outside-toplevel
+    import mlflow
+
+    client = mlflow.MlflowClient(
+        os.getenv("MLFLOW_TRACKING_URI", "sqlite:///mlflow.db")
+    )
+    experiment = client.get_experiment_by_name(PROFILING_EXPERIMENT)
+    experiment_id = (
+        experiment.experiment_id
+        if experiment is not None
+        else client.create_experiment(PROFILING_EXPERIMENT)
+    )
+    run = client.create_run(
+        experiment_id,
+        run_name=f"profile_{report['stage']}",
+        tags={"stage": report["stage"]},
+    )
+    client.log_metric(run.info.run_id, "wall_seconds", report["wall_seconds"])
+    client.log_metric(run.info.run_id, "cpu_seconds", report["cpu_seconds"])
+    client.log_artifacts(run.info.run_id, str(report_dir))
+    client.set_terminated(run.info.run_id)
+
+
+@contextmanager
+def profile_stage(stage):
+    """
+    Profile a pipeline stage when PIPELINE_PROFILE is set: the timings of
+    the profiled functions, optionally with cProfile and tracemalloc
+    dumps, are written to reports/profiling/<stage>_<time>/ and logged to
+    MLflow. Does nothing otherwise
+    """
+
+    modes = profile_modes()
+    if not modes:
+        yield
+        return
+
+    report_dir = (
+        Path(REPORT_ROOT) / f"{stage}_{time.strftime('%Y%m%d_%H%M%S')}"
+    )
+    report_dir.mkdir(parents=True, exist_ok=True)
+    os.environ[PROFILE_DIR_ENV] = str(report_dir)
+    SESSION.update(
+        enabled=True, pid=os.getpid(), stats_pid=os.getpid(), depth=0
+    )
+    FUNCTION_STATS.clear()
+    profiler = cProfile.Profile() if "cprofile" in modes else None
+    if "tracemalloc" in modes:
+        tracemalloc.start()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(report_dir / "profile.prof")
+        report = {
+            "stage": stage,
+            "modes": sorted(modes),
+            "wall_seconds": time.perf_counter() - start_wall,
+            "cpu_seconds": time.process_time() - start_cpu,
+            "functions": merge_function_stats(
+                [FUNCTION_STATS, *worker_stats(report_dir)]
+            ),
+        }
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            snapshot.dump(str(report_dir / "tracemalloc.snapshot"))
+            report["top_allocations"] = [
+                str(statistic)
+                for statistic in snapshot.statistics("lineno")[
+                    :TOP_ALLOCATIONS
+                ]
+            ]
+            tracemalloc.stop()
+        with open(report_dir / "timings.json", "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+        write_html_report(report, report_dir / "timings.html")
+        os.environ.pop(PROFILE_DIR_ENV, None)
+        SESSION["enabled"] = False
+        logging.info("Profile of stage %s saved in %s", stage, report_dir)
+        try:
+            log_report(report_dir, report)
+        # the profile must not fail the stage
+        except Exception:  # pylint: disable=broad-exception-caught
+            logging.exception("Profile of %s not logged to MLflow", stage)
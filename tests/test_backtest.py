@@ -0,0 +1,19 @@
+import pandas as pd
+
+from scr.model_pipeline.backtest import fold_ranges
+
+
+def test_fold_ranges():
+
+    dates = pd.DatetimeIndex(
+        pd.date_range("2018-01-01", periods=6, freq="7D").repeat(2)
+    )
+
+    cutoff, *ranges = fold_ranges(dates, ["2018-01-29"], horizon=1)[0]
+    assert cutoff == pd.Timestamp("2018-01-29")
+    assert ranges == [0, 8, 8, 10]
+
+    _, *ranges = fold_ranges(
+        dates, ["2018-01-29"], horizon=2, val_weeks=2, window_weeks=2
+    )[0]
+    assert ranges == [4, 6, 8, 12]
@@ -0,0 +1,89 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from catboost import CatBoostRegressor
+
+from scr.batch_prediction import (
+    arrow_stream_chunks,
+    ndjson_chunks,
+    open_record_batches,
+    predict_record_batches,
+)
+
+FEATURE_TYPES = {
+    "product_category_name": "text",
+    "sales_amount_sum": "number",
+}
+
+
+def make_features(num_rows):
+    return pd.DataFrame(
+        {
+            "order_purchase_date": "2018-05-07",
+            "product_category_name": np.where(
+                np.arange(num_rows) % 2, "beleza_saude", "esporte_lazer"
+            ),
+            "sales_amount_sum": np.arange(num_rows, dtype="float64"),
+        }
+    )
+
+
+@pytest.mark.parametrize("input_format", ["csv", "parquet", "arrow_stream"])
+def test_predict_record_batches(input_format):
+
+    x_df = make_features(25)
+    model = CatBoostRegressor(iterations=5, verbose=0).fit(
+        x_df[list(FEATURE_TYPES)],
+        x_df["sales_amount_sum"],
+        cat_features=[0],
+    )
+
+    source = io.BytesIO()
+    if input_format == "csv":
+        x_df.to_csv(source, index=False)
+    elif input_format == "parquet":
+        x_df.to_parquet(source, index=False)
+    else:
+        table = pa.Table.from_pandas(x_df, preserve_index=False)
+        with pa.ipc.new_stream(source, table.schema) as writer:
+            writer.write_table(table)
+    source.seek(0)
+
+    batches = open_record_batches(
+        source, input_format, FEATURE_TYPES, batch_rows=10
+    )
+    prediction_chunks = list(predict_record_batches(model, batches, [0]))
+
+    assert [len(chunk) for chunk in prediction_chunks] == [10, 10, 5]
+    np.testing.assert_allclose(
+        np.concatenate(prediction_chunks),
+        model.predict(x_df[list(FEATURE_TYPES)]),
+    )
+
+
+def test_open_record_batches_missing_features():
+
+    source = io.BytesIO()
+    make_features(3).drop("sales_amount_sum", axis=1).to_parquet(source)
+
+    with pytest.raises(ValueError, match="sales_amount_sum"):
+        open_record_batches(source, "parquet", FEATURE_TYPES)
+
+
+def test_output_encoders():
+
+    prediction_chunks = [np.array([1.5, 2.0]), np.array([3.25])]
+
+    ndjson = b"".join(ndjson_chunks(prediction_chunks)).decode()
+    assert ndjson.splitlines() == [
+        '{"prediction": 1.5}',
+        '{"prediction": 2.0}',
+        '{"prediction": 3.25}',
+    ]
+
+    arrow_bytes = b"".join(arrow_stream_chunks(prediction_chunks))
+    table = pa.ipc.open_stream(arrow_bytes).read_all()
+    assert table["prediction"].to_pylist() == [1.5, 2.0, 3.25]
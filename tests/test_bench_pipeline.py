@@ -0,0 +1,104 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.bench_pipeline import best_of, compare_to_baseline, time_stage
+from benchmarks.synthetic_olist import iter_olist_chunks, write_olist_datasets
+from scr.model_pipeline.data_preparation import join_orders, read_raw_datasets
+
+
+def test_chunked_datasets_have_the_olist_schema(tmp_path):
+
+    write_olist_datasets(
+        iter_olist_chunks(
+            2500, num_categories=5, num_cities=20, chunk_orders=1000
+        ),
+        tmp_path,
+    )
+    orders_df, order_items_df, products_df, customers_df = read_raw_datasets(
+        f"{tmp_path}/"
+    )
+
+    assert len(orders_df) == len(customers_df) == 2500
+    assert orders_df["order_id"].is_unique
+    assert set(order_items_df["order_id"]) == set(orders_df["order_id"])
+    assert products_df["product_category_name"].nunique() <= 5
+    assert customers_df["customer_city"].nunique() <= 20
+    joined_df = join_orders(
+        orders_df, order_items_df, products_df, customers_df
+    )
+    assert joined_df["order_purchase_date"].dt.dayofweek.eq(0).all()
+    assert joined_df["sales_amount"].sum() == len(order_items_df)
+
+    # timestamps written in the format of the Olist files
+    pd.to_datetime(
+        orders_df["order_purchase_timestamp"], format="%Y-%m-%d %H:%M:%S"
+    )
+
+
+def test_regressions_against_the_baseline():
+
+    def stage(seconds, peak_memory_mb, rows=1000):
+        return {
+            "seconds": seconds,
+            "rows": rows,
+            "rows_per_second": round(rows / seconds),
+            "peak_memory_mb": peak_memory_mb,
+        }
+
+    baseline = {"join_orders": stage(1.0, 100), "train": stage(10.0, 500)}
+    stages = best_of(
+        [
+            {"join_orders": stage(1.2, 130), "train": stage(14.0, 500)},
+            {"join_orders": stage(3.0, 110), "train": stage(11.0, 520)},
+            {"join_orders": stage(1.1, 150), "train": stage(12.0, 510)},
+        ]
+    )
+
+    assert stages["join_orders"] == stage(1.1, 110)
+    assert compare_to_baseline(stages, baseline, 0.25, 0.2, 0.2, 5) == []
+    assert compare_to_baseline(stages, baseline, 0.05, 0.05, 0.2, 5) == [
+        "join_orders: peak memory 110 MB, baseline 100 MB",
+        "train: 11.00s, baseline 10.00s",
+    ]
+    # slowdowns below min_seconds are noise
+    assert compare_to_baseline(stages, baseline, 0.05, 0.2, 0.5, 5) == [
+        "train: 11.00s, baseline 10.00s"
+    ]
+    # and so are peak memory increases below min_megabytes
+    assert (
+        compare_to_baseline(
+            {"score_batch": stage(1.0, 2)},
+            {"score_batch": stage(1.0, 1)},
+            0.25,
+            0.2,
+            0.2,
+            5,
+        )
+        == []
+    )
+    assert compare_to_baseline(stages, baseline, 0.05, 0.05, 0.2, 32) == [
+        "train: 11.00s, baseline 10.00s"
+    ]
+
+
+@pytest.mark.skipif(
+    not Path("/proc/self/clear_refs").exists(),
+    reason="the peak memory is only reset on Linux",
+)
+def test_stage_memory_is_counted_from_its_start():
+
+    # 256MB held by a previous stage
+    previous = np.ones(2**25)
+    previous[:] = 2.0
+
+    total, stats = time_stage(
+        lambda size: np.ones(size).sum(), lambda _: 2**24, 2**24
+    )
+
+    assert total == stats["rows"] == 2**24
+    # the 128MB of the stage only
+    assert 100 < stats["peak_memory_mb"] < 200
+    assert previous.sum() == 2**26
@@ -1,6 +1,12 @@
 import pandas as pd
+from workalendar.america import Brazil, BrazilSaoPauloCity
 
-from scr.model_pipeline.data_preparation import aggregate_cols_by_dates
+from scr.model_pipeline.data_preparation import (
+    add_holidays,
+    add_timestamp_features,
+    aggregate_cols_by_dates,
+    avoid_gap_dates,
+)
 
 
 def test_prepare_data():
@@ -91,3 +97,94 @@ def test_prepare_data():
     )
 
     assert all(actual_df == expected_df)
+
+
+def test_add_timestamp_features():
+
+    df = pd.DataFrame(
+        {
+            "order_purchase_timestamp": [
+                "2017-10-02 10:56:33",
+                "2018-07-24 20:41:37",
+                "2018-01-01 00:00:00",
+                "2017-12-31 23:59:59",
+            ]
+        }
+    )
+
+    actual_df = add_timestamp_features(df, "order_purchase_timestamp")
+
+    assert actual_df["order_purchase_date"].tolist() == list(
+        pd.to_datetime(
+            ["2017-10-02", "2018-07-23", "2018-01-01", "2017-12-25"]
+        )
+    )
+    assert actual_df["order_purchase_original_date"].tolist() == list(
+        pd.to_datetime(
+            ["2017-10-02", "2018-07-24", "2018-01-01", "2017-12-31"]
+        )
+    )
+    assert actual_df["order_purchase_month"].tolist() == list(
+        pd.to_datetime(
+            ["2017-10-01", "2018-07-01", "2018-01-01", "2017-12-01"]
+        )
+    )
+    assert actual_df["daytime_in_minutes"].tolist() == [656, 1241, 0, 1439]
+
+
+def test_add_holidays():
+
+    df = pd.DataFrame(
+        {
+            "order_purchase_date": pd.to_datetime(
+                ["2019-12-25", "2017-01-02", "2020-11-20", "2018-09-07"]
+            )
+        }
+    )
+
+    actual_df = add_holidays(df.copy(), cal=Brazil())
+    assert actual_df["flag_holiday"].tolist() == [1, 0, 0, 1]
+    assert actual_df["holiday"].tolist()[:2] == ["Christmas Day", "missing"]
+
+    actual_df = add_holidays(df.copy(), cal=BrazilSaoPauloCity())
+    assert actual_df["flag_holiday"].tolist() == [1, 0, 1, 1]
+
+    # a chunk without orders
+    actual_df = add_holidays(df[:0].copy(), cal=Brazil())
+    assert actual_df.empty
+    assert {"holiday", "flag_holiday"} <= set(actual_df.columns)
+
+
+def test_avoid_gap_dates():
+
+    df = pd.DataFrame(
+        {
+            "order_purchase_date": pd.to_datetime(
+                ["2018-04-23", "2018-05-07", "2018-04-30"]
+            ),
+            "product_category_name": ["beleza_saude"] * 2 + ["esporte_lazer"],
+            "customer_city": ["sao paulo"] * 3,
+            "sales_amount_sum": [3.0, 5.0, 7.0],
+            "freight_mean": [1.0, 2.0, 3.0],
+        }
+    )
+
+    actual_df = avoid_gap_dates(
+        df, "order_purchase_date", ["product_category_name", "customer_city"]
+    )
+    assert len(actual_df) == 6
+    assert actual_df["sales_amount_sum"].tolist() == [3, 0, 0, 7, 5, 0]
+    assert actual_df["freight_mean"].isna().sum() == 3
+
+    actual_df = avoid_gap_dates(
+        df.iloc[[1]],
+        "order_purchase_date",
+        ["product_category_name", "customer_city"],
+        dates=pd.to_datetime(["2018-05-07"]),
+        series_df=df,
+    )
+    assert actual_df["product_category_name"].tolist() == [
+        "beleza_saude",
+        "esporte_lazer",
+    ]
+    assert actual_df["sales_amount_sum"].tolist() == [5, 0]
@@ -0,0 +1,128 @@
+import pandas as pd
+import pytest
+
+from scr.model_pipeline.dataset_store import DatasetStore, get_dataset_store
+
+
+@pytest.mark.parametrize("storage_format", ["parquet", "csv"])
+def test_dataset_store_round_trip(tmp_path, storage_format):
+
+    df = pd.DataFrame(
+        {
+            "order_purchase_date": pd.to_datetime(
+                ["2018-04-23", "2018-04-30", "2018-05-07", "2018-05-14"]
+            ),
+            "product_category_name": pd.Categorical(
+                ["beleza_saude", "esporte_lazer"] * 2
+            ),
+            "sales_amount_sum": [3, 5, 0, 7],
+        }
+    )
+    store = get_dataset_store(tmp_path, storage_format)
+    store.write(df, "2018-05-01/x_val")
+
+    actual_df = store.read(
+        "2018-05-01/x_val",
+        columns=["order_purchase_date", "sales_amount_sum"],
+        start_date="2018-04-30",
+        end_date="2018-05-14",
+    )
+
+    assert list(actual_df.columns) == [
+        "order_purchase_date",
+        "sales_amount_sum",
+    ]
+    assert actual_df["sales_amount_sum"].tolist() == [5, 0]
+    assert pd.api.types.is_datetime64_any_dtype(
+        actual_df["order_purchase_date"]
+    )
+    if storage_format == "parquet":
+        assert isinstance(
+            store.read("2018-05-01/x_val")["product_category_name"].dtype,
+            pd.CategoricalDtype,
+        )
+
+
+@pytest.mark.parametrize("storage_format", ["parquet", "csv"])
+def test_dataset_store_append(tmp_path, storage_format):
+
+    df = pd.DataFrame(
+        {
+            "order_purchase_date": pd.to_datetime(["2018-04-23"]),
+            "sales_amount_sum": [3.0],
+        }
+    )
+    store = get_dataset_store(tmp_path, storage_format)
+    store.append(df, "model_data")
+    store.append(
+        pd.DataFrame(
+            {
+                "sales_amount_sum": [5.0],
+                "order_purchase_date": pd.to_datetime(["2018-04-30"]),
+            }
+        ),
+        "model_data",
+    )
+
+    actual_df = store.read("model_data", start_date="2018-04-30")
+    assert actual_df["sales_amount_sum"].tolist() == [5.0]
+    assert len(store.read("model_data")) == 2
+    assert store.columns("model_data") == [
+        "order_purchase_date",
+        "sales_amount_sum",
+    ]
+
+
+@pytest.mark.parametrize("storage_format", ["parquet", "csv"])
+def test_dataset_store_reads_columns_without_the_date(
+    tmp_path, storage_format
+):
+
+    store = get_dataset_store(tmp_path, storage_format)
+    store.write(
+        pd.DataFrame(
+            {
+                "order_purchase_date": pd.to_datetime(["2018-04-23"]),
+                "sales_amount_sum": [3.0],
+            }
+        ),
+        "model_data",
+    )
+
+    actual_df = store.read("model_data", columns=["sales_amount_sum"])
+    assert list(actual_df.columns) == ["sales_amount_sum"]
+    assert actual_df["sales_amount_sum"].tolist() == [3.0]
+
+
+@pytest.mark.parametrize("storage_format", ["parquet", "csv"])
+def test_dataset_store_reads_rows_with_the_given_values(
+    tmp_path, storage_format
+):
+
+    store = get_dataset_store(tmp_path, storage_format)
+    store.write(
+        pd.DataFrame(
+            {
+                "customer_id": ["c1", "c2", "c3"],
+                "customer_city": ["sao paulo", "rio", "curitiba"],
+            }
+        ),
+        "state/seen_clients",
+    )
+
+    actual_df = store.read(
+        "state/seen_clients",
+        columns=["customer_city"],
+        isin={"customer_id": ["c3", "c1", "c4"]},
+    )
+    assert actual_df["customer_city"].tolist() == ["sao paulo", "curitiba"]
+
+
+def test_incomplete_store_fails_when_created(tmp_path):
+
+    class WriteOnlyStore(DatasetStore):
+        def _write(self, df, path):
+            df.to_pickle(path)
+
+    with pytest.raises(TypeError, match="abstract"):
+        WriteOnlyStore(tmp_path)
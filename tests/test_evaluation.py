@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+
+from scr.model_pipeline.evaluation import (
+    add_baseline_forecasts,
+    evaluate_forecasts,
+)
+
+
+def test_evaluate_forecasts():
+
+    df = pd.DataFrame(
+        {
+            "product_category_name": ["beleza_saude"] * 3
+            + ["esporte_lazer"] * 2,
+            "actual_value": [10.0, 0.0, 20.0, 5.0, np.nan],
+            "forecast": [12.0, 1.0, 15.0, 5.0, 3.0],
+        }
+    )
+
+    actual_df = evaluate_forecasts(
+        df, "actual_value", ["forecast"], ["product_category_name"]
+    )
+
+    beleza = actual_df.iloc[0]
+    assert beleza["product_category_name"] == "beleza_saude"
+    assert np.isclose(beleza["rmse"], np.sqrt((4 + 1 + 25) / 3))
+    assert np.isclose(beleza["mape"], 100 * (0.2 + 0.25) / 2)
+    assert np.isclose(beleza["wape"], 100 * 8 / 30)
+    assert np.isclose(beleza["bias"], -2 / 3)
+    assert actual_df.iloc[1][["rmse", "count"]].tolist() == [0, 1]
+
+    overall_df = evaluate_forecasts(df, "actual_value", ["forecast"])
+    assert overall_df["count"].tolist() == [4]
+
+    # rows with a missing group key are left out of every group
+    df.loc[0, "product_category_name"] = np.nan
+    actual_df = evaluate_forecasts(
+        df, "actual_value", ["forecast"], ["product_category_name"]
+    )
+    assert actual_df["count"].tolist() == [2, 1]
+
+
+def test_add_baseline_forecasts():
+
+    df = pd.DataFrame(
+        {
+            "product_category_name": ["beleza_saude", "esporte_lazer"] * 4,
+            "sales_amount_sum": [1.0, 10.0, 2.0, 20.0, 3.0, 30.0, 6.0, 40.0],
+        }
+    )
+
+    actual_df = add_baseline_forecasts(
+        df, "sales_amount_sum", ["product_category_name"], window=3
+    )
+
+    expected = (
+        df.groupby("product_category_name")["sales_amount_sum"]
+        .rolling(3, min_periods=1)
+        .mean()
+        .reset_index(level=0, drop=True)
+        .sort_index()
+    )
+    np.testing.assert_allclose(actual_df["ma_forecast"], expected)
+    assert actual_df["latest_value_forecast"].equals(df["sales_amount_sum"])
+
+
+def test_moving_average_of_a_series_after_a_missing_value():
+
+    df = pd.DataFrame(
+        {
+            "product_category_name": ["beleza_saude"] * 3
+            + ["esporte_lazer"] * 2,
+            "sales_amount_sum": [1.0, np.nan, 3.0, 3.0, 5.0],
+        }
+    )
+
+    actual_df = add_baseline_forecasts(
+        df, "sales_amount_sum", ["product_category_name"], window=2
+    )
+
+    np.testing.assert_allclose(
+        actual_df["ma_forecast"], [1.0, 1.0, 3.0, 3.0, 4.0]
+    )
@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+
+from scr.model_pipeline.feature_engineering import (
+    add_rolling_features,
+    add_tendency_features,
+    rolling_state,
+    tendency_state,
+    update_rolling_features,
+    update_tendency_features,
+)
+
+
+def test_add_tendency_features():
+
+    df = pd.DataFrame(
+        {
+            "product_category_name": ["a", "b", "a", "b", "a", "a"],
+            "customer_city": ["sao paulo"] * 6,
+            "sales_amount_sum": [2, 10, 4, np.nan, 6, 0],
+        }
+    )
+
+    actual_df = add_tendency_features(
+        df,
+        feat_list=["sales_amount_sum", "sales_amount_sum"],
+        key_col_list=["product_category_name", "customer_city"],
+        lags=(1, 2),
+    )
+
+    assert list(actual_df.columns[3:]) == [
+        "sales_amount_sum_lag",
+        "sales_amount_sum_lag2",
+        "sales_amount_sum_historical_mean",
+        "sales_amount_sum_historical_diff",
+    ]
+    np.testing.assert_array_equal(
+        actual_df["sales_amount_sum_lag"],
+        [np.nan, np.nan, 2, 10, 4, 6],
+    )
+    np.testing.assert_array_equal(
+        actual_df["sales_amount_sum_lag2"],
+        [np.nan, np.nan, np.nan, np.nan, 2, 4],
+    )
+    np.testing.assert_array_equal(
+        actual_df["sales_amount_sum_historical_mean"],
+        [2, 10, 3, np.nan, 4, 3],
+    )
+    np.testing.assert_array_equal(
+        actual_df["sales_amount_sum_historical_diff"],
+        [0, 0, 1 / 3, np.nan, 0.5, -1],
+    )
+
+
+def test_rows_with_a_missing_key_have_no_features():
+
+    df = pd.DataFrame(
+        {
+            "product_category_name": ["a", None, "a", None, "a"],
+            "customer_city": ["sao paulo"] * 5,
+            "sales_amount_sum": [2.0, 10, 4, 8, 6],
+        }
+    )
+    key_col_list = ["product_category_name", "customer_city"]
+
+    actual_df = add_rolling_features(
+        add_tendency_features(
+            df, ["sales_amount_sum"], key_col_list, lags=(1,)
+        ),
+        ["sales_amount_sum"],
+        key_col_list,
+        windows=(2,),
+        ewm_spans=(2,),
+    )
+
+    feature_cols = actual_df.columns[3:]
+    assert actual_df.loc[[1, 3], feature_cols].isna().all().all()
+    np.testing.assert_array_equal(
+        actual_df.loc[[0, 2, 4], "sales_amount_sum_rolling_mean2"], [2, 3, 5]
+    )
+
+
+def test_update_rolling_features():
+
+    df = pd.DataFrame(
+        {
+            "product_category_name": ["a", "b"] * 5,
+            "customer_city": ["sao paulo"] * 10,
+            "sales_amount_sum": [1, 5, 2, np.nan, 3, 5, 4, 6, 8, 0],
+        }
+    )
+    key_col_list = ["product_category_name", "customer_city"]
+
+    full_df = add_rolling_features(
+        df, ["sales_amount_sum"], key_col_list, windows=(3,), ewm_spans=(3,)
+    )
+    expected = full_df["sales_amount_sum"].groupby(
+        full_df["product_category_name"]
+    )
+    np.testing.assert_allclose(
+        full_df["sales_amount_sum_rolling_mean3"],
+        expected.transform(lambda x: x.rolling(3, min_periods=1).mean()),
+    )
+    np.testing.assert_allclose(
+        full_df["sales_amount_sum_ewm3"],
+        expected.transform(
+            lambda x: x.ewm(span=3, adjust=False, ignore_na=True).mean()
+        ),
+    )
+
+    history_df = add_rolling_features(
+        df[:8],
+        ["sales_amount_sum"],
+        key_col_list,
+        windows=(3,),
+        ewm_spans=(3,),
+    )
+    new_df, state_df = update_rolling_features(
+        rolling_state(history_df, ["sales_amount_sum"], key_col_list, (3,)),
+        df[8:],
+        ["sales_amount_sum"],
+        key_col_list,
+        windows=(3,),
+        ewm_spans=(3,),
+    )
+
+    pd.testing.assert_frame_equal(
+        new_df.reset_index(drop=True),
+        full_df[8:].reset_index(drop=True),
+    )
+    assert len(state_df) == 4
+
+
+def test_update_tendency_features():
+
+    df = pd.DataFrame(
+        {
+            "product_category_name": ["a", "b"] * 5,
+            "customer_city": ["sao paulo"] * 10,
+            "order_purchase_date": pd.date_range(
+                "2018-01-01", periods=5, freq="7D"
+            ).repeat(2),
+            "sales_amount_sum": [1, 5, 2, np.nan, 3, 5, 4, 6, 8, 0],
+        }
+    )
+    key_col_list = ["product_category_name", "customer_city"]
+
+    full_df = add_tendency_features(
+        df, ["sales_amount_sum"], key_col_list, lags=(1, 2)
+    )
+    new_df, state_df = update_tendency_features(
+        tendency_state(df[:6], ["sales_amount_sum"], key_col_list, (1, 2)),
+        df[6:],
+        ["sales_amount_sum"],
+        key_col_list,
+        lags=(1, 2),
+    )
+
+    pd.testing.assert_frame_equal(new_df, full_df[6:].reset_index(drop=True))
+    assert state_df["historical_count"].tolist() == [4, 4, 5, 5]
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+from scr.model_pipeline.dataset_store import get_dataset_store
+from scr.model_pipeline.feature_store import (
+    FeatureStore,
+    export_feature_store,
+)
+
+
+def test_feature_store_lookup(tmp_path):
+
+    model_data = pd.DataFrame(
+        {
+            "order_purchase_date": pd.to_datetime(
+                ["2018-04-23", "2018-04-30", "2018-04-23", "2018-04-30"]
+            ),
+            "product_category_name": ["beleza_saude"] * 2
+            + ["esporte_lazer"] * 2,
+            "customer_state": "SP",
+            "customer_city": "sao paulo",
+            "sales_amount_sum": [1.0, 2.0, 3.0, 4.0],
+            "sales_amount_sum_lag": [np.nan, 1.0, np.nan, 3.0],
+        }
+    )
+    store = get_dataset_store(tmp_path, "parquet")
+    store.write(model_data, "model_data")
+    export_feature_store(
+        store, tmp_path / "feature_store", columns_per_read=1
+    )
+
+    feature_store = FeatureStore(tmp_path / "feature_store")
+    # any day of the week finds the row of the week
+    rows = feature_store.find_rows(
+        ["esporte_lazer", "beleza_saude", "beleza_saude", "moveis_decoracao"],
+        ["sao paulo", "sao paulo", "rio de janeiro", "sao paulo"],
+        ["2018-05-03", "2018-04-23", "2018-04-23", "2018-04-23"],
+    )
+    assert rows[2:].tolist() == [-1, -1]
+
+    actual = feature_store.model_input(
+        rows[:2],
+        ["esporte_lazer", "beleza_saude"],
+        ["sao paulo", "sao paulo"],
+        ["customer_state", "sales_amount_sum_lag", "sales_amount_sum"],
+    )
+    assert actual[:, 0].tolist() == ["SP", "SP"]
+    np.testing.assert_array_equal(
+        actual[:, 1:].astype("float64"), [[3.0, 4.0], [np.nan, 1.0]]
+    )
@@ -0,0 +1,59 @@
+from scr.forecast_cache import ForecastCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_least_recently_used_entry_is_evicted():
+
+    cache = ForecastCache(max_size=2, ttl_seconds=60)
+    assert cache.get_many("1", ["a", "b"]) == [None, None]
+    cache.put_many("1", ["a", "b"], [1.0, 2.0])
+    assert cache.get_many("1", ["a"]) == [1.0]
+    cache.put_many("1", ["c"], [3.0])
+
+    assert cache.get_many("1", ["a", "b", "c"]) == [1.0, None, 3.0]
+    assert cache.stats() == {
+        "model_version": "1",
+        "size": 2,
+        "hits": 3,
+        "misses": 3,
+        "evictions": 1,
+        "hit_ratio": 0.5,
+    }
+
+
+def test_entries_expire_after_ttl():
+
+    clock = FakeClock()
+    cache = ForecastCache(max_size=10, ttl_seconds=60, clock=clock)
+    cache.get_many("1", [])
+    cache.put_many("1", [("beleza_saude", "sao paulo", 2800)], [12.5])
+
+    clock.now = 59
+    assert cache.get_many("1", [("beleza_saude", "sao paulo", 2800)]) == [
+        12.5
+    ]
+    clock.now = 60
+    assert cache.get_many("1", [("beleza_saude", "sao paulo", 2800)]) == [
+        None
+    ]
+    assert cache.stats()["size"] == 0
+
+
+def test_new_model_version_invalidates_entries():
+
+    cache = ForecastCache(max_size=10, ttl_seconds=60)
+    cache.get_many("1", [])
+    cache.put_many("1", ["a"], [1.0])
+
+    assert cache.get_many("2", ["a"]) == [None]
+    # late results of the previous version are not stored
+    cache.put_many("1", ["a"], [1.0])
+    assert cache.get_many("2", ["a"]) == [None]
+    assert cache.stats()["size"] == 0
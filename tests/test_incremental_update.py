@@ -0,0 +1,88 @@
+import pandas as pd
+from click.testing import CliRunner
+from workalendar.america import Brazil
+
+from benchmarks.synthetic_olist import iter_olist_chunks, write_olist_datasets
+from scr.model_pipeline.data_preparation import (
+    CLIENT_KEY_COLS,
+    add_order_features,
+    aggregate_weekly,
+    join_orders,
+    read_raw_datasets,
+)
+from scr.model_pipeline.dataset_store import get_dataset_store
+from scr.model_pipeline.feature_engineering import build_model_data
+from scr.model_pipeline.incremental_update import (
+    read_week_raw_datasets,
+    run_incremental_update,
+)
+
+
+def test_read_week_raw_datasets_keeps_the_orders_of_the_week(tmp_path):
+
+    write_olist_datasets(
+        iter_olist_chunks(3000, num_categories=5, num_cities=20), tmp_path
+    )
+    week_start = pd.Timestamp("2017-06-05")
+
+    orders_df, order_items_df, products_df, customers_df = (
+        read_week_raw_datasets(f"{tmp_path}/", week_start, chunksize=500)
+    )
+
+    all_orders_df, all_items_df, all_products_df, _ = read_raw_datasets(
+        f"{tmp_path}/"
+    )
+    purchase = pd.to_datetime(all_orders_df["order_purchase_timestamp"])
+    week_orders_df = all_orders_df[
+        (purchase >= week_start) & (purchase < "2017-06-12")
+    ]
+    assert len(week_orders_df) > 0
+    assert (
+        orders_df["order_id"].tolist() == week_orders_df["order_id"].tolist()
+    )
+    assert (
+        len(order_items_df)
+        == all_items_df["order_id"].isin(week_orders_df["order_id"]).sum()
+    )
+    assert set(customers_df["customer_id"]) == set(orders_df["customer_id"])
+    assert len(products_df) == len(all_products_df)
+
+
+def test_week_without_orders_adds_zero_sales_rows(tmp_path):
+
+    write_olist_datasets(
+        iter_olist_chunks(2000, num_categories=3, num_cities=5),
+        tmp_path / "raw",
+    )
+    joined_df = add_order_features(
+        join_orders(*read_raw_datasets(f"{tmp_path}/raw/")), cal=Brazil()
+    )
+    national_df, final_df = aggregate_weekly(joined_df, "all")
+    store = get_dataset_store(tmp_path / "processed", "parquet")
+    store.write(national_df, "national_orders_by_week")
+    store.write(final_df, "orders_by_week")
+    store.write(
+        joined_df[CLIENT_KEY_COLS].drop_duplicates(), "state/seen_clients"
+    )
+    build_model_data(store)
+    # the week after the last orders has none
+    week_start = final_df["order_purchase_date"].max() + pd.Timedelta(7, "D")
+
+    result = CliRunner().invoke(
+        run_incremental_update,
+        [
+            f"--week={week_start:%Y-%m-%d}",
+            f"--raw-path={tmp_path}/raw/",
+            f"--source-path={tmp_path}/processed/",
+            "--storage-format=parquet",
+        ],
+    )
+
+    assert result.exit_code == 0, result.output
+    week_df = store.read("orders_by_week", start_date=week_start)
+    num_series = len(
+        final_df[["product_category_name", "customer_city"]].drop_duplicates()
+    )
+    assert len(week_df) == num_series
+    assert week_df["sales_amount_sum"].eq(0).all()
+    assert len(store.read("model_data", start_date=week_start)) == num_series
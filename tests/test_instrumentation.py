@@ -0,0 +1,71 @@
+import pandas as pd
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from scr.instrumentation import PIPELINE_REGISTRY, instrument_app, track_stage
+from scr.model_pipeline.dataset_store import get_dataset_store
+
+
+def test_track_stage_records_rows_duration_and_memory(tmp_path):
+
+    store = get_dataset_store(tmp_path, "parquet")
+    store.write(pd.DataFrame({"sales_amount_sum": [1.0, 2.0]}), "before")
+
+    @track_stage("test_stage")
+    def run_stage():
+        df = store.read("before")
+        store.write(pd.concat([df, df]), "after")
+
+    run_stage()
+
+    def sample(name, **labels):
+        return PIPELINE_REGISTRY.get_sample_value(
+            name, {"stage": "test_stage", **labels}
+        )
+
+    assert (
+        sample("pipeline_stage_rows", dataset="before", operation="read") == 2
+    )
+    assert (
+        sample("pipeline_stage_rows", dataset="after", operation="write") == 4
+    )
+    assert sample("pipeline_stage_duration_seconds") > 0
+    assert sample("pipeline_stage_peak_memory_bytes") > 2**20
+    assert sample("pipeline_stage_last_success_timestamp_seconds") > 0
+    # outside of a stage nothing is recorded
+    store.read("after")
+    assert (
+        sample("pipeline_stage_rows", dataset="after", operation="read")
+        is None
+    )
+
+
+def test_instrument_app_times_requests_by_route():
+
+    app = FastAPI()
+    instrument_app(app, "test_app")
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: int):
+        return {"item_id": item_id}
+
+    client = TestClient(app)
+    client.get("/items/1")
+    client.get("/items/2")
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert 'endpoint="/items/{item_id}"' in response.text
+    assert (
+        REGISTRY.get_sample_value(
+            "api_request_duration_seconds_count",
+            {
+                "app": "test_app",
+                "endpoint": "/items/{item_id}",
+                "method": "GET",
+                "status": "200",
+            },
+        )
+        == 2
+    )
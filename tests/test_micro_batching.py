@@ -0,0 +1,50 @@
+import asyncio
+
+from scr.micro_batching import MicroBatcher
+
+
+def test_micro_batcher_coalesces_requests():
+
+    batch_sizes = []
+
+    def double(items):
+        batch_sizes.append(len(items))
+        return [2 * item for item in items]
+
+    async def run():
+        batcher = MicroBatcher(
+            double, max_batch_size=64, max_wait_ms=20, num_workers=1
+        )
+        await batcher.start()
+        results = await asyncio.gather(
+            *[batcher.submit([i, i + 100]) for i in range(50)]
+        )
+        await batcher.stop()
+        return results
+
+    results = asyncio.run(run())
+
+    assert results == [[2 * i, 2 * i + 200] for i in range(50)]
+    assert sum(batch_sizes) == 100
+    assert len(batch_sizes) < 50
+    assert max(batch_sizes) <= 64 + 1
+
+
+def test_micro_batcher_error_reaches_every_request():
+
+    def fail(items):
+        raise ValueError(f"{len(items)} items")
+
+    async def run():
+        batcher = MicroBatcher(fail, max_wait_ms=20)
+        await batcher.start()
+        results = await asyncio.gather(
+            batcher.submit([1]), batcher.submit([2]), return_exceptions=True
+        )
+        await batcher.stop()
+        return results
+
+    results = asyncio.run(run())
+
+    assert [str(result) for result in results] == ["2 items", "2 items"]
+    assert all(isinstance(result, ValueError) for result in results)
@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+from catboost import CatBoostRegressor
+
+from scr.model_cache import ModelCache, read_cache_entry, write_cache_entry
+
+
+def train_model(seed):
+    x_df = pd.DataFrame(
+        {
+            "product_category_name": ["beleza_saude", "esporte_lazer"] * 10,
+            "sales_amount_sum": np.arange(20.0),
+        }
+    )
+    model = CatBoostRegressor(
+        iterations=5,
+        cat_features=["product_category_name"],
+        random_seed=seed,
+        verbose=0,
+    )
+
+    return model.fit(x_df, np.arange(20.0))
+
+
+class FakeRegistry:
+    def __init__(self, version):
+        self.version = version
+
+    def get_latest_versions(self, name, stages):
+        if self.version is None:
+            return []
+        return [
+            SimpleNamespace(name=name, stage=stages[0], version=self.version)
+        ]
+
+
+def test_write_and_read_cache_entry(tmp_path):
+
+    model = train_model(seed=1)
+    write_cache_entry(model, 3, tmp_path)
+
+    cached_model, schema = read_cache_entry(tmp_path)
+    assert schema == {
+        "version": "3",
+        "feature_names": ["product_category_name", "sales_amount_sum"],
+        "cat_features": [0],
+        "feature_types": {
+            "product_category_name": "text",
+            "sales_amount_sum": "number",
+        },
+    }
+    x_df = pd.DataFrame(
+        {"product_category_name": ["beleza_saude"], "sales_amount_sum": [4.0]}
+    )
+    assert cached_model.predict(x_df) == model.predict(x_df)
+    assert read_cache_entry(tmp_path / "empty") is None
+
+
+def test_refresh_swaps_to_new_version(tmp_path, monkeypatch):
+
+    write_cache_entry(train_model(seed=1), 1, tmp_path)
+    registry = FakeRegistry(version=1)
+    model_cache = ModelCache(tmp_path, client=registry)
+    model_cache.load()
+    first_model = model_cache.current[0]
+
+    assert not model_cache.refresh()
+    assert model_cache.current[0] is first_model
+
+    registry.version = 2
+    monkeypatch.setattr(
+        "scr.model_cache.load_registry_model",
+        lambda model_name, version: train_model(seed=2),
+    )
+    assert model_cache.refresh()
+    assert model_cache.current[2] == "2"
+    assert read_cache_entry(tmp_path)[1]["version"] == "2"
+
+
+def test_load_without_any_version(tmp_path):
+
+    model_cache = ModelCache(tmp_path, client=FakeRegistry(version=None))
+
+    assert model_cache.load() is None
+    with pytest.raises(RuntimeError, match="No Production version"):
+        model_cache.load(required=True)
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+from scr import monitor
+from scr.model_pipeline.dataset_store import get_dataset_store
+
+
+class LastWeekModel:
+    def predict(self, df):
+        return df["sales_amount_sum"].to_numpy()
+
+
+def test_week_stats_has_the_errors_of_the_next_week_targets(
+    tmp_path, monkeypatch
+):
+
+    dates = pd.date_range("2018-04-02", periods=3, freq="W-MON")
+    store = get_dataset_store(tmp_path, "parquet")
+    store.write(
+        pd.DataFrame(
+            {
+                "order_purchase_date": np.repeat(dates, 2),
+                "product_category_name": ["beleza_saude"] * 6,
+                "customer_city": ["sao paulo", "campinas"] * 3,
+                "sales_amount_sum": [1.0, 10.0, 3.0, 14.0, 2.0, 12.0],
+            }
+        ),
+        "model_data",
+    )
+    schema = {
+        "feature_names": ["product_category_name", "sales_amount_sum"],
+        "feature_types": {
+            "product_category_name": "text",
+            "sales_amount_sum": "number",
+        },
+    }
+    monkeypatch.setitem(
+        monitor.MONITOR_MODEL, "current", (LastWeekModel(), schema, "1")
+    )
+
+    stats = monitor.week_stats(
+        dates[0], f"{tmp_path}/", "parquet", "sales_amount_sum", None
+    )
+
+    assert stats.rows == 2
+    # predictions 1 and 10 for the targets 3 and 14
+    assert stats.errors == {
+        "rows": 2,
+        "abs": 6.0,
+        "squared": 20.0,
+        "sum": -6.0,
+    }
+    last_week = monitor.week_stats(
+        dates[2], f"{tmp_path}/", "parquet", "sales_amount_sum", None
+    )
+    assert last_week.rows == 2
+    assert last_week.errors["rows"] == 0
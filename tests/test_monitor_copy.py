@@ -0,0 +1,19 @@
+import pandas as pd
+
+from scr.monitoring.monitor_copy import new_scored_files
+
+
+def test_new_scored_files_of_the_served_version(tmp_path):
+
+    for name in ["x_val_v1", "x_val_v2", "batch_001", "batch_002"]:
+        pd.DataFrame({"prediction": [1.0]}).to_parquet(
+            tmp_path / f"{name}.parquet"
+        )
+    (tmp_path / "batch_003.tmp").touch()
+
+    new_files = new_scored_files(
+        tmp_path, {"batch_001.parquet"}, "x_val_v2.parquet"
+    )
+
+    # the validation split scored by version 1 is left out
+    assert new_files == ["batch_002.parquet", "x_val_v2.parquet"]
@@ -0,0 +1,65 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from scr import profiling
+from scr.profiling import FUNCTION_STATS, profile_stage, profiled
+
+
+@profiled
+def allocate(size):
+    return np.ones(size).sum()
+
+
+@profiled
+def allocate_twice(size):
+    allocate(size)
+    return allocate(2 * size)
+
+
+def test_functions_are_only_profiled_when_asked(monkeypatch):
+
+    monkeypatch.delenv("PIPELINE_PROFILE", raising=False)
+    monkeypatch.setitem(profiling.SESSION, "enabled", False)
+    FUNCTION_STATS.clear()
+
+    with profile_stage("test_stage"):
+        assert allocate_twice(10) == 20
+
+    assert not FUNCTION_STATS
+
+
+def test_profile_stage_report(tmp_path, monkeypatch):
+
+    monkeypatch.setenv("PIPELINE_PROFILE", "cprofile,tracemalloc")
+    monkeypatch.setattr(profiling, "REPORT_ROOT", str(tmp_path))
+    logged = []
+    monkeypatch.setattr(
+        profiling, "log_report", lambda *report: logged.append(report)
+    )
+
+    with profile_stage("test_stage"):
+        allocate_twice(2**20)
+        with ProcessPoolExecutor(2) as pool:
+            list(pool.map(allocate, [2**10] * 4))
+
+    (report_dir,) = tmp_path.iterdir()
+    with open(report_dir / "timings.json", encoding="utf-8") as file:
+        report = json.load(file)
+    functions = report["functions"]
+    assert report["stage"] == "test_stage"
+    assert functions["test_profiling.allocate"]["calls"] == 6
+    assert functions["test_profiling.allocate_twice"]["calls"] == 1
+    # the 16MB array of the inner call is in the peak of the outer one
+    assert (
+        functions["test_profiling.allocate_twice"]["peak_alloc_bytes"]
+        >= 2 * 8 * 2**20
+    )
+    assert (
+        functions["test_profiling.allocate_twice"]["wall_seconds"]
+        <= report["wall_seconds"]
+    )
+    for name in ["profile.prof", "tracemalloc.snapshot", "timings.html"]:
+        assert (report_dir / name).exists()
+    assert logged[0][1] == report
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+from scr.model_pipeline.data_preparation import aggregate_cols_by_dates
+from scr.model_pipeline.streaming_ingestion import (
+    finalize_aggregates,
+    merge_partials,
+    partial_aggregates,
+)
+
+
+def test_partial_aggregates_match_aggregate_cols_by_dates():
+
+    rng = np.random.default_rng(42)
+    df = pd.DataFrame(
+        {
+            "order_purchase_date": pd.to_datetime("2018-01-01")
+            + pd.to_timedelta(7 * rng.integers(0, 3, 60), unit="D"),
+            "product_category_name": rng.choice(["a", "b"], 60),
+            "year": 2018,
+            "month": 1,
+            "day_of_month": rng.integers(1, 28, 60),
+            "flag_holiday": rng.integers(0, 2, 60),
+            "flag_approved_order": rng.integers(0, 2, 60),
+            "flag_new_client": rng.integers(0, 2, 60),
+            "daytime_in_minutes": rng.integers(0, 1440, 60),
+            "sales_amount": rng.integers(1, 4, 60),
+            "sales_value": rng.uniform(10, 100, 60).round(2),
+            "freight": rng.uniform(5, 20, 60).round(2),
+            "product_weight_g": rng.choice([100.0, 250.0, np.nan], 60),
+        }
+    )
+    key_cols = ["order_purchase_date", "product_category_name"]
+
+    partials = None
+    for chunk in np.array_split(df, 4):
+        partials = merge_partials(
+            partials, partial_aggregates(chunk, key_cols)
+        )
+
+    pd.testing.assert_frame_equal(
+        finalize_aggregates(partials),
+        aggregate_cols_by_dates(df, key_cols),
+        check_dtype=False,
+    )
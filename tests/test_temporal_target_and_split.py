@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+from scr.model_pipeline.dataset_store import get_dataset_store
+from scr.model_pipeline.temporal_target_and_split import (
+    add_targets,
+    split_model_data,
+)
+
+
+def test_add_targets():
+
+    df = pd.DataFrame(
+        {
+            "order_purchase_date": pd.to_datetime(
+                ["2018-04-30", "2018-04-23", "2018-04-30", "2018-04-23"]
+                + ["2018-05-07"]
+            ),
+            "product_category_name": ["beleza_saude"] * 5,
+            "customer_city": ["sao paulo", "sao paulo", "campinas"]
+            + ["campinas", "sao paulo"],
+            "sales_amount_sum": [2.0, 1.0, 20.0, 10.0, 3.0],
+        }
+    )
+
+    actual_df = add_targets(df, "sales_amount_sum", [1, 2])
+
+    expected_df = df.sort_values("order_purchase_date", kind="stable")
+    for horizon in [1, 2]:
+        expected = expected_df.groupby(
+            ["product_category_name", "customer_city"]
+        )["sales_amount_sum"].shift(-horizon)
+        pd.testing.assert_series_equal(
+            actual_df[f"target_{horizon}_semana"],
+            expected,
+            check_names=False,
+        )
+
+
+def test_split_model_data_by_columns(tmp_path):
+
+    dates = pd.date_range("2018-04-02", periods=8, freq="W-MON")
+    df = pd.DataFrame(
+        {
+            "order_purchase_date": np.repeat(dates, 2)[::-1],
+            "product_category_name": ["beleza_saude"] * 16,
+            "customer_city": ["sao paulo", "campinas"] * 8,
+            "sales_amount_sum": np.arange(16, dtype="float64"),
+            "sales_amount_mean": np.arange(16, dtype="float64") / 2,
+            "sales_amount_lag_1": np.arange(16, dtype="float64") / 3,
+        }
+    )
+    store = get_dataset_store(tmp_path, "parquet")
+    store.write(df, "model_data")
+
+    x_train, y_train, x_val, y_val = split_model_data(
+        store, "sales_amount_sum", [1, 2], "2018-05-07", columns_per_read=2
+    )
+
+    expected_df = add_targets(df, "sales_amount_sum", [1, 2])
+    float_cols = list(df.select_dtypes("float64"))
+    expected_df[float_cols] = expected_df[float_cols].astype("float32")
+    expected_train = expected_df[
+        expected_df["order_purchase_date"] < "2018-05-07"
+    ].reset_index(drop=True)
+    expected_val = expected_df[
+        expected_df["order_purchase_date"] >= "2018-05-14"
+    ].reset_index(drop=True)
+    target_cols = ["target_1_semana", "target_2_semana"]
+    pd.testing.assert_frame_equal(
+        x_train.reset_index(drop=True), expected_train[list(df)]
+    )
+    pd.testing.assert_frame_equal(
+        y_train.reset_index(drop=True), expected_train[target_cols]
+    )
+    pd.testing.assert_frame_equal(x_val, expected_val[list(df)])
+    pd.testing.assert_frame_equal(y_val, expected_val[target_cols])
@@ -0,0 +1,116 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import ks_2samp, wasserstein_distance
+
+from scr.monitoring.window_stats import (
+    NumericSketch,
+    WindowStats,
+    drift_report,
+    numeric_drift,
+)
+
+SCHEMA = {
+    "feature_types": {
+        "product_category_name": "text",
+        "sales_amount_sum": "number",
+    }
+}
+
+
+def scored_rows(seed, shift=0.0, rows=1000):
+    rng = np.random.default_rng(seed)
+    prediction = rng.normal(10 + shift, 2, rows)
+
+    return pd.DataFrame(
+        {
+            "product_category_name": rng.choice(
+                ["beleza_saude", "esporte_lazer"], rows
+            ),
+            "sales_amount_sum": rng.gamma(2 + shift, 50, rows),
+            "prediction": prediction,
+            "target": prediction + 1,
+        }
+    )
+
+
+def window(*frames):
+    stats = WindowStats.for_schema(SCHEMA)
+    for df in frames:
+        stats.update(df)
+
+    return stats
+
+
+def test_batches_and_merged_windows_match_the_whole_window():
+
+    df = scored_rows(seed=1)
+    whole = window(df)
+    batches = window(
+        *[df.iloc[start:][:300] for start in range(0, 1000, 300)]
+    )
+    merged = window(df.iloc[:500]).merge(window(df.iloc[500:]))
+
+    for stats in [batches, merged]:
+        assert stats.rows == 1000
+        assert stats.categorical == whole.categorical
+        for col, sketch in stats.numeric.items():
+            assert sketch.buckets == whole.numeric[col].buckets
+            assert sketch.counts == whole.numeric[col].counts
+            assert sketch.moments == pytest.approx(whole.numeric[col].moments)
+
+    restored = WindowStats.from_dict(json.loads(json.dumps(merged.to_dict())))
+    reference = window(scored_rows(seed=0))
+    assert (
+        drift_report(reference, restored)["scores"]
+        == drift_report(reference, merged)["scores"]
+    )
+
+
+def test_sketch_scores_are_close_to_exact_scores():
+
+    rng = np.random.default_rng(0)
+    reference_values = rng.gamma(2, 50, 5000)
+    current_values = np.r_[rng.gamma(3, 50, 5000), 0, -1, np.nan]
+    reference = NumericSketch()
+    reference.update(reference_values)
+    current = NumericSketch()
+    current.update(current_values)
+
+    scores = numeric_drift(reference, current)
+    finite_values = current_values[~np.isnan(current_values)]
+    assert scores["ks"] == pytest.approx(
+        ks_2samp(reference_values, finite_values).statistic, abs=0.01
+    )
+    assert scores["wasserstein"] == pytest.approx(
+        wasserstein_distance(reference_values, finite_values)
+        / reference_values.std(),
+        rel=0.02,
+    )
+    assert current.counts == {"values": 5002, "zero": 1, "missing": 1}
+
+
+def test_drift_report():
+
+    reference = window(scored_rows(seed=0))
+    same = window(scored_rows(seed=1))
+    shifted = window(scored_rows(seed=1, shift=3))
+
+    report = drift_report(reference, same)
+    assert not report["dataset_drift"]
+    assert report["drifted_columns"] == []
+    assert report["mae"] == report["rmse"] == 1
+    assert report["mean_error"] == -1
+    assert report["reference_errors"] == {
+        "mae": 1,
+        "rmse": 1,
+        "mean_error": -1,
+    }
+
+    for method in ["psi", "ks", "wasserstein"]:
+        report = drift_report(reference, shifted, method)
+        assert report["dataset_drift"]
+        assert report["drifted_columns"] == ["prediction", "sales_amount_sum"]
+        assert report["rows"] == report["reference_rows"] == 1000